@@ -0,0 +1,198 @@
+import os
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+IVF_INDEX_FILE = "ivf.npz"
+ASSIGN_BLOCK_ROWS = 16384  # k-means 分配时每块计算的行数
+PAD_ID = -1  # 检索结果不足 k 条时的填充行号
+
+
+def _normalize(mat: np.ndarray) -> np.ndarray:
+    return mat / (np.linalg.norm(mat, axis=1, keepdims=True) + 1e-8)
+
+
+def _assign(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """
+    把每一行分配到内积最大的中心（向量均已归一化，等价于余弦最近）
+    """
+    labels = np.empty(len(matrix), dtype=np.int64)
+    for i in range(0, len(matrix), ASSIGN_BLOCK_ROWS):
+        block = np.asarray(matrix[i:i + ASSIGN_BLOCK_ROWS], dtype=np.float32)
+        labels[i:i + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+
+def spherical_kmeans(
+    matrix: np.ndarray,
+    n_clusters: int,
+    n_iter: int = 20,
+    max_train: int = 100000,
+    seed: int = 0
+) -> np.ndarray:
+    """
+    球面 k-means（余弦距离），训练集超过 max_train 时随机采样
+    :return: (n_clusters, dim) 已归一化的中心
+    """
+    rng = np.random.default_rng(seed)
+    n = len(matrix)
+    sample = np.sort(rng.choice(n, size=max_train, replace=False)) if n > max_train else np.arange(n)
+    train = np.asarray(matrix[sample], dtype=np.float32)
+    centroids = train[rng.choice(len(train), size=n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = _assign(train, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, train)
+        counts = np.bincount(labels, minlength=n_clusters)
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            # 空簇重新随机取点，避免中心退化
+            sums[empty] = train[rng.choice(len(train), size=len(empty), replace=False)]
+        new_centroids = _normalize(sums)
+        shift = float(np.max(np.abs(new_centroids - centroids)))
+        centroids = new_centroids
+        if shift < 1e-4:
+            break
+    return np.ascontiguousarray(centroids, dtype=np.float32)
+
+
+class IVFIndex:
+    """
+    倒排文件（IVF）近似检索：k-means 粗量化把向量分到 nlist 个桶，查询时只扫描最近的 nprobe 个桶
+    nprobe 越大召回越高、延迟越大；nprobe == nlist 时等价于精确检索
+    """
+    def __init__(self, nlist: int = None, nprobe: int = 8, n_iter: int = 20, seed: int = 0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.seed = seed
+        self.centroids: Optional[np.ndarray] = None  # (nlist, dim)
+        self.list_offsets: Optional[np.ndarray] = None  # (nlist + 1,) 每个桶在 list_rows 中的起止位置
+        self.list_rows: Optional[np.ndarray] = None  # (N,) 按桶排序的行号
+        # build 之后 add 的行单独记录所属桶，查询时线性过滤，compact/save 时并入倒排表
+        self.extra_rows = np.empty(0, dtype=np.int64)
+        self.extra_labels = np.empty(0, dtype=np.int64)
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def build(self, matrix: np.ndarray):
+        """
+        训练中心并把全部行分桶；matrix 须已 L2 归一化
+        """
+        n = len(matrix)
+        if n == 0:
+            raise ValueError("空矩阵无法构建 IVF 索引")
+        nlist = self.nlist or int(4 * np.sqrt(n))
+        nlist = max(1, min(nlist, n))
+        self.centroids = spherical_kmeans(matrix, nlist, n_iter=self.n_iter, seed=self.seed)
+        self.nlist = nlist
+        self._set_lists(_assign(matrix, self.centroids))
+
+    def _set_lists(self, labels: np.ndarray, rows: np.ndarray = None):
+        order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=self.nlist)
+        self.list_rows = (order if rows is None else rows[order]).astype(np.int64)
+        self.list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.extra_rows = np.empty(0, dtype=np.int64)
+        self.extra_labels = np.empty(0, dtype=np.int64)
+
+    def add(self, matrix: np.ndarray, start_row: int):
+        """
+        把新行分配到已训练的中心（不重新训练），代价只与新行数有关
+        :param matrix: 新增的已归一化向量，行号从 start_row 开始
+        """
+        if len(matrix) == 0:
+            return
+        self.extra_rows = np.concatenate([self.extra_rows, np.arange(start_row, start_row + len(matrix))])
+        self.extra_labels = np.concatenate([self.extra_labels, _assign(matrix, self.centroids)])
+
+    def _labels(self) -> Tuple[np.ndarray, np.ndarray]:
+        # 全部行（倒排表 + 新增）的 (行号, 桶号)
+        labels = np.repeat(np.arange(self.nlist), self.list_sizes())
+        return np.concatenate([self.list_rows, self.extra_rows]), np.concatenate([labels, self.extra_labels])
+
+    def merge_extra(self):
+        if len(self.extra_rows):
+            self._set_lists(*self._labels()[::-1])
+
+    def compact(self, keep: np.ndarray):
+        """
+        去掉 keep 为 False 的行并按顺序重新编号，中心不变
+        """
+        rows, labels = self._labels()
+        mask = keep[rows]
+        new_ids = np.cumsum(keep) - 1
+        self._set_lists(labels[mask], new_ids[rows[mask]])
+
+    def probe(self, query_emb: np.ndarray, nprobe: int = None) -> np.ndarray:
+        """
+        返回需扫描的候选行号（最近 nprobe 个桶的并集）
+        """
+        nprobe = max(1, min(nprobe or self.nprobe, self.nlist))
+        centroid_sims = self.centroids @ query_emb
+        if nprobe < self.nlist:
+            lists = np.argpartition(-centroid_sims, nprobe - 1)[:nprobe]
+        else:
+            lists = np.arange(self.nlist)
+        parts = [self.list_rows[self.list_offsets[l]:self.list_offsets[l + 1]] for l in lists]
+        if len(self.extra_rows):
+            parts.append(self.extra_rows[np.isin(self.extra_labels, lists)])
+        return np.concatenate(parts)
+
+    def list_sizes(self) -> np.ndarray:
+        return np.diff(self.list_offsets)
+
+    def save(self, index_dir: str):
+        self.merge_extra()
+        np.savez(
+            os.path.join(index_dir, IVF_INDEX_FILE),
+            centroids=self.centroids,
+            list_offsets=self.list_offsets,
+            list_rows=self.list_rows,
+            params=np.array([self.nlist, self.nprobe, self.n_iter, self.seed], dtype=np.int64),
+        )
+
+    @classmethod
+    def load(cls, index_dir: str, nprobe: int = None) -> "IVFIndex":
+        data = np.load(os.path.join(index_dir, IVF_INDEX_FILE))
+        nlist, saved_nprobe, n_iter, seed = (int(x) for x in data["params"])
+        index = cls(nlist=nlist, nprobe=nprobe or saved_nprobe, n_iter=n_iter, seed=seed)
+        index.centroids = data["centroids"]
+        index.list_offsets = data["list_offsets"]
+        index.list_rows = data["list_rows"]
+        return index
+
+
+def pad_ids(rows: Sequence[Sequence[int]], k: int) -> np.ndarray:
+    """
+    把各查询返回的行号列表用 PAD_ID 补齐到 k 列，得到 (Q, k) 矩阵
+    ivf 探测的桶内行数少于 k 时返回结果会不足 k 条
+    """
+    out = np.full((len(rows), k), PAD_ID, dtype=np.int64)
+    for i, r in enumerate(rows):
+        r = list(r)[:k]
+        out[i, :len(r)] = r
+    return out
+
+
+def recall_at_k(exact_ids: np.ndarray, approx_ids: np.ndarray) -> float:
+    """
+    recall@k：近似结果命中精确 top-k 的比例，输入均为 (Q, k) 行号矩阵（PAD_ID 不计入命中）
+    结果不足 k 条的查询用 short_results 单独统计
+    """
+    hits = 0
+    total = 0
+    for e, a in zip(exact_ids, approx_ids):
+        hits += len(set(e.tolist()) & set(a.tolist()) - {PAD_ID})
+        total += int(np.count_nonzero(e != PAD_ID))
+    return hits / total if total else 1.0
+
+
+def short_results(approx_ids: np.ndarray) -> Dict[str, int]:
+    """
+    统计返回不足 k 条的查询：{"queries": 查询数, "missing": 缺少的结果条数}
+    """
+    missing = (np.asarray(approx_ids) == PAD_ID).sum(axis=1)
+    return {"queries": int(np.count_nonzero(missing)), "missing": int(missing.sum())}
@@ -0,0 +1,244 @@
+import os
+import re
+import json
+from collections import Counter
+from typing import List, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+BM25_INDEX_FILE = "bm25.npz"
+BM25_VOCAB_FILE = "bm25_vocab.json"
+
+# 连续中文片段切字二元组；字母数字串整体作为一个词（如 2023、ROE、601319）
+_TOKEN_RE = re.compile(r"[\u4e00-\u9fff]+|[A-Za-z0-9]+(?:\.[0-9]+)?")
+_CJK_RE = re.compile(r"[\u4e00-\u9fff]")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    面向中文财报的分词：中文按字二元组切分（单字片段保留单字），英文数字按整词小写
+    例如“商誉减值” -> 商誉 誉减 减值，无需词典即可精确匹配术语
+    """
+    tokens = []
+    for seg in _TOKEN_RE.findall(text):
+        if _CJK_RE.match(seg):
+            if len(seg) == 1:
+                tokens.append(seg)
+            else:
+                tokens.extend(seg[i:i + 2] for i in range(len(seg) - 1))
+        else:
+            tokens.append(seg.lower())
+    return tokens
+
+
+class _Segment:
+    """
+    一段文档的倒排表（CSR）：词 -> [文档行号]，行号为全局行号
+    """
+    def __init__(self, vocab: Dict[str, int], term_offsets: np.ndarray, post_docs: np.ndarray, post_tf: np.ndarray):
+        self.vocab = vocab
+        self.term_offsets = term_offsets  # (V + 1,) 每个词在倒排表中的起止位置
+        self.post_docs = post_docs  # 倒排表：文档行号（同一词内升序）
+        self.post_tf = post_tf  # 倒排表：词频
+
+    @classmethod
+    def from_postings(cls, terms: List[str], term_ids: np.ndarray, doc_ids: np.ndarray, tfs: np.ndarray) -> "_Segment":
+        order = np.lexsort((doc_ids, term_ids))  # 按词排序，同一词内文档行号升序
+        df = np.bincount(term_ids, minlength=len(terms))
+        return cls(
+            vocab={t: i for i, t in enumerate(terms)},
+            term_offsets=np.concatenate([[0], np.cumsum(df)]).astype(np.int64),
+            post_docs=doc_ids[order].astype(np.int64),
+            post_tf=tfs[order].astype(np.float32),
+        )
+
+    @classmethod
+    def build(cls, texts: Sequence[str], start_row: int) -> Tuple["_Segment", np.ndarray]:
+        vocab: Dict[str, int] = {}
+        term_ids: List[int] = []
+        doc_ids: List[int] = []
+        tfs: List[int] = []
+        doc_len = np.zeros(len(texts), dtype=np.float32)
+        for d, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_len[d] = sum(counts.values())
+            for term, tf in counts.items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                doc_ids.append(start_row + d)
+                tfs.append(tf)
+        seg = cls.from_postings(list(vocab), np.asarray(term_ids, dtype=np.int64),
+                                np.asarray(doc_ids, dtype=np.int64), np.asarray(tfs, dtype=np.float32))
+        return seg, doc_len
+
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        t = self.vocab.get(term)
+        if t is None:
+            return self.post_docs[:0], self.post_tf[:0]
+        lo, hi = self.term_offsets[t], self.term_offsets[t + 1]
+        return self.post_docs[lo:hi], self.post_tf[lo:hi]
+
+    def terms(self) -> List[str]:
+        terms = [None] * len(self.vocab)
+        for term, t in self.vocab.items():
+            terms[t] = term
+        return terms
+
+
+class BM25Index:
+    """
+    倒排索引 + BM25 打分；一次遍历建索引，倒排表以 CSR 形式存为 numpy 数组
+    增量写入的文档单独成段（只对新文档分词），删除只打标记；idf、avgdl 在查询时按全部段汇总，
+    compact 时去掉已删除文档并合并为一段
+    """
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.segments: List[_Segment] = []
+        self.doc_len = np.zeros(0, dtype=np.float32)  # (N,) 每个文档的词数
+        self.deleted: Optional[np.ndarray] = None  # (N,) 删除标记，None 表示没有删除
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.doc_len)
+
+    def build(self, texts: Sequence[str]):
+        seg, doc_len = _Segment.build(texts, 0)
+        self.segments = [seg]
+        self.doc_len = doc_len
+        self.deleted = None
+
+    def add(self, texts: Sequence[str]):
+        """
+        追加文档（行号接在现有文档之后），代价只与新文档规模有关
+        """
+        if not len(texts):
+            return
+        seg, doc_len = _Segment.build(texts, self.n_docs)
+        self.segments.append(seg)
+        self.doc_len = np.concatenate([self.doc_len, doc_len])
+        if self.deleted is not None:
+            self.deleted = np.concatenate([self.deleted, np.zeros(len(texts), dtype=bool)])
+
+    def delete(self, rows: np.ndarray):
+        if self.deleted is None:
+            self.deleted = np.zeros(self.n_docs, dtype=bool)
+        self.deleted[rows] = True
+
+    def compact(self, keep: np.ndarray):
+        """
+        只保留 keep 为 True 的文档并按顺序重新编号，各段合并为一段（不重新分词）
+        :param keep: (N,) 布尔数组，通常为向量库的存活行
+        """
+        new_ids = np.cumsum(keep) - 1
+        vocab: Dict[str, int] = {}
+        term_parts, doc_parts, tf_parts = [], [], []
+        for seg in self.segments:
+            local_to_global = np.array([vocab.setdefault(t, len(vocab)) for t in seg.terms()], dtype=np.int64)
+            terms = np.repeat(local_to_global, np.diff(seg.term_offsets))
+            mask = keep[seg.post_docs]
+            term_parts.append(terms[mask])
+            doc_parts.append(new_ids[seg.post_docs[mask]])
+            tf_parts.append(seg.post_tf[mask])
+        if not self.segments:
+            self.doc_len = self.doc_len[keep]
+            return
+        term_ids = np.concatenate(term_parts)
+        # 只保留仍有倒排项的词
+        used = np.flatnonzero(np.bincount(term_ids, minlength=len(vocab)))
+        remap = np.full(len(vocab), -1, dtype=np.int64)
+        remap[used] = np.arange(len(used))
+        terms = list(vocab)
+        self.segments = [_Segment.from_postings([terms[i] for i in used], remap[term_ids],
+                                                np.concatenate(doc_parts), np.concatenate(tf_parts))]
+        self.doc_len = self.doc_len[keep]
+        self.deleted = None
+
+    def scores(self, query: str) -> np.ndarray:
+        """
+        返回全部文档的 BM25 分数（未命中及已删除为 0）
+        """
+        sims = np.zeros(self.n_docs, dtype=np.float32)
+        alive = self.n_docs - (int(self.deleted.sum()) if self.deleted is not None else 0)
+        if alive == 0:
+            return sims
+        doc_len = self.doc_len if self.deleted is None else self.doc_len[~self.deleted]
+        avgdl = max(float(doc_len.mean()), 1e-8)
+        for term, qtf in Counter(tokenize(query)).items():
+            hits = [seg.postings(term) for seg in self.segments]
+            # df 含尚未 compact 的已删除文档，删除比例不大时对 idf 影响很小
+            df = sum(len(docs) for docs, _ in hits)
+            if df == 0:
+                continue
+            idf = np.log(1 + (alive - df + 0.5) / (df + 0.5))
+            for docs, tf in hits:
+                if len(docs) == 0:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.doc_len[docs] / avgdl)
+                # 同一段内同一词的倒排项文档互不重复，可直接用花式索引累加
+                sims[docs] += idf * qtf * tf * (self.k1 + 1) / (tf + norm)
+        if self.deleted is not None:
+            sims[self.deleted] = 0
+        return sims
+
+    def search(self, query: str, top_k: int = 10, rows: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param rows: 可选，只在这些行中取 top_k（分区过滤）
+        :return: (行号, 分数)，只包含分数 > 0 的文档，按分数降序
+        """
+        sims = self.scores(query)
+        cand = np.flatnonzero(sims > 0)
+        if rows is not None:
+            cand = np.intersect1d(cand, rows, assume_unique=False)
+        if len(cand) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        cand_scores = sims[cand]
+        k = min(top_k, len(cand))
+        top = np.argpartition(-cand_scores, k - 1)[:k] if k < len(cand) else np.arange(len(cand))
+        top = top[np.lexsort((cand[top], -cand_scores[top]))]
+        return cand[top], cand_scores[top]
+
+    def save(self, index_dir: str):
+        arrays = {
+            "params": np.array([self.k1, self.b], dtype=np.float64),
+            "doc_len": self.doc_len,
+        }
+        if self.deleted is not None:
+            arrays["deleted"] = self.deleted
+        for i, seg in enumerate(self.segments):
+            arrays[f"seg{i}_term_offsets"] = seg.term_offsets
+            arrays[f"seg{i}_post_docs"] = seg.post_docs
+            arrays[f"seg{i}_post_tf"] = seg.post_tf
+        np.savez(os.path.join(index_dir, BM25_INDEX_FILE), **arrays)
+        with open(os.path.join(index_dir, BM25_VOCAB_FILE), "w", encoding="utf-8") as f:
+            json.dump([seg.terms() for seg in self.segments], f, ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, index_dir: str) -> "BM25Index":
+        data = np.load(os.path.join(index_dir, BM25_INDEX_FILE))
+        k1, b = data["params"]
+        index = cls(k1=float(k1), b=float(b))
+        index.doc_len = data["doc_len"]
+        index.deleted = data["deleted"] if "deleted" in data.files else None
+        with open(os.path.join(index_dir, BM25_VOCAB_FILE), "r", encoding="utf-8") as f:
+            seg_terms = json.load(f)
+        index.segments = [
+            _Segment({term: t for t, term in enumerate(terms)}, data[f"seg{i}_term_offsets"],
+                     data[f"seg{i}_post_docs"], data[f"seg{i}_post_tf"])
+            for i, terms in enumerate(seg_terms)
+        ]
+        return index
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int = 60,
+                           weights: Sequence[float] = None) -> List[Tuple[int, float]]:
+    """
+    倒数排名融合（RRF）：score(d) = Σ w_i / (k + rank_i(d))，rank 从 1 开始
+    :param rankings: 多路召回的行号列表，各自按相关度降序
+    :return: [(行号, 融合分数), ...]，按分数降序，同分按行号升序
+    """
+    weights = weights or [1.0] * len(rankings)
+    fused: Dict[int, float] = {}
+    for ranking, w in zip(rankings, weights):
+        for rank, doc in enumerate(ranking, start=1):
+            fused[int(doc)] = fused.get(int(doc), 0.0) + w / (k + rank)
+    return sorted(fused.items(), key=lambda x: (-x[1], x[0]))
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# 大模型回答的磁盘缓存：key 为 模型名 + 消息 + temperature + max_tokens 的哈希
+# 模式由 LLM_CACHE_MODE 配置：on 读写（默认）/ replay 只读回放，未命中不调用接口 / off 关闭
+DEFAULT_CACHE_PATH = os.getenv(
+    "LLM_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".llm_cache", "completions.sqlite")
+)
+DEFAULT_MAX_MB = float(os.getenv("LLM_CACHE_MAX_MB", "256"))
+CACHE_MODES = ("on", "replay", "off")
+
+
+def completion_key(model: str, messages: List[Dict[str, str]], temperature: float, max_tokens: int) -> str:
+    """
+    对请求中影响输出的部分做规范化 JSON 后取 sha256，提示词字节相同即命中
+    """
+    payload = json.dumps(
+        {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens},
+        ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """
+    基于 sqlite 的回答缓存，按最近访问时间做 LRU 淘汰，总大小不超过 max_mb
+    线程安全，同步/异步生成共用；读写均为本地小事务，可直接在事件循环中调用
+    """
+    def __init__(self, path: str = None, mode: str = None, max_mb: float = None):
+        """
+        :param path: 可选，sqlite 文件路径，默认 LLM_CACHE_PATH 或项目下 .llm_cache/completions.sqlite
+        :param mode: on/replay/off，默认读取 LLM_CACHE_MODE 或 on
+        :param max_mb: 缓存内容总大小上限（MB），超出时淘汰最久未访问的条目
+        """
+        self.mode = mode or os.getenv("LLM_CACHE_MODE", "on")
+        if self.mode not in CACHE_MODES:
+            raise ValueError(f"不支持的 LLM_CACHE_MODE: {self.mode}，可选 {CACHE_MODES}")
+        self.max_bytes = int((max_mb if max_mb is not None else DEFAULT_MAX_MB) * 1024 * 1024)
+        self.path = Path(path or DEFAULT_CACHE_PATH)
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.tokens_saved = 0
+        if self.mode != "off":
+            self._open()
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    @property
+    def replay(self) -> bool:
+        return self.mode == "replay"
+
+    def _open(self):
+        if self.replay:
+            # 回放模式以只读方式打开，不建表、不改日志模式；文件不存在时全部视为未命中
+            if not self.path.exists():
+                return
+            self._conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False,
+                                         isolation_level=None)
+            self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, model TEXT, content TEXT NOT NULL, tokens INTEGER, "
+            "size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON completions(accessed)")
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+    def __len__(self) -> int:
+        if self._conn is None:
+            return 0
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        查询缓存，命中时刷新访问时间（回放模式不刷新）
+        :return: 缓存的回答原文；未命中或缓存关闭时为 None
+        """
+        if self._conn is None:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT content, tokens FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.tokens_saved += row[1] or 0
+            # 回放模式只读：不刷新访问时间，不改变淘汰顺序与数据库文件
+            if not self.replay:
+                self._conn.execute("UPDATE completions SET accessed = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key: str, content: str, model: str = None, tokens: int = None):
+        """
+        写入一条回答，回放模式与关闭时忽略；写入后超出大小上限则按 LRU 淘汰
+        """
+        if self._conn is None or self.replay or content is None:
+            return
+        size = len(content.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completions (key, model, content, tokens, size, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, content, tokens, size, now, now)
+            )
+            self._size += size - (old[0] if old else 0)
+            self.writes += 1
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # 持锁调用：淘汰到上限的 90%，留出余量避免每次写入都触发
+        target = int(self.max_bytes * 0.9)
+        rows = self._conn.execute("SELECT key, size FROM completions ORDER BY accessed").fetchall()
+        drop = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            drop.append((key,))
+            self._size -= size
+        self._conn.executemany("DELETE FROM completions WHERE key = ?", drop)
+        self.evictions += len(drop)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "mode": self.mode,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "writes": self.writes,
+            "evictions": self.evictions,
+            "tokens_saved": self.tokens_saved,
+            "size_mb": self._size / 1024 / 1024,
+        }
+
+    def report(self) -> str:
+        s = self.stats()
+        return (f"回答缓存（{s['mode']}）：命中 {s['hits']}，未命中 {s['misses']}，命中率 {s['hit_rate']:.1%}，"
+                f"写入 {s['writes']}，淘汰 {s['evictions']}，节省约 {s['tokens_saved']} token，"
+                f"占用 {s['size_mb']:.1f}MB")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,143 @@
+import threading
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from get_text_embedding import estimate_tokens
+
+# 认定为切块重叠的最短公共前后缀长度（字符），太短的巧合重复不合并
+MIN_OVERLAP = 20
+
+
+def _header(file_name: str, page: Any) -> str:
+    return f"[文件名]{file_name} [页码]{page}\n"
+
+
+def _overlap(a: str, b: str, min_overlap: int) -> int:
+    """
+    a 的后缀与 b 的前缀重合的最大长度，不足 min_overlap 时返回 0
+    以 b 的前 min_overlap 个字符在 a 中定位候选起点，避免逐长度比较
+    """
+    if len(a) < min_overlap or len(b) < min_overlap:
+        return 0
+    probe = b[:min_overlap]
+    p = a.find(probe)
+    while p != -1:
+        if b.startswith(a[p:]):
+            return len(a) - p
+        p = a.find(probe, p + 1)
+    return 0
+
+
+def merge_overlaps(texts: List[str], min_overlap: int = MIN_OVERLAP) -> List[Tuple[str, List[int]]]:
+    """
+    合并同一页内的切块：去掉被其他块完全包含的块，再反复拼接重叠最长的一对（a 尾 == b 头）
+    :param texts: 同一 (file_name, page) 的块文本，按检索排名排列
+    :return: [(合并后文本, 组成它的输入下标列表)]，按其中最高排名排列
+    """
+    segs: List[Tuple[str, List[int]]] = []
+    for i, t in enumerate(texts):
+        t = t.strip()
+        host = next((s for s in segs if t in s[0]), None)
+        if host is not None:
+            host[1].append(i)
+            continue
+        # 新块包含已有块时吸收它们
+        absorbed = [s for s in segs if s[0] in t]
+        segs = [s for s in segs if s[0] not in t]
+        segs.append((t, sorted([i] + [j for s in absorbed for j in s[1]])))
+    while len(segs) > 1:
+        best = (0, -1, -1)
+        for x, (a, _) in enumerate(segs):
+            for y, (b, _) in enumerate(segs):
+                if x != y:
+                    ov = _overlap(a, b, min_overlap)
+                    if ov > best[0]:
+                        best = (ov, x, y)
+        ov, x, y = best
+        if ov == 0:
+            break
+        (a, ia), (b, ib) = segs[x], segs[y]
+        merged = (a + b[ov:], sorted(ia + ib))
+        segs = [s for k, s in enumerate(segs) if k not in (x, y)]
+        segs.append(merged)
+    return sorted(segs, key=lambda s: s[1][0])
+
+
+def pack_context(chunks: List[Dict[str, Any]], token_budget: int = None,
+                 min_overlap: int = MIN_OVERLAP) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """
+    组装提示词上下文：同一 (file_name, page) 的块合并并去掉切块重叠，按检索排名排序，再装入 token 预算
+    :param chunks: 检索结果，按分数从高到低（带 score 字段时按 score 排序）
+    :param token_budget: 可选，上下文估算 token 上限；放不下的段整体跳过，排名第一的段超长时截断
+    :return: (与 chunk 同结构的段列表, 统计 {tokens_before, tokens_after, saved, segments, dropped})
+    """
+    if any('score' in c for c in chunks):
+        chunks = sorted(chunks, key=lambda c: -c.get('score', float('-inf')))
+    groups: Dict[Tuple[str, Any], List[int]] = {}
+    for rank, c in enumerate(chunks):
+        md = c['metadata']
+        groups.setdefault((md['file_name'], md['page']), []).append(rank)
+    segments = []
+    for (file_name, page), ranks in groups.items():
+        for text, members in merge_overlaps([chunks[r]['content'] for r in ranks], min_overlap):
+            segments.append((ranks[members[0]], file_name, page, text))
+    segments.sort(key=lambda s: s[0])
+
+    packed, used, dropped = [], 0, 0
+    for _, file_name, page, text in segments:
+        cost = estimate_tokens(_header(file_name, page) + text)
+        if token_budget and used + cost > token_budget:
+            if packed:
+                dropped += 1
+                continue
+            # 最相关的一段也放不下时截断到预算内，保证至少有证据
+            while cost > token_budget and len(text) > 1:
+                text = text[:max(1, min(len(text) - 1, int(len(text) * token_budget / cost)))]
+                cost = estimate_tokens(_header(file_name, page) + text)
+        packed.append({"content": text, "metadata": {"file_name": file_name, "page": page}})
+        used += cost
+    before = sum(estimate_tokens(_header(c['metadata']['file_name'], c['metadata']['page']) + c['content'])
+                 for c in chunks)
+    return packed, {"tokens_before": before, "tokens_after": used, "saved": before - used,
+                    "segments": len(packed), "dropped": dropped}
+
+
+class ContextStats:
+    """
+    逐题记录上下文组装前后的估算 token 数，线程安全
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records: List[Dict[str, int]] = []
+
+    def record(self, stats: Dict[str, int]):
+        with self._lock:
+            self.records.append(stats)
+
+    def summary(self) -> Dict[str, float]:
+        with self._lock:
+            records = list(self.records)
+        if not records:
+            return {"questions": 0}
+        before = np.array([r["tokens_before"] for r in records], dtype=np.float64)
+        saved = np.array([r["saved"] for r in records], dtype=np.float64)
+        return {
+            "questions": len(records),
+            "tokens_before": int(before.sum()),
+            "tokens_saved": int(saved.sum()),
+            "saved_rate": float(saved.sum() / before.sum()) if before.sum() else 0.0,
+            "saved_per_question_mean": float(saved.mean()),
+            "saved_per_question_p50": float(np.percentile(saved, 50)),
+            "saved_per_question_max": float(saved.max()),
+            "dropped_segments": int(sum(r["dropped"] for r in records)),
+        }
+
+    def report(self) -> str:
+        s = self.summary()
+        if not s["questions"]:
+            return "上下文组装：无记录"
+        return (f"上下文组装：{s['questions']} 题，原始约 {s['tokens_before']} token，节省 {s['tokens_saved']}"
+                f"（{s['saved_rate']:.1%}）；每题节省 均值/p50/max = {s['saved_per_question_mean']:.0f}/"
+                f"{s['saved_per_question_p50']:.0f}/{s['saved_per_question_max']:.0f}，"
+                f"超出预算跳过 {s['dropped_segments']} 段")
@@ -0,0 +1,174 @@
+import os
+import hashlib
+from typing import List, Dict, Type
+
+import numpy as np
+
+from get_text_embedding import get_text_embedding
+
+# 通过环境变量选择后端：EMBEDDING_BACKEND=api|flag|hash，EMBEDDING_DIM、EMBEDDING_DTYPE 可选
+EMBEDDING_BACKENDS: Dict[str, Type["EmbeddingBackend"]] = {}
+
+SUPPORTED_DTYPES = {"float32": np.float32, "float16": np.float16}
+
+
+def register_backend(name: str):
+    """
+    注册 embedding 后端的装饰器，注册后可通过名字（配置）选择
+    """
+    def decorator(cls):
+        cls.name = name
+        EMBEDDING_BACKENDS[name] = cls
+        return cls
+    return decorator
+
+
+def _l2_normalize(mat: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    return mat / (norms + 1e-8)  # 避免除零
+
+
+class EmbeddingBackend:
+    """
+    embedding 后端统一接口：embed(texts) 返回 (len(texts), dim) 的二维数组
+    """
+    name = "base"
+
+    def __init__(self, model_name: str = None, dim: int = None, dtype: str = "float32", batch_size: int = 64):
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"不支持的 dtype: {dtype}，可选 {list(SUPPORTED_DTYPES)}")
+        self.model_name = model_name
+        self.dim = dim
+        self.dtype = SUPPORTED_DTYPES[dtype]
+        self.batch_size = batch_size
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    def _finalize(self, mat) -> np.ndarray:
+        mat = np.asarray(mat, dtype=np.float32)
+        if mat.size == 0:
+            return np.zeros((0, self.dim or 0), dtype=self.dtype)
+        if self.dim is None:
+            self.dim = int(mat.shape[1])
+        return np.ascontiguousarray(mat, dtype=self.dtype)
+
+
+@register_backend("api")
+class ApiEmbeddingBackend(EmbeddingBackend):
+    """
+    OpenAI 兼容的远程 embedding 接口（硅基流动等），带磁盘缓存
+    """
+    def __init__(self, model_name: str = None, dim: int = None, dtype: str = "float32", batch_size: int = 64,
+                 api_key: str = None, base_url: str = None):
+        super().__init__(model_name or os.getenv('LOCAL_EMBEDDING_MODEL'), dim, dtype, batch_size)
+        self.api_key = api_key or os.getenv('LOCAL_API_KEY')
+        self.base_url = base_url or os.getenv('LOCAL_BASE_URL')
+        if not self.api_key or not self.base_url:
+            raise ValueError('请在.env中配置LOCAL_API_KEY和LOCAL_BASE_URL')
+        if not self.model_name:
+            raise ValueError('请在.env中配置LOCAL_EMBEDDING_MODEL')
+        print(f"Use API mode:{self.model_name}")
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return self._finalize(get_text_embedding(
+            texts,
+            api_key=self.api_key,
+            base_url=self.base_url,
+            embedding_model=self.model_name,
+            batch_size=self.batch_size
+        ))
+
+
+@register_backend("flag")
+class FlagEmbeddingBackend(EmbeddingBackend):
+    """
+    本地 FlagEmbedding 模型（默认 bge-m3），默认在 CPU 上运行，可用 EMBEDDING_DEVICE 指定
+    """
+    def __init__(self, model_name: str = None, dim: int = None, dtype: str = "float32", batch_size: int = 64,
+                 device: str = None):
+        super().__init__(model_name or os.getenv('LOCAL_EMBEDDING_MODEL', 'BAAI/bge-m3'), dim, dtype, batch_size)
+        from FlagEmbedding import FlagModel
+        self.device = device or os.getenv('EMBEDDING_DEVICE', 'cpu')
+        print(f"正在加载嵌入模型: {self.model_name}")
+        model_kwargs = dict(
+            query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
+            use_fp16=self.device.startswith("cuda"),  # 仅 GPU 使用 fp16 加速
+        )
+        try:
+            self.model = FlagModel(self.model_name, devices=self.device, **model_kwargs)
+        except TypeError:
+            # 旧版 FlagEmbedding 不支持 devices 参数，按其默认设备选择
+            self.model = FlagModel(self.model_name, **model_kwargs)
+        # FlagModel 已经处于评估模式，不需要调用 eval()
+        print(f"嵌入模型加载完成，设备: {self.device}")
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        import torch
+        with torch.no_grad():
+            embeddings = self.model.encode(texts, batch_size=self.batch_size)
+        # 手动 L2 归一化以便余弦相似度计算
+        return self._finalize(_l2_normalize(np.asarray(embeddings, dtype=np.float32)))
+
+
+@register_backend("hash")
+class HashEmbeddingBackend(EmbeddingBackend):
+    """
+    确定性离线后端：字符 1-gram/2-gram 特征哈希到 dim 维并 L2 归一化
+    不需要网络和模型，同一文本在任何进程中结果一致，用于建库/检索基准测试
+    """
+    def __init__(self, model_name: str = None, dim: int = None, dtype: str = "float32", batch_size: int = 64,
+                 seed: int = 0):
+        super().__init__(model_name, dim or 1024, dtype, batch_size)
+        self.seed = seed
+        self.model_name = model_name or f"hash-ngram-{self.dim}-s{seed}"
+        # 由 seed 派生的 64 位乘法哈希常数，保证跨进程可复现
+        digest = hashlib.sha256(f"hash-embedding-{seed}".encode("utf-8")).digest()
+        self._mult = np.uint64(int.from_bytes(digest[:8], "little") | 1)
+        self._mult2 = np.uint64(int.from_bytes(digest[8:16], "little") | 1)
+
+    def _embed_one(self, text: str, out: np.ndarray):
+        codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        if codes.size == 0:
+            return
+        grams = codes
+        if codes.size > 1:
+            grams = np.concatenate([codes, (codes[:-1] << np.uint64(21)) ^ codes[1:] ^ np.uint64(1 << 63)])
+        h = grams * self._mult
+        h ^= h >> np.uint64(29)
+        h *= self._mult2
+        buckets = (h >> np.uint64(32)) % np.uint64(self.dim)
+        signs = np.where((h >> np.uint64(31)) & np.uint64(1), 1.0, -1.0)
+        out += np.bincount(buckets.astype(np.int64), weights=signs, minlength=self.dim)
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        mat = np.zeros((len(texts), self.dim), dtype=np.float64)
+        with np.errstate(over="ignore"):
+            for i, t in enumerate(texts):
+                self._embed_one(t, mat[i])
+        return self._finalize(_l2_normalize(mat))
+
+
+def create_embedding_backend(
+    backend: str = None,
+    model_name: str = None,
+    dim: int = None,
+    dtype: str = None,
+    batch_size: int = 64,
+    **kwargs
+) -> EmbeddingBackend:
+    """
+    按名字创建 embedding 后端，未显式传入的参数从环境变量读取
+    :param backend: 后端名（api/flag/hash），默认 EMBEDDING_BACKEND 或 api
+    :param model_name: 模型名，默认各后端自行读取 LOCAL_EMBEDDING_MODEL
+    :param dim: 向量维度（hash 后端生效），默认 EMBEDDING_DIM
+    :param dtype: 输出精度 float32/float16，默认 EMBEDDING_DTYPE 或 float32
+    :param batch_size: 批处理大小
+    """
+    backend = backend or os.getenv('EMBEDDING_BACKEND', 'api')
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"未知的 embedding 后端: {backend}，可选 {list(EMBEDDING_BACKENDS)}")
+    env_dim = os.getenv('EMBEDDING_DIM')
+    dim = dim or (int(env_dim) if env_dim else None)
+    dtype = dtype or os.getenv('EMBEDDING_DTYPE', 'float32')
+    return EMBEDDING_BACKENDS[backend](model_name=model_name, dim=dim, dtype=dtype, batch_size=batch_size, **kwargs)
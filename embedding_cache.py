@@ -0,0 +1,190 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from merge_chunks import norm_text
+
+# 缓存根目录，可通过环境变量 EMBEDDING_CACHE_DIR 覆盖
+DEFAULT_CACHE_DIR = os.getenv(
+    "EMBEDDING_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".embedding_cache")
+)
+
+VECTORS_FILE = "vectors.f32"   # float32 向量顺序追加写入
+INDEX_FILE = "index.tsv"       # 每行一个 key，行号即向量行号
+META_FILE = "meta.json"        # 模型名与向量维度
+
+# 内存中问题向量 LRU 的容量，可通过环境变量 QUERY_EMBEDDING_CACHE_SIZE 配置
+DEFAULT_QUERY_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "4096"))
+
+
+def text_key(text: str) -> str:
+    """
+    规范化文本后计算内容哈希，空白/零宽字符差异不会导致重复 embedding
+    """
+    return hashlib.sha1(norm_text(text).encode("utf-8")).hexdigest()
+
+
+def _model_dir_name(model_name: str) -> str:
+    # 模型名可能含 "/"（如 BAAI/bge-m3），转成安全目录名并附带短哈希防止冲突
+    safe = re.sub(r"[^0-9A-Za-z._-]+", "_", model_name).strip("_") or "model"
+    return f"{safe}-{hashlib.sha1(model_name.encode('utf-8')).hexdigest()[:8]}"
+
+
+class EmbeddingCache:
+    """
+    基于内容寻址的 embedding 磁盘缓存，按 (模型名, 规范化文本哈希) 索引
+    每个模型一个子目录：vectors.f32 存紧凑 float32 矩阵，index.tsv 存 key 顺序
+    """
+    def __init__(self, model_name: str, cache_dir: str = None):
+        if not model_name:
+            raise ValueError("model_name 不能为空")
+        self.model_name = model_name
+        self.dir = Path(cache_dir or DEFAULT_CACHE_DIR) / _model_dir_name(model_name)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.dim: Optional[int] = None
+        self._rows: Dict[str, int] = {}
+        self._n_rows = 0
+        self._mmap: Optional[np.memmap] = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _load(self):
+        meta_path = self.dir / META_FILE
+        if not meta_path.exists():
+            return
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        self.dim = int(meta["dim"])
+        vec_path = self.dir / VECTORS_FILE
+        index_path = self.dir / INDEX_FILE
+        if not vec_path.exists() or not index_path.exists():
+            return
+        # 向量先于索引落盘；进程中断时以两者中较短的一方为准
+        n_vec = vec_path.stat().st_size // (4 * self.dim)
+        with open(index_path, "r", encoding="utf-8") as f:
+            keys = f.read().splitlines()[:n_vec]
+        for row, key in enumerate(keys):
+            self._rows[key] = row
+        self._n_rows = len(keys)
+        self._truncate_to(self._n_rows)
+
+    def _truncate_to(self, n_rows: int):
+        # 丢弃上次中断残留的半截数据，保证向量行与索引行一一对应
+        vec_path = self.dir / VECTORS_FILE
+        index_path = self.dir / INDEX_FILE
+        if vec_path.exists() and self.dim and vec_path.stat().st_size != n_rows * 4 * self.dim:
+            with open(vec_path, "r+b") as f:
+                f.truncate(n_rows * 4 * self.dim)
+        if index_path.exists():
+            with open(index_path, "r", encoding="utf-8") as f:
+                lines = f.read().splitlines()
+            if len(lines) != n_rows:
+                index_path.write_text("".join(l + "\n" for l in lines[:n_rows]), encoding="utf-8")
+
+    def _matrix(self) -> Optional[np.memmap]:
+        if self._mmap is None and self._rows:
+            self._mmap = np.memmap(self.dir / VECTORS_FILE, dtype=np.float32, mode="r",
+                                   shape=(self._n_rows, self.dim))
+        return self._mmap
+
+    def gather(self, keys: Sequence[str]) -> Tuple[Optional[np.ndarray], np.ndarray]:
+        """
+        批量查询缓存，命中的向量直接写入预分配矩阵
+        :param keys: text_key 生成的 key 列表
+        :return: ((len(keys), dim) float32 矩阵，未命中行未初始化；缓存为空时为 None, 命中布尔掩码)
+        """
+        with self._lock:
+            rows = np.fromiter((self._rows.get(k, -1) for k in keys), dtype=np.int64, count=len(keys))
+            hit_mask = rows >= 0
+            if self.dim is None or not hit_mask.any():
+                return (np.empty((len(keys), self.dim), dtype=np.float32) if self.dim else None), hit_mask
+            out = np.empty((len(keys), self.dim), dtype=np.float32)
+            out[hit_mask] = self._matrix()[rows[hit_mask]]
+            return out, hit_mask
+
+    def put_many(self, keys: Sequence[str], vectors) -> None:
+        """
+        追加写入新向量，已存在的 key 跳过
+        :param keys: text_key 生成的 key 列表
+        :param vectors: 与 keys 等长的向量（二维数组或列表）
+        """
+        if len(keys) == 0:
+            return
+        vecs = np.ascontiguousarray(vectors, dtype=np.float32)
+        if vecs.ndim != 2 or vecs.shape[0] != len(keys):
+            raise ValueError(f"向量形状 {vecs.shape} 与 key 数量 {len(keys)} 不匹配")
+        with self._lock:
+            if self.dim is None:
+                self.dim = int(vecs.shape[1])
+                (self.dir / META_FILE).write_text(
+                    json.dumps({"model": self.model_name, "dim": self.dim}, ensure_ascii=False),
+                    encoding="utf-8"
+                )
+            elif vecs.shape[1] != self.dim:
+                raise ValueError(f"向量维度 {vecs.shape[1]} 与缓存维度 {self.dim} 不一致")
+            new_keys, new_rows, seen = [], [], set()
+            for i, k in enumerate(keys):
+                if k in self._rows or k in seen:
+                    continue
+                seen.add(k)
+                new_keys.append(k)
+                new_rows.append(i)
+            if not new_keys:
+                return
+            start = self._n_rows
+            with open(self.dir / VECTORS_FILE, "ab") as f:
+                vecs[new_rows].tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.dir / INDEX_FILE, "a", encoding="utf-8") as f:
+                f.write("".join(k + "\n" for k in new_keys))
+            for offset, k in enumerate(new_keys):
+                self._rows[k] = start + offset
+            self._n_rows += len(new_keys)
+            self._mmap = None  # 文件已增长，下次读取时重新映射
+
+
+class QueryEmbeddingLRU:
+    """
+    问题向量的内存 LRU 缓存，按 text_key(问题) 索引；批量预先嵌入后检索、生成阶段直接复用
+    """
+    def __init__(self, max_size: int = None):
+        self.max_size = max_size or DEFAULT_QUERY_CACHE_SIZE
+        self._items: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._items
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vec = self._items.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return vec
+
+    def put_many(self, keys: Sequence[str], vectors: np.ndarray):
+        with self._lock:
+            for k, v in zip(keys, vectors):
+                self._items[k] = v
+                self._items.move_to_end(k)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
@@ -0,0 +1,96 @@
+import json
+from typing import Any, List, Optional
+
+_decoder = json.JSONDecoder()
+
+
+def _scan(text: str, opener: str) -> List[Any]:
+    """
+    从任意位置的 opener（'{' 或 '['）开始尝试解析 JSON 值，跳过模型输出中的说明文字、```json 代码块标记等
+    """
+    values = []
+    i = text.find(opener)
+    while i != -1:
+        try:
+            value, end = _decoder.raw_decode(text, i)
+        except ValueError:
+            i = text.find(opener, i + 1)
+            continue
+        values.append(value)
+        i = text.find(opener, end)
+    return values
+
+
+def extract_json_array(text: str, mode: str = 'objects') -> Optional[str]:
+    """
+    从大模型输出中提取 JSON
+    :param mode: objects 收集所有顶层 JSON 对象组成数组；array 取第一个 JSON 数组
+    :return: JSON 数组字符串，找不到时返回 None
+    """
+    if not text:
+        return None
+    if mode == 'objects':
+        values = [v for v in _scan(text, '{') if isinstance(v, dict)]
+    elif mode == 'array':
+        values = next((v for v in _scan(text, '[') if isinstance(v, list)), None)
+    else:
+        raise ValueError(f"不支持的 mode: {mode}，可选 objects/array")
+    if not values:
+        return None
+    return json.dumps(values, ensure_ascii=False)
+
+
+class FirstJSONObject:
+    """
+    流式输出的增量 JSON 解析：逐段 feed 模型输出，第一个完整且合法的顶层 JSON 对象到达时返回 True
+    跟踪字符串与转义，括号配平后才尝试解析；不合法时从下一个 '{' 重新开始
+    """
+    def __init__(self):
+        self.buf = ""
+        self.value: Optional[dict] = None
+        self.end: Optional[int] = None
+        self._pos = 0
+        self._start = -1
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+
+    @property
+    def text(self) -> str:
+        # 已收到的输出；找到对象后截止到对象末尾
+        return self.buf[:self.end] if self.end is not None else self.buf
+
+    def feed(self, delta: str) -> bool:
+        if self.value is not None:
+            return True
+        self.buf += delta
+        buf = self.buf
+        while self._pos < len(buf):
+            ch = buf[self._pos]
+            if self._start < 0:
+                if ch == '{':
+                    self._start, self._depth, self._in_str, self._esc = self._pos, 1, False, False
+            elif self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif ch == '\\':
+                    self._esc = True
+                elif ch == '"':
+                    self._in_str = False
+            elif ch == '"':
+                self._in_str = True
+            elif ch == '{':
+                self._depth += 1
+            elif ch == '}':
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        value = json.loads(buf[self._start:self._pos + 1])
+                    except ValueError:
+                        value = None
+                    if isinstance(value, dict):
+                        self.value, self.end = value, self._pos + 1
+                        return True
+                    self._pos, self._start = self._start, -1
+            self._pos += 1
+        return False
@@ -6,6 +6,10 @@ import hashlib
  
 from typing import List, Dict, Optional, Tuple
 import json
+import numpy as np
+
+from embedding_cache import EmbeddingCache, text_key
+from llm_client import get_sync_client
 
 # LOCAL_API_KEY,LOCAL_BASE_URL,LOCAL_TEXT_MODEL,LOCAL_EMBEDDING_MODEL
 
@@ -15,63 +19,270 @@ load_dotenv()  # 加载环境变量（可选，用户可自行读取）
 
 def get_openai_client(api_key: str, base_url: str) -> OpenAI:
     """
-    获取 OpenAI 客户端，必须传递 api_key 和 base_url
+    获取 OpenAI 客户端，必须传递 api_key 和 base_url；同一 api_key/base_url 复用进程内共享的连接池
     """
     if not api_key or not base_url:
         raise ValueError("api_key 和 base_url 必须显式传递！")
-    return OpenAI(
-        api_key=api_key,
-        base_url=base_url,
-    )
+    return get_sync_client(api_key, base_url)
 
 
 
 from tqdm import tqdm
+import re
+import time
+import threading
+import concurrent.futures
+from openai import RateLimitError, APIStatusError
+
+from rate_limiter import get_rate_limiter, retry_delay
+
+# 同时在途的 embedding 批次数，可通过环境变量 EMBEDDING_MAX_CONCURRENCY 配置
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "4"))
+# 单批最大重试次数与退避参数（指数退避 + 全抖动，单次等待不超过 max_delay）
+DEFAULT_MAX_RETRIES = 6
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+# 单个请求的估算 token 上限，可通过环境变量 EMBEDDING_MAX_BATCH_TOKENS 配置
+DEFAULT_MAX_BATCH_TOKENS = int(os.getenv("EMBEDDING_MAX_BATCH_TOKENS", "8192"))
+
+_CJK_RE = re.compile(r"[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]")
+
+
+class BatchTooLargeError(Exception):
+    """服务端以超出 token/长度限制为由拒绝了整个批次"""
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算文本 token 数：中文及全角字符按 1 字 1 token，其余按 3 字符 1 token（偏保守）
+    """
+    n_cjk = len(_CJK_RE.findall(text))
+    return n_cjk + (len(text) - n_cjk + 2) // 3 + 1
+
+
+def pack_batches_by_tokens(
+    token_counts: List[int],
+    max_batch_tokens: int,
+    max_batch_size: int
+) -> List[Tuple[int, int]]:
+    """
+    按顺序把文本贪心装入批次，每批估算 token 不超过 max_batch_tokens、条数不超过 max_batch_size
+    :param token_counts: 每条文本的估算 token 数
+    :return: [(start, end), ...] 连续区间，拼接后覆盖全部输入
+    """
+    spans = []
+    start, used = 0, 0
+    for i, n in enumerate(token_counts):
+        if i > start and (used + n > max_batch_tokens or i - start >= max_batch_size):
+            spans.append((start, i))
+            start, used = i, 0
+        used += n
+    if start < len(token_counts):
+        spans.append((start, len(token_counts)))
+    return spans
+
+
+class _TokenBudget:
+    """
+    并发批次共享的单请求 token 上限；一旦有批次因过大被拒，就下调上限，后续批次发送前预先拆分
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._lock = threading.Lock()
+
+    def shrink_below(self, rejected_tokens: int):
+        with self._lock:
+            self.limit = min(self.limit, max(1, rejected_tokens - 1))
+
+
+def _is_too_large(err: Exception) -> bool:
+    # 413，或 400 且错误信息指向 token/长度超限
+    if not isinstance(err, APIStatusError):
+        return False
+    if err.status_code == 413:
+        return True
+    if err.status_code != 400:
+        return False
+    msg = str(err).lower()
+    return any(k in msg for k in ("token", "too large", "too long", "maximum", "exceed", "length"))
+
+
+def _is_retryable(err: Exception) -> bool:
+    # 4xx 客户端错误（参数、鉴权等）重试无意义，直接抛出；429/408/409 及网络、5xx 错误可重试
+    if isinstance(err, RateLimitError):
+        return True
+    if isinstance(err, APIStatusError):
+        return err.status_code >= 500 or err.status_code in (408, 409)
+    return True
+
+
+def _embed_batch_with_retry(
+    client: OpenAI,
+    embedding_model: str,
+    batch_texts: List[str],
+    batch_no: int,
+    max_retries: int,
+    base_delay: float,
+    max_delay: float
+) -> Tuple[np.ndarray, Optional[int]]:
+    """
+    请求单个批次，失败时按批次独立重试，不影响其他在途批次
+    :return: (float32 嵌入矩阵, 服务端返回的实际 token 数；未返回 usage 时为 None)
+    """
+    limiter = get_rate_limiter("embedding")
+    est_tokens = sum(estimate_tokens(t) for t in batch_texts)
+    attempt = 0
+    while True:
+        try:
+            # 经共享限流器排队：RPM/TPM 令牌桶 + 自适应并发，429 会让所有批次一起降速
+            with limiter.acquire(est_tokens) as permit:
+                response = client.embeddings.create(
+                    model=embedding_model,
+                    input=batch_texts
+                )
+                usage = getattr(response, "usage", None)
+                used_tokens = getattr(usage, "total_tokens", None) or getattr(usage, "prompt_tokens", None)
+                permit.set_tokens(used_tokens)
+            batch = np.array([embedding.embedding for embedding in response.data], dtype=np.float32)
+            return batch, used_tokens
+        except Exception as e:
+            if _is_too_large(e):
+                raise BatchTooLargeError(str(e)) from e
+            if not _is_retryable(e) or attempt >= max_retries:
+                raise RuntimeError(f"第{batch_no}批 embedding 请求失败（已重试{attempt}次）: {e}") from e
+            # 与大模型请求共用退避策略：指数退避 + 抖动，服务端给出 Retry-After 时以其为下限
+            delay = retry_delay(e, attempt, base_delay, max_delay)
+            # Retry-After 同时已让限流器暂停放行，这里的等待与其重叠，不会叠加
+            attempt += 1
+            print(f"第{batch_no}批 {type(e).__name__}: {e}. {delay:.1f}秒后重试（第{attempt}次）...")
+            time.sleep(delay)
+
+
+def _embed_span_adaptive(
+    client: OpenAI,
+    embedding_model: str,
+    batch_texts: List[str],
+    batch_tokens: List[int],
+    batch_no: int,
+    budget: _TokenBudget,
+    max_retries: int,
+    base_delay: float,
+    max_delay: float
+) -> Tuple[np.ndarray, int]:
+    """
+    发送一个批次；超过当前 token 上限或被服务端判为过大时对半拆分后递归重试
+    :return: (float32 嵌入矩阵, 本批消耗的 token 数)
+    """
+    est = sum(batch_tokens)
+    if len(batch_texts) > 1 and est > budget.limit:
+        mid = len(batch_texts) // 2
+    else:
+        try:
+            embeddings, used = _embed_batch_with_retry(
+                client, embedding_model, batch_texts, batch_no, max_retries, base_delay, max_delay
+            )
+            return embeddings, used or est
+        except BatchTooLargeError as e:
+            if len(batch_texts) == 1:
+                raise RuntimeError(f"第{batch_no}批中单条文本（约{est} token）超出服务端长度限制: {e}") from e
+            budget.shrink_below(est)
+            mid = len(batch_texts) // 2
+            print(f"第{batch_no}批（{len(batch_texts)}条，约{est} token）过大，拆分为两半重试，上限调整为 {budget.limit}")
+    left, left_used = _embed_span_adaptive(
+        client, embedding_model, batch_texts[:mid], batch_tokens[:mid], batch_no,
+        budget, max_retries, base_delay, max_delay
+    )
+    right, right_used = _embed_span_adaptive(
+        client, embedding_model, batch_texts[mid:], batch_tokens[mid:], batch_no,
+        budget, max_retries, base_delay, max_delay
+    )
+    return np.concatenate([left, right]), left_used + right_used
+
 
 def batch_get_embeddings(
     texts: List[str],
     batch_size: int = 64,
     api_key: str = None,
     base_url: str = None,
-    embedding_model: str = None
-) -> List[List[float]]:
+    embedding_model: str = None,
+    max_concurrency: int = None,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    base_delay: float = DEFAULT_BASE_DELAY,
+    max_delay: float = DEFAULT_MAX_DELAY,
+    max_batch_tokens: int = None,
+    stats: Dict = None
+) -> np.ndarray:
     """
-    批量获取文本的嵌入向量
+    批量获取文本的嵌入向量，按估算 token 预算装批并发请求，输出顺序与输入顺序一致
     :param texts: 文本列表
-    :param batch_size: 批处理大小
+    :param batch_size: 单批最大条数
     :param api_key: 可选，自定义 API KEY
     :param base_url: 可选，自定义 BASE URL
     :param embedding_model: 可选，自定义嵌入模型
-    :return: 嵌入向量列表
+    :param max_concurrency: 同时在途的批次数，默认 EMBEDDING_MAX_CONCURRENCY（1 为串行）
+    :param max_retries: 单批最大重试次数
+    :param base_delay: 退避基准秒数
+    :param max_delay: 单次退避等待上限（服务端 Retry-After 优先）
+    :param max_batch_tokens: 单个请求的估算 token 上限，默认 EMBEDDING_MAX_BATCH_TOKENS
+    :param stats: 可选，传入 dict 时回填 tokens、seconds、tokens_per_sec、batches 等统计
+    :return: (len(texts), dim) 的 float32 嵌入矩阵
     """
     if not api_key or not base_url or not embedding_model:
         raise ValueError("api_key、base_url、embedding_model 必须显式传递！")
-    all_embeddings = []
     client = get_openai_client(api_key, base_url)
     total = len(texts)
     if total == 0:
-        return []
-    iterator = range(0, total, batch_size)
+        return np.zeros((0, 0), dtype=np.float32)
+    token_counts = [estimate_tokens(t) for t in texts]
+    budget = _TokenBudget(max_batch_tokens or DEFAULT_MAX_BATCH_TOKENS)
+    spans = pack_batches_by_tokens(token_counts, budget.limit, batch_size)
+    max_concurrency = max(1, min(max_concurrency or DEFAULT_MAX_CONCURRENCY, len(spans)))
+    all_embeddings: Optional[np.ndarray] = None  # 首批返回、得知维度后一次性分配
+    used_tokens = 0
+    t0 = time.perf_counter()
+    pbar = tqdm(total=len(spans), desc="Embedding", unit="batch") if total > 1 else None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = {
+            executor.submit(
+                _embed_span_adaptive, client, embedding_model, texts[i:j], token_counts[i:j],
+                n + 1, budget, max_retries, base_delay, max_delay
+            ): i
+            for n, (i, j) in enumerate(spans)
+        }
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                i = futures[future]
+                batch_embeddings, batch_used = future.result()
+                if all_embeddings is None:
+                    all_embeddings = np.empty((total, batch_embeddings.shape[1]), dtype=np.float32)
+                # 按批次起始位置直接写入预分配矩阵，保证与输入顺序一致
+                all_embeddings[i:i + len(batch_embeddings)] = batch_embeddings
+                used_tokens += batch_used
+                if pbar is not None:
+                    pbar.update(1)
+        except Exception:
+            for f in futures:
+                f.cancel()
+            raise
+        finally:
+            if pbar is not None:
+                pbar.close()
+    elapsed = time.perf_counter() - t0
+    tokens_per_sec = used_tokens / elapsed if elapsed > 0 else 0.0
     if total > 1:
-        iterator = tqdm(iterator, desc="Embedding", unit="batch")
-    import time
-    from openai import RateLimitError
-    for i in iterator:
-        batch_texts = texts[i:i + batch_size]
-        retry_count = 0
-        while True:
-            try:
-                response = client.embeddings.create(
-                    model=embedding_model,
-                    input=batch_texts
-                )
-                batch_embeddings = [embedding.embedding for embedding in response.data]
-                all_embeddings.extend(batch_embeddings)
-                break
-            except RateLimitError as e:
-                retry_count += 1
-                print(f"RateLimitError: {e}. 等待10秒后重试（第{retry_count}次）...")
-                time.sleep(10)
+        print(f"Embedding 完成: {total} 条 / {len(spans)} 批, 约 {used_tokens} token, "
+              f"{elapsed:.1f}s, {tokens_per_sec:.0f} token/s")
+        print(get_rate_limiter("embedding").report())
+    if stats is not None:
+        stats.update({
+            "texts": total,
+            "batches": len(spans),
+            "tokens": used_tokens,
+            "seconds": elapsed,
+            "tokens_per_sec": tokens_per_sec,
+            "max_batch_tokens": budget.limit,
+            "rate_limit": get_rate_limiter("embedding").stats(),
+        })
     return all_embeddings
 
 
@@ -81,27 +292,59 @@ def get_text_embedding(
     api_key: str = None,
     base_url: str = None,
     embedding_model: str = None,
-    batch_size: int = 64
-) -> List[List[float]]:
+    batch_size: int = 64,
+    use_cache: bool = True,
+    cache_dir: str = None,
+    max_batch_tokens: int = None
+) -> np.ndarray:
     """
     获取文本的嵌入向量，支持批次处理，保持输出顺序与输入顺序一致
     :param texts: 文本列表
     :param api_key: 可选，自定义 API KEY
     :param base_url: 可选，自定义 BASE URL
     :param embedding_model: 可选，自定义嵌入模型
-    :param batch_size: 批处理大小
-    :return: 嵌入向量列表
+    :param batch_size: 单批最大条数
+    :param use_cache: 是否使用磁盘 embedding 缓存（按 模型名+规范化文本哈希 命中）
+    :param cache_dir: 可选，缓存目录，默认 EMBEDDING_CACHE_DIR 或项目下 .embedding_cache
+    :param max_batch_tokens: 可选，单个请求的估算 token 上限
+    :return: (len(texts), dim) 的 float32 嵌入矩阵
     """
     if not api_key or not base_url or not embedding_model:
         raise ValueError("api_key、base_url、embedding_model 必须显式传递！")
-    # 直接批量获取所有文本的embedding，不做缓存
-    return batch_get_embeddings(
-        texts,
-        batch_size=batch_size,
-        api_key=api_key,
-        base_url=base_url,
-        embedding_model=embedding_model
-    )
-
-
-    
+    if not use_cache:
+        return batch_get_embeddings(
+            texts,
+            batch_size=batch_size,
+            api_key=api_key,
+            base_url=base_url,
+            embedding_model=embedding_model,
+            max_batch_tokens=max_batch_tokens
+        )
+    cache = EmbeddingCache(embedding_model, cache_dir)
+    keys = [text_key(t) for t in texts]
+    out, hit_mask = cache.gather(keys)
+    n_hit = int(hit_mask.sum())
+    # 只把未命中的文本（同内容只算一次）发给 API
+    miss: Dict[str, List[int]] = {}
+    for pos, k in enumerate(keys):
+        if not hit_mask[pos]:
+            miss.setdefault(k, []).append(pos)
+    if miss:
+        print(f"Embedding 缓存命中 {n_hit}/{len(texts)}，待请求 {len(miss)} 条")
+        miss_keys = list(miss.keys())
+        new_embeddings = batch_get_embeddings(
+            [texts[miss[k][0]] for k in miss_keys],
+            batch_size=batch_size,
+            api_key=api_key,
+            base_url=base_url,
+            embedding_model=embedding_model,
+            max_batch_tokens=max_batch_tokens
+        )
+        cache.put_many(miss_keys, new_embeddings)
+        if out is None:
+            out = np.empty((len(texts), new_embeddings.shape[1]), dtype=np.float32)
+        for row, k in enumerate(miss_keys):
+            out[miss[k]] = new_embeddings[row]
+    if out is None:
+        return np.zeros((0, 0), dtype=np.float32)
+    return out
@@ -0,0 +1,111 @@
+import os
+import asyncio
+import threading
+import weakref
+from typing import Dict, Optional, Tuple
+
+import httpx
+from dotenv import load_dotenv
+from openai import OpenAI, AsyncOpenAI
+
+load_dotenv()
+
+# 进程内共享的 OpenAI 兼容客户端：配置只读取一次，同步/异步客户端复用 keep-alive 连接池
+# 连接池与超时可通过 LLM_POOL_SIZE、LLM_KEEPALIVE、LLM_CONNECT_TIMEOUT、LLM_TIMEOUT 配置
+
+_CONFIG: Optional["LLMConfig"] = None
+_SYNC_CLIENTS: Dict[Tuple[str, str], OpenAI] = {}
+# 异步连接池绑定在创建它的事件循环上，按循环分别缓存，循环结束后自动释放
+_ASYNC_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, str], AsyncOpenAI]]" = \
+    weakref.WeakKeyDictionary()
+_LOCK = threading.Lock()
+
+
+class LLMConfig:
+    """
+    大模型与 embedding 接口配置，来自环境变量（.env）
+    """
+    def __init__(self):
+        self.api_key = os.getenv('LOCAL_API_KEY')
+        self.base_url = os.getenv('LOCAL_BASE_URL')
+        self.text_model = os.getenv('LOCAL_TEXT_MODEL')
+        self.embedding_model = os.getenv('LOCAL_EMBEDDING_MODEL')
+        self.pool_size = int(os.getenv('LLM_POOL_SIZE', '32'))
+        self.keepalive = int(os.getenv('LLM_KEEPALIVE', str(self.pool_size)))
+        self.connect_timeout = float(os.getenv('LLM_CONNECT_TIMEOUT', '10'))
+        self.timeout = float(os.getenv('LLM_TIMEOUT', '60'))
+
+    def validate(self, require_text_model: bool = True) -> "LLMConfig":
+        if not self.api_key or not self.base_url or (require_text_model and not self.text_model):
+            raise ValueError('请在.env中配置LOCAL_API_KEY、LOCAL_BASE_URL、LOCAL_TEXT_MODEL')
+        if self.pool_size < 1 or self.keepalive < 0 or self.connect_timeout <= 0 or self.timeout <= 0:
+            raise ValueError('LLM_POOL_SIZE 须 >= 1，LLM_KEEPALIVE 须 >= 0，超时须 > 0')
+        return self
+
+
+def load_llm_config(reload: bool = False) -> LLMConfig:
+    """
+    读取并缓存配置，进程内只读取一次；reload=True 时重新读取（已创建的客户端不受影响）
+    """
+    global _CONFIG
+    with _LOCK:
+        if _CONFIG is None or reload:
+            _CONFIG = LLMConfig()
+        return _CONFIG
+
+
+def _http_options(config: LLMConfig) -> Dict:
+    return {
+        "limits": httpx.Limits(max_connections=config.pool_size, max_keepalive_connections=config.keepalive),
+        "timeout": httpx.Timeout(config.timeout, connect=config.connect_timeout),
+    }
+
+
+def get_sync_client(api_key: str = None, base_url: str = None) -> OpenAI:
+    """
+    获取共享的同步客户端（线程安全，可在线程池中并发使用）
+    重试由调用方配合限流器完成，客户端自身不重试
+    :param api_key: 可选，默认取配置中的 LOCAL_API_KEY
+    :param base_url: 可选，默认取配置中的 LOCAL_BASE_URL
+    """
+    config = load_llm_config()
+    key = (api_key or config.api_key, base_url or config.base_url)
+    if not key[0] or not key[1]:
+        raise ValueError("api_key 和 base_url 必须显式传递！")
+    with _LOCK:
+        client = _SYNC_CLIENTS.get(key)
+        if client is None:
+            client = OpenAI(api_key=key[0], base_url=key[1], max_retries=0,
+                            http_client=httpx.Client(**_http_options(config)))
+            _SYNC_CLIENTS[key] = client
+        return client
+
+
+def get_async_client(api_key: str = None, base_url: str = None) -> AsyncOpenAI:
+    """
+    获取当前事件循环共享的异步客户端，须在事件循环内调用
+    """
+    config = load_llm_config()
+    key = (api_key or config.api_key, base_url or config.base_url)
+    if not key[0] or not key[1]:
+        raise ValueError("api_key 和 base_url 必须显式传递！")
+    loop = asyncio.get_running_loop()
+    with _LOCK:
+        clients = _ASYNC_CLIENTS.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            client = AsyncOpenAI(api_key=key[0], base_url=key[1], max_retries=0,
+                                 http_client=httpx.AsyncClient(**_http_options(config)))
+            clients[key] = client
+        return client
+
+
+def close_clients():
+    """
+    关闭同步客户端的连接池（进程退出前可选调用）；异步客户端随事件循环释放
+    """
+    with _LOCK:
+        clients = list(_SYNC_CLIENTS.values())
+        _SYNC_CLIENTS.clear()
+    for client in clients:
+        client.close()
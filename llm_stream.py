@@ -0,0 +1,103 @@
+import time
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from extract_json_array import FirstJSONObject
+
+# 流式生成：增量解析输出，第一个完整 JSON 对象到达即关闭流，不再等待模型写完 max_tokens
+
+
+def _delta(event) -> Optional[str]:
+    choices = getattr(event, "choices", None)
+    if not choices:
+        return None
+    return getattr(choices[0].delta, "content", None)
+
+
+class StreamStats:
+    """
+    流式请求指标：首 token 时间（TTFT）、拿到完整答案的时间（TTA）、总耗时、提前终止比例，线程安全
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records: List[Dict[str, Any]] = []
+
+    def record(self, ttft: Optional[float], tta: float, total: float, early_stop: bool, chars: int):
+        with self._lock:
+            self.records.append({"ttft": ttft, "tta": tta, "total": total, "early_stop": early_stop, "chars": chars})
+
+    def summary(self) -> Dict[str, float]:
+        with self._lock:
+            records = list(self.records)
+        if not records:
+            return {"requests": 0}
+        ttft = np.array([r["ttft"] for r in records if r["ttft"] is not None], dtype=np.float64)
+        tta = np.array([r["tta"] for r in records], dtype=np.float64)
+        pct = lambda a, q: float(np.percentile(a, q) * 1000) if a.size else 0.0
+        return {
+            "requests": len(records),
+            "ttft_ms_p50": pct(ttft, 50),
+            "ttft_ms_p95": pct(ttft, 95),
+            "tta_ms_p50": pct(tta, 50),
+            "tta_ms_p95": pct(tta, 95),
+            "early_stop_rate": sum(r["early_stop"] for r in records) / len(records),
+            "output_chars_mean": float(np.mean([r["chars"] for r in records])),
+        }
+
+    def report(self) -> str:
+        s = self.summary()
+        if not s["requests"]:
+            return "流式生成：无记录"
+        return (f"流式生成：{s['requests']} 次，TTFT p50/p95 = {s['ttft_ms_p50']:.0f}/{s['ttft_ms_p95']:.0f}ms，"
+                f"答案完成 p50/p95 = {s['tta_ms_p50']:.0f}/{s['tta_ms_p95']:.0f}ms，"
+                f"提前终止 {s['early_stop_rate']:.1%}，平均输出 {s['output_chars_mean']:.0f} 字符")
+
+
+def read_stream(stream, t0: float, stats: StreamStats = None) -> str:
+    """
+    消费同步流，第一个完整 JSON 对象到达时关闭连接（服务端随之停止生成）
+    :param t0: 发起请求的 time.perf_counter()，用于计算 TTFT/TTA
+    :return: 收到的输出；找到 JSON 对象时截止到对象末尾
+    """
+    parser, ttft, tta, early = FirstJSONObject(), None, None, False
+    try:
+        for event in stream:
+            delta = _delta(event)
+            if not delta:
+                continue
+            if ttft is None:
+                ttft = time.perf_counter() - t0
+            if parser.feed(delta):
+                early, tta = True, time.perf_counter() - t0
+                break
+    finally:
+        stream.close()
+    total = time.perf_counter() - t0
+    if stats is not None:
+        stats.record(ttft, tta if early else total, total, early, len(parser.buf))
+    return parser.text
+
+
+async def read_stream_async(stream, t0: float, stats: StreamStats = None) -> str:
+    """
+    read_stream 的异步版本
+    """
+    parser, ttft, tta, early = FirstJSONObject(), None, None, False
+    try:
+        async for event in stream:
+            delta = _delta(event)
+            if not delta:
+                continue
+            if ttft is None:
+                ttft = time.perf_counter() - t0
+            if parser.feed(delta):
+                early, tta = True, time.perf_counter() - t0
+                break
+    finally:
+        await stream.close()
+    total = time.perf_counter() - t0
+    if stats is not None:
+        stats.record(ttft, tta if early else total, total, early, len(parser.buf))
+    return parser.text
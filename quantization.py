@@ -0,0 +1,195 @@
+import os
+from typing import Optional
+
+import numpy as np
+
+QUANT_INDEX_FILE = "quant.npz"
+SCORE_BLOCK_ROWS = 65536  # 解码打分时每块处理的行数
+
+
+class _CodeQuantizer:
+    """
+    量化器公共部分：codes 为逐行编码，新增行用已训练的参数编码，删除行在 compact 时去掉
+    """
+    kind = "base"
+    codes: Optional[np.ndarray] = None
+
+    def train(self, matrix: np.ndarray):
+        raise NotImplementedError
+
+    def encode(self, matrix: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def score_codes(self, query_emb: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def build(self, matrix: np.ndarray):
+        self.train(matrix)
+        self.codes = self.encode(matrix)
+
+    def add(self, matrix: np.ndarray):
+        """
+        追加新行的编码（不重新训练），代价只与新行数有关
+        """
+        if len(matrix):
+            self.codes = np.concatenate([self.codes, self.encode(matrix)])
+
+    def compact(self, keep: np.ndarray):
+        self.codes = np.ascontiguousarray(self.codes[keep])
+
+    def scores(self, query_emb: np.ndarray, rows: np.ndarray = None) -> np.ndarray:
+        return self.score_codes(query_emb, self.codes if rows is None else self.codes[rows])
+
+    def code_bytes(self) -> int:
+        return int(self.codes.nbytes)
+
+
+class ScalarInt8Quantizer(_CodeQuantizer):
+    """
+    逐维标量 int8 量化：x ≈ offset + scale * (code + 128)，每个向量占 dim 字节（float32 的 1/4）
+    打分为非对称方式：查询保持 float32，q·x = (q*scale)·code + 常数项，不需要解码整库
+    增量写入的新行超出训练时的取值范围会被截断
+    """
+    kind = "int8"
+
+    def __init__(self):
+        self.scale: Optional[np.ndarray] = None
+        self.offset: Optional[np.ndarray] = None
+        self.codes: Optional[np.ndarray] = None  # (N, dim) int8
+
+    def train(self, matrix: np.ndarray):
+        lo = np.full(matrix.shape[1], np.inf, dtype=np.float32)
+        hi = np.full(matrix.shape[1], -np.inf, dtype=np.float32)
+        for i in range(0, len(matrix), SCORE_BLOCK_ROWS):
+            block = np.asarray(matrix[i:i + SCORE_BLOCK_ROWS], dtype=np.float32)
+            lo = np.minimum(lo, block.min(axis=0))
+            hi = np.maximum(hi, block.max(axis=0))
+        self.offset = lo
+        self.scale = np.maximum(hi - lo, 1e-8) / 255.0
+
+    def encode(self, matrix: np.ndarray) -> np.ndarray:
+        codes = np.empty(matrix.shape, dtype=np.int8)
+        for i in range(0, len(matrix), SCORE_BLOCK_ROWS):
+            block = np.asarray(matrix[i:i + SCORE_BLOCK_ROWS], dtype=np.float32)
+            q = np.rint((block - self.offset) / self.scale) - 128
+            codes[i:i + len(block)] = np.clip(q, -128, 127)
+        return codes
+
+    def _query_terms(self, query_emb: np.ndarray):
+        weighted = query_emb * self.scale
+        const = float(query_emb @ self.offset + 128.0 * weighted.sum())
+        return weighted.astype(np.float32), const
+
+    def score_codes(self, query_emb: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        weighted, const = self._query_terms(query_emb)
+        sims = np.empty(len(codes), dtype=np.float32)
+        for i in range(0, len(codes), SCORE_BLOCK_ROWS):
+            block = codes[i:i + SCORE_BLOCK_ROWS].astype(np.float32)
+            sims[i:i + len(block)] = block @ weighted
+        return sims + const
+
+    def save(self, index_dir: str):
+        np.savez(os.path.join(index_dir, QUANT_INDEX_FILE), kind=np.array(self.kind),
+                 scale=self.scale, offset=self.offset, codes=self.codes)
+
+    def _load_arrays(self, data):
+        self.scale, self.offset, self.codes = data["scale"], data["offset"], data["codes"]
+
+
+def _kmeans_l2(data: np.ndarray, k: int, n_iter: int, rng: np.random.Generator) -> np.ndarray:
+    # 欧氏 k-means，用于 PQ 子空间码本训练
+    centroids = data[rng.choice(len(data), size=k, replace=len(data) < k)].copy()
+    data_sq = (data ** 2).sum(axis=1, keepdims=True)
+    for _ in range(n_iter):
+        dist = data_sq - 2 * data @ centroids.T + (centroids ** 2).sum(axis=1)
+        labels = np.argmin(dist, axis=1)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, data)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        empty = np.flatnonzero(~nonempty)
+        if len(empty):
+            centroids[empty] = data[rng.choice(len(data), size=len(empty))]
+    return centroids
+
+
+class ProductQuantizer(_CodeQuantizer):
+    """
+    乘积量化（PQ）：向量切成 m 段，每段用 256 个中心的码本编码，每个向量只占 m 字节
+    打分为非对称方式：先算查询各段与码本的内积表（m×256），再按编码查表求和
+    """
+    kind = "pq"
+
+    def __init__(self, m: int = 64, ksub: int = 256, n_iter: int = 15, max_train: int = 50000, seed: int = 0):
+        if ksub > 256:
+            raise ValueError("ksub 不能超过 256（编码为 uint8）")
+        self.m = m
+        self.ksub = ksub
+        self.n_iter = n_iter
+        self.max_train = max_train
+        self.seed = seed
+        self.codebooks: Optional[np.ndarray] = None  # (m, ksub, dsub)
+        self.codes: Optional[np.ndarray] = None  # (N, m) uint8
+
+    def train(self, matrix: np.ndarray):
+        n, dim = matrix.shape
+        if dim % self.m:
+            raise ValueError(f"维度 {dim} 不能被 m={self.m} 整除")
+        rng = np.random.default_rng(self.seed)
+        sample = np.sort(rng.choice(n, size=self.max_train, replace=False)) if n > self.max_train else np.arange(n)
+        train = np.asarray(matrix[sample], dtype=np.float32)
+        dsub = dim // self.m
+        self.codebooks = np.stack([
+            _kmeans_l2(np.ascontiguousarray(train[:, j * dsub:(j + 1) * dsub]), self.ksub, self.n_iter, rng)
+            for j in range(self.m)
+        ]).astype(np.float32)
+
+    def encode(self, matrix: np.ndarray) -> np.ndarray:
+        dsub = self.codebooks.shape[2]
+        codes = np.empty((len(matrix), self.m), dtype=np.uint8)
+        cb_sq = (self.codebooks ** 2).sum(axis=2)  # (m, ksub)
+        for i in range(0, len(matrix), SCORE_BLOCK_ROWS):
+            block = np.asarray(matrix[i:i + SCORE_BLOCK_ROWS], dtype=np.float32)
+            for j in range(self.m):
+                sub = block[:, j * dsub:(j + 1) * dsub]
+                codes[i:i + len(block), j] = np.argmin(cb_sq[j] - 2 * sub @ self.codebooks[j].T, axis=1)
+        return codes
+
+    def score_codes(self, query_emb: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        dsub = self.codebooks.shape[2]
+        # 内积查找表：lut[j, c] = q_j · codebook_j[c]
+        lut = np.einsum('mkd,md->mk', self.codebooks, query_emb.reshape(self.m, dsub)).astype(np.float32)
+        sims = np.empty(len(codes), dtype=np.float32)
+        cols = np.arange(self.m)
+        for i in range(0, len(codes), SCORE_BLOCK_ROWS):
+            block = codes[i:i + SCORE_BLOCK_ROWS]
+            sims[i:i + len(block)] = lut[cols, block].sum(axis=1)
+        return sims
+
+    def save(self, index_dir: str):
+        np.savez(os.path.join(index_dir, QUANT_INDEX_FILE), kind=np.array(self.kind),
+                 codebooks=self.codebooks, codes=self.codes,
+                 params=np.array([self.m, self.ksub, self.n_iter, self.max_train, self.seed], dtype=np.int64))
+
+    def _load_arrays(self, data):
+        self.m, self.ksub, self.n_iter, self.max_train, self.seed = (int(x) for x in data["params"])
+        self.codebooks, self.codes = data["codebooks"], data["codes"]
+
+
+QUANTIZERS = {"int8": ScalarInt8Quantizer, "pq": ProductQuantizer}
+
+
+def create_quantizer(storage: str, pq_m: int = 64):
+    if storage == "int8":
+        return ScalarInt8Quantizer()
+    if storage == "pq":
+        return ProductQuantizer(m=pq_m)
+    raise ValueError(f"不支持的量化方式: {storage}，可选 {list(QUANTIZERS)}")
+
+
+def load_quantizer(index_dir: str):
+    data = np.load(os.path.join(index_dir, QUANT_INDEX_FILE))
+    quantizer = QUANTIZERS[str(data["kind"])]()
+    quantizer._load_arrays(data)
+    return quantizer
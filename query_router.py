@@ -0,0 +1,101 @@
+import re
+from typing import Dict, List, Optional, Set, Iterable
+
+from report_meta import extract_company_and_year
+
+# 问题中的年份：2023年、2023年度、2023 年
+YEAR_RE = re.compile(r"(20\d{2})\s*年")
+# 公司全称中可省略的后缀，去掉后作为额外别名
+COMPANY_SUFFIXES = ("集团股份有限公司", "股份有限公司", "有限责任公司", "有限公司")
+
+
+def _full_name_aliases(filename: str) -> Set[str]:
+    """
+    从文件名最后一段解析公司全称，如“600970中国中材国际工程股份有限公司2023年年度报告” -> 中国中材国际工程股份有限公司
+    """
+    stem = re.sub(r"\.pdf$", "", filename, flags=re.IGNORECASE)
+    last = stem.split("-")[-1]
+    name = re.sub(r"^\d{6}", "", last)
+    name = re.sub(r"\d{4}年?年?度?报告.*$", "", name)
+    aliases = set()
+    if len(name) >= 2 and re.search(r"[\u4e00-\u9fff]", name):
+        aliases.add(name)
+        for suffix in COMPANY_SUFFIXES:
+            if name.endswith(suffix) and len(name) - len(suffix) >= 2:
+                aliases.add(name[:-len(suffix)])
+                break
+    return aliases
+
+
+class QueryRouter:
+    """
+    公司/年份路由：从已加载 chunk 的 file_name 建立 公司别名 -> 公司 与 公司 -> 年份 的映射，
+    用一个编译好的多模式正则（长别名优先）在问题中识别实体，生成向量库的 where 过滤条件
+    """
+    def __init__(self, file_attributes: Dict[str, Dict[str, str]], extra_aliases: Dict[str, str] = None):
+        """
+        :param file_attributes: file_name -> {company, year, ticker}，通常取 SimpleVectorStore.file_attributes
+        :param extra_aliases: 可选，额外别名 -> 公司名（如 "人保": "中国人保"）
+        """
+        self.alias_to_company: Dict[str, str] = {}
+        self.company_years: Dict[str, Set[str]] = {}
+        for fn, attrs in file_attributes.items():
+            company, year = attrs.get("company"), attrs.get("year")
+            if not company:
+                company, year = extract_company_and_year(fn)
+            if not company:
+                continue
+            self.company_years.setdefault(company, set())
+            if year:
+                self.company_years[company].add(year)
+            aliases = {company} | _full_name_aliases(fn)
+            ticker = attrs.get("ticker", "")
+            if ticker:
+                aliases.update({ticker, ticker.split(".")[0]})
+            for alias in aliases:
+                # 同一别名对应多家公司时保留先出现的，避免歧义别名误路由
+                self.alias_to_company.setdefault(alias, company)
+        for alias, company in (extra_aliases or {}).items():
+            if company in self.company_years:
+                self.alias_to_company[alias] = company
+        self._pattern = self._compile(self.alias_to_company.keys())
+
+    @staticmethod
+    def _compile(aliases: Iterable[str]) -> Optional["re.Pattern"]:
+        aliases = sorted(aliases, key=len, reverse=True)  # 长别名优先匹配
+        if not aliases:
+            return None
+        return re.compile("|".join(re.escape(a) for a in aliases))
+
+    @classmethod
+    def from_store(cls, vector_store, extra_aliases: Dict[str, str] = None) -> "QueryRouter":
+        return cls(vector_store.file_attributes, extra_aliases)
+
+    def detect(self, question: str) -> Dict[str, List[str]]:
+        """
+        识别问题中的公司与年份
+        :return: {"company": [...], "year": [...]}，按出现顺序去重
+        """
+        companies = []
+        if self._pattern is not None:
+            for m in self._pattern.finditer(question):
+                company = self.alias_to_company[m.group(0)]
+                if company not in companies:
+                    companies.append(company)
+        years = list(dict.fromkeys(YEAR_RE.findall(question)))
+        return {"company": companies, "year": years}
+
+    def route(self, question: str) -> Optional[Dict[str, List[str]]]:
+        """
+        生成向量库过滤条件；未识别到公司时返回 None（全局检索）
+        识别到的年份在这些公司的报告中都不存在时只按公司过滤
+        """
+        found = self.detect(question)
+        if not found["company"]:
+            return None
+        where = {"company": found["company"]}
+        available = set().union(*(self.company_years.get(c, set()) for c in found["company"]))
+        years = [y for y in found["year"] if y in available]
+        if years:
+            where["year"] = years
+        return where
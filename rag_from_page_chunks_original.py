@@ -1,120 +1,915 @@
 import json
 import os
+import asyncio
+import random
+import time
 
 import hashlib
-from typing import List, Dict, Any
+import itertools
+from typing import List, Dict, Any, Optional, Tuple, Callable
+import numpy as np
 from tqdm import tqdm
 import sys
 sys.path.append(os.path.dirname(__file__))
-from get_text_embedding import get_text_embedding # 用于获取文本嵌入
+from embedding_backends import create_embedding_backend # 可配置的 embedding 后端
+from ann_index import IVFIndex # 近似最近邻（IVF）索引
+from quantization import create_quantizer, load_quantizer # int8 / PQ 量化存储
+from report_meta import report_attributes # 从年报文件名解析公司/年份
+from query_router import QueryRouter # 问题中的公司/年份识别与检索路由
+from bm25_index import BM25Index, BM25_INDEX_FILE, reciprocal_rank_fusion # 稀疏倒排索引与 RRF 融合
+from reranker import RerankStage, create_reranker # 召回后的二阶段重排
+from topk import topk_indices, topk_indices_2d # 确定性的 top-k 选择
+from sharded_search import ShardedSearcher # 多进程分片暴力检索
 
 from dotenv import load_dotenv # 用于加载环境变量
-from openai import OpenAI # 用于调用OpenAI API
+from openai import AsyncOpenAI # 用于调用OpenAI API
+from llm_client import load_llm_config, get_sync_client, get_async_client # 共享连接池的客户端
+from extract_json_array import extract_json_array # 从模型输出中提取 JSON
+from get_text_embedding import estimate_tokens # 粗略估算 token 数
+from rate_limiter import get_rate_limiter, rate_limit_report, retry_delay # embedding 与 chat 共享的限流器
+from completion_cache import CompletionCache, completion_key # 大模型回答的磁盘缓存
+from embedding_cache import QueryEmbeddingLRU, text_key # 问题向量的内存 LRU
+from context_packing import ContextStats, pack_context # 提示词上下文去重叠与 token 预算
+from llm_stream import StreamStats, read_stream, read_stream_async # 流式生成与提前终止
+from run_journal import RunJournal, file_sha1, write_json_array # 可恢复的逐题结果日志
+from semantic_cache import SemanticAnswerCache, InflightCoalescer # 语义答案缓存与并发请求合并
 # 统一加载项目根目录的.env
 #os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
 load_dotenv() # 加载环境变量
 
+SEARCH_BLOCK_ROWS = 65536 # 检索时按块计算相似度的行数
+SEARCH_BATCH_MAX_SCORES = 1 << 24 # 批量检索时单个相似度块的最大元素数（约 64MB float32）
+SHARD_MIN_ROWS = 100000 # 库规模不低于该值时才启用多进程分片检索，规模小时进程间通信开销大于收益
+VECTOR_INDEX_TYPES = ('flat', 'ivf') # flat 精确检索；ivf 近似检索
+VECTOR_STORAGE_TYPES = ('float32', 'int8', 'pq') # 打分用的向量存储方式
+PARTITION_KEYS = ('file_name', 'company', 'year', 'ticker') # 分区过滤可用字段
+RETRIEVAL_MODES = ('dense', 'bm25', 'hybrid') # 向量检索 / 关键词检索 / 两路 RRF 融合
+
+# 持久化索引目录中的文件
+INDEX_MANIFEST_FILE = 'manifest.json' # 模型名、维度、语料哈希等；最后写入，存在即表示索引完整
+INDEX_MATRIX_FILE = 'embeddings.npy'  # 已归一化的向量矩阵，加载时内存映射
+INDEX_CHUNKS_FILE = 'chunks.jsonl'    # 每行一个 chunk（内容+元数据）；增量保存时新增 chunk 追加在末尾
+INDEX_DELTA_MATRIX_FILE = 'delta_embeddings.bin' # 增量保存追加的已归一化向量（原始字节，行数见 manifest）
+INDEX_DELETED_FILE = 'deleted_rows.bin' # 增量保存追加的已删除行号（int64）
+INDEX_FORMAT_VERSION = 3
+INDEX_COMPACT_RATIO = 0.3 # 未合并的新增+删除行超过总行数该比例时，保存改为 compact 后全量重写
+CORPUS_UPDATES_SUFFIX = '.updates.jsonl' # 语料 JSON 旁的增量更新日志，每行一次报告的替换/删除
+
 class PageChunkLoader: # 用于加载分页后的内容
     def __init__(self, json_path: str):
         self.json_path = json_path
+        self.updates_path = json_path + CORPUS_UPDATES_SUFFIX
+    def _committed_updates(self) -> bytes:
+        # 增量更新日志中完整的行；末尾写了一半的行（中途中断）不计入
+        if not os.path.exists(self.updates_path):
+            return b''
+        with open(self.updates_path, 'rb') as f:
+            data = f.read()
+        return data[:data.rfind(b'\n') + 1]
+    def _read_updates(self) -> List[Dict[str, Any]]:
+        return [json.loads(line) for line in self._committed_updates().decode('utf-8').splitlines()]
     def load_chunks(self) -> List[Dict[str, Any]]:
+        """
+        读取语料 JSON，并按顺序应用增量更新日志：受影响报告的旧 chunk 去掉，替换后的 chunk 追加在末尾
+        """
         with open(self.json_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+            chunks = json.load(f)
+        for rec in self._read_updates():
+            chunks = [c for c in chunks if c['metadata']['file_name'] != rec['file_name']]
+            if rec['op'] == 'upsert':
+                chunks.extend(rec['chunks'])
+        return chunks
+    def append_update(self, op: str, file_name: str, chunks: List[Dict[str, Any]] = None):
+        """
+        追加一条报告级更新到增量日志并落盘，不重写语料 JSON
+        :param op: upsert 用 chunks 替换该报告的全部 chunk；delete 删除该报告
+        """
+        if op not in ('upsert', 'delete'):
+            raise ValueError(f"不支持的更新类型: {op}")
+        rec = {"op": op, "file_name": file_name}
+        if op == 'upsert':
+            rec["chunks"] = [strip_chunk_id(c) for c in chunks]
+        committed = len(self._committed_updates())
+        with open(self.updates_path, 'ab') as f:
+            f.truncate(committed)
+            f.write((json.dumps(rec, ensure_ascii=False) + '\n').encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+    def compact_updates(self) -> int:
+        """
+        把增量日志合并进语料 JSON（全量重写，先写临时文件再替换）并删除日志
+        :return: 合并的更新条数
+        """
+        n = len(self._read_updates())
+        if not n:
+            return 0
+        chunks = self.load_chunks()
+        with open(self.json_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(chunks, f, ensure_ascii=False, indent=2)
+        os.replace(self.json_path + '.tmp', self.json_path)
+        os.remove(self.updates_path)
+        return n
+    def corpus_hash(self) -> str:
+        # 按文件字节流计算 sha256（有增量日志时接着计入其完整的行），用于判断持久化索引是否与当前语料一致（无需解析 JSON）
+        h = hashlib.sha256()
+        with open(self.json_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        h.update(self._committed_updates())
+        return h.hexdigest()
 
 
 class EmbeddingModel: # 用于生成文本嵌入
-    def __init__(self, batch_size: int = 64, use_local: bool = False, model_name: str = None):
+    def __init__(self, batch_size: int = 64, use_local: bool = False, model_name: str = None,
+                 backend: str = None, dim: int = None, dtype: str = None):
+        """
+        :param use_local: 兼容旧参数，为 True 且未指定 backend 时使用本地 FlagEmbedding
+        :param backend: 后端名（api/flag/hash），默认读取 EMBEDDING_BACKEND
+        :param dim: 向量维度（hash 后端生效），默认读取 EMBEDDING_DIM
+        :param dtype: 输出精度 float32/float16，默认读取 EMBEDDING_DTYPE
+        """
         self.batch_size = batch_size
-        self.use_local = False
-        
-        if use_local:
-            # 直接使用 Hugging Face 模型
-            from FlagEmbedding import FlagModel
-            import torch
-            
-            # 默认使用 bge-m3，也可以通过参数指定
-            self.model_name = model_name or os.getenv('LOCAL_EMBEDDING_MODEL', 'BAAI/bge-m3')
-            self.device = "cuda" if torch.cuda.is_available() else "cpu"
-            
-            print(f"正在加载嵌入模型: {self.model_name}")
-            self.model = FlagModel(
-                self.model_name,
-                query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
-                use_fp16=(self.device == "cuda")  # GPU 使用 fp16 加速
-            )
-            # FlagModel 已经处于评估模式，不需要调用 eval()
-            print(f"嵌入模型加载完成，设备: {self.device}")
-        else:
-            # 保留原有的 API 调用方式（向后兼容）
-            print("使用硅基流动API")
-        
-            self.api_key = os.getenv('LOCAL_API_KEY')
-            self.base_url = os.getenv('LOCAL_BASE_URL')
-            self.embedding_model = os.getenv('LOCAL_EMBEDDING_MODEL')
-            if not self.api_key or not self.base_url:
-                raise ValueError('请在.env中配置LOCAL_API_KEY和LOCAL_BASE_URL')
-            print(f"Use API mode:{self.embedding_model}")
+        if backend is None and use_local:
+            backend = 'flag'
+        self.backend = create_embedding_backend(
+            backend, model_name=model_name, dim=dim, dtype=dtype, batch_size=batch_size
+        )
+        self.use_local = self.backend.name != 'api'
 
-    def embed_texts(self, texts: List[str]) -> List[List[float]]:
-        if self.use_local:
-            # 直接使用本地模型
-            import torch
-            import numpy as np
-            with torch.no_grad():
-                # FlagModel 支持批量处理
-                embeddings = self.model.encode(
-                    texts,
-                    batch_size=self.batch_size
-                    # 移除 normalize_embeddings 参数
-                )
-                # 手动归一化以便余弦相似度计算
-                if hasattr(embeddings, 'tolist'):
-                    embeddings = embeddings.tolist()
-                # 转换为 numpy 数组进行归一化
-                embeddings = np.array(embeddings)
-                # L2 归一化
-                norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
-                embeddings = embeddings / (norms + 1e-8)  # 避免除零
-                return embeddings.tolist()
-            return embeddings.tolist() if hasattr(embeddings, 'tolist') else embeddings
-        else:
-            # 原有的 API 调用方式
-            return get_text_embedding(
-                texts,
-                api_key=self.api_key,
-                base_url=self.base_url,
-                embedding_model=self.embedding_model,
-                batch_size=self.batch_size
-            )
+    @property
+    def model_name(self) -> str:
+        return self.backend.model_name
 
-    def embed_text(self, text: str) -> List[float]:
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        # 返回 (len(texts), dim) 的连续 float32/float16 矩阵，不再转 Python 列表
+        return self.backend.embed(texts)
+
+    def embed_text(self, text: str) -> np.ndarray:
         return self.embed_texts([text])[0]
 
+def strip_chunk_id(chunk: Dict[str, Any]) -> Dict[str, Any]:
+    # chunk_id 仅供向量库内部比对，写入语料与输出结果时去掉，保持原有格式
+    return {k: v for k, v in chunk.items() if k != 'chunk_id'}
+
+
+def assign_chunk_ids(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    为没有 chunk_id 的 chunk 生成稳定 ID：文件名#页码#内容哈希，同一文件同页同内容的重复 chunk 追加序号
+    同一份报告重新切块后未变化的 chunk ID 不变，增量更新时据此复用已有向量
+    """
+    seen: Dict[str, int] = {}
+    for c in chunks:
+        if 'chunk_id' in c:
+            continue
+        md = c.get('metadata', {})
+        digest = hashlib.sha1(c.get('content', '').encode('utf-8')).hexdigest()[:16]
+        base = f"{md.get('file_name', '')}#p{md.get('page', '')}#{digest}"
+        n = seen.get(base, 0)
+        seen[base] = n + 1
+        c['chunk_id'] = base if n == 0 else f"{base}-{n}"
+    return chunks
+
+
 class SimpleVectorStore: 
-    def __init__(self):
-        self.embeddings = []
+    def __init__(self, dtype: str = None, index_type: str = 'flat', nlist: int = None, nprobe: int = 8,
+                 storage: str = 'float32', pq_m: int = 64, rerank_k: int = None, search_workers: int = 1):
+        """
+        :param dtype: 向量存储精度 float32/float16，默认沿用首次写入的 embedding 精度
+        :param index_type: flat 精确暴力检索；ivf 倒排近似检索（k-means 粗量化）
+        :param nlist: ivf 桶数，默认 4*sqrt(N)
+        :param nprobe: ivf 查询时扫描的桶数，越大召回越高、延迟越大
+        :param storage: 打分用的向量存储 float32（原始矩阵）/ int8（逐维标量量化）/ pq（乘积量化）
+        :param pq_m: pq 分段数，每个向量占 pq_m 字节
+        :param rerank_k: 量化打分后取前 rerank_k 个候选用原始向量精确重打分，None/0 表示不重打分
+        :param search_workers: 大于 1 时 flat + float32 存储的全局检索由多个进程分片并行计算，
+                               结果与单进程一致；库规模小于 SHARD_MIN_ROWS 或有未 compact 的删除时仍在本进程计算
+        """
+        if index_type not in VECTOR_INDEX_TYPES:
+            raise ValueError(f"不支持的 index_type: {index_type}，可选 {VECTOR_INDEX_TYPES}")
+        if storage not in VECTOR_STORAGE_TYPES:
+            raise ValueError(f"不支持的 storage: {storage}，可选 {VECTOR_STORAGE_TYPES}")
+        self.dtype = np.dtype(dtype) if dtype else None
+        self.index_type = index_type
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.storage = storage
+        self.pq_m = pq_m
+        self.rerank_k = rerank_k
         self.chunks = []
-    def add_chunks(self, chunks: List[Dict[str, Any]], embeddings: List[List[float]]):
+        self._blocks: List[np.ndarray] = []  # add_chunks 写入的已归一化块，检索前合并
+        self._matrix: Optional[np.ndarray] = None  # (N, dim) 已 L2 归一化的连续矩阵
+        self._ann: Optional[IVFIndex] = None  # index_type=ivf 时的倒排索引，矩阵变化后重建
+        self._quantizer = None  # storage 为 int8/pq 时的量化编码，矩阵变化后重建
+        self._partitions: Optional[Dict[str, np.ndarray]] = None  # file_name -> 行号，chunks 变化后重建
+        self._file_attrs: Dict[str, Dict[str, str]] = {}  # file_name -> {company, year, ticker}
+        self._bm25: Optional[BM25Index] = None  # chunk 内容的 BM25 倒排索引
+        self._deleted: Optional[np.ndarray] = None  # (N,) 已删除行标记，compact 后清空；None 表示没有删除
+        self.version = 0  # 每次增删递增，供依赖库内容的缓存（如路由）判断是否需要重建
+        self.search_workers = search_workers
+        self._sharded: Optional[ShardedSearcher] = None  # 多进程分片检索，库内容变化后重建
+        self._sharded_version = None
+        # 最近一次保存/加载的目录状态 {"dir", "base", "rows", "deleted"}，用于增量保存；compact 后失效
+        self._persisted: Optional[Dict[str, Any]] = None
+    def add_chunks(self, chunks: List[Dict[str, Any]], embeddings: np.ndarray):
+        """
+        追加 chunk 与向量；已构建的 ivf、量化编码、BM25、分区按新增部分增量更新，不重新训练
+        """
+        embeddings = np.asarray(embeddings)
+        if len(chunks) != len(embeddings):
+            raise ValueError(f"chunks 数量 {len(chunks)} 与 embeddings 数量 {len(embeddings)} 不一致")
+        if len(chunks) == 0:
+            return
+        if self.dtype is None:
+            self.dtype = embeddings.dtype if embeddings.dtype in (np.float16, np.float32) else np.dtype(np.float32)
+        assign_chunk_ids(chunks)
+        start = len(self.chunks)
+        # 入库时一次性归一化，检索时不再重复计算行范数
+        block = embeddings.astype(np.float32)
+        block /= np.linalg.norm(block, axis=1, keepdims=True) + 1e-8
+        self._blocks.append(np.ascontiguousarray(block, dtype=self.dtype))
         self.chunks.extend(chunks)
-        self.embeddings.extend(embeddings)
-    def search(self, query_embedding: List[float], top_k: int = 3) -> List[Dict[str, Any]]:
-        from numpy import dot
-        from numpy.linalg import norm
-        import numpy as np
-        if not self.embeddings:
-            return []
-        emb_matrix = np.array(self.embeddings)
-        query_emb = np.array(query_embedding)
-        sims = emb_matrix @ query_emb / (norm(emb_matrix, axis=1) * norm(query_emb) + 1e-8)
-        idxs = sims.argsort()[::-1][:top_k]
-        return [self.chunks[i] for i in idxs]
+        if self._ann is not None:
+            self._ann.add(block, start)
+        if self._quantizer is not None:
+            self._quantizer.add(block)
+        if self._bm25 is not None:
+            self._bm25.add([c.get('content', '') for c in chunks])
+        if self._deleted is not None:
+            self._deleted = np.concatenate([self._deleted, np.zeros(len(chunks), dtype=bool)])
+        if self._partitions is not None:
+            for fn, rows in self._group_rows(chunks, start).items():
+                old = self._partitions.get(fn)
+                self._partitions[fn] = rows if old is None else np.concatenate([old, rows])
+                self._file_attrs.setdefault(fn, report_attributes(fn))
+        self.version += 1
+    @staticmethod
+    def _group_rows(chunks: List[Dict[str, Any]], start: int = 0, skip: np.ndarray = None) -> Dict[str, np.ndarray]:
+        rows_by_file: Dict[str, List[int]] = {}
+        for i, c in enumerate(chunks):
+            if skip is not None and skip[i]:
+                continue
+            rows_by_file.setdefault(c.get('metadata', {}).get('file_name', ''), []).append(start + i)
+        return {fn: np.asarray(rows, dtype=np.int64) for fn, rows in rows_by_file.items()}
+    @property
+    def n_deleted(self) -> int:
+        return int(self._deleted.sum()) if self._deleted is not None else 0
+    def delete_rows(self, rows: np.ndarray) -> int:
+        """
+        标记删除指定行：检索时跳过，空间在 compact 时回收；代价与删除行数（及所在分区大小）有关
+        :return: 新删除的行数
+        """
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        if self._deleted is None:
+            self._deleted = np.zeros(len(self.chunks), dtype=bool)
+        rows = rows[~self._deleted[rows]]
+        if len(rows) == 0:
+            return 0
+        self._deleted[rows] = True
+        if self._bm25 is not None:
+            self._bm25.delete(rows)
+        if self._partitions is not None:
+            for fn in {self.chunks[i].get('metadata', {}).get('file_name', '') for i in rows}:
+                remaining = np.setdiff1d(self._partitions[fn], rows, assume_unique=True)
+                if len(remaining):
+                    self._partitions[fn] = remaining
+                else:
+                    del self._partitions[fn]
+                    del self._file_attrs[fn]
+        self.version += 1
+        return len(rows)
+    def delete_file(self, file_name: str) -> int:
+        """
+        删除某份报告的全部 chunk，返回删除行数
+        """
+        rows = self.partitions.get(file_name)
+        return self.delete_rows(rows) if rows is not None else 0
+    def upsert_file(self, file_name: str, chunks: List[Dict[str, Any]],
+                    embed_fn: Callable[[List[str]], np.ndarray]) -> Dict[str, int]:
+        """
+        用新的 chunk 列表替换某份报告：按 chunk_id 比对，未变化的保留原有行和向量，
+        已不存在的标记删除，只对新增 chunk 调用 embed_fn
+        :param chunks: 该报告的全部 chunk（metadata.file_name 须为 file_name）
+        :param embed_fn: 文本列表 -> (n, dim) 向量，如 EmbeddingModel.embed_texts
+        :return: {"added", "kept", "deleted"}
+        """
+        for c in chunks:
+            if c.get('metadata', {}).get('file_name', '') != file_name:
+                raise ValueError(f"chunk 的 file_name 与 {file_name} 不一致: {c.get('metadata')}")
+        assign_chunk_ids(chunks)
+        old_rows = self.partitions.get(file_name, np.empty(0, dtype=np.int64))
+        old_ids = {self.chunks[r]['chunk_id']: r for r in old_rows}
+        new_ids = {c['chunk_id'] for c in chunks}
+        stale = [r for cid, r in old_ids.items() if cid not in new_ids]
+        fresh = [c for c in chunks if c['chunk_id'] not in old_ids]
+        deleted = self.delete_rows(stale)
+        if fresh:
+            self.add_chunks(fresh, embed_fn([c['content'] for c in fresh]))
+        return {"added": len(fresh), "kept": len(chunks) - len(fresh), "deleted": deleted}
+    def compact(self) -> int:
+        """
+        回收已删除行：矩阵、chunks、ivf 倒排表、量化编码、BM25 倒排表按存活行重排（不重新嵌入、不重新训练）
+        :return: 回收的行数
+        """
+        if self._deleted is None:
+            return 0
+        keep = ~self._deleted
+        removed = int(self._deleted.sum())
+        self._matrix = np.ascontiguousarray(self.embeddings[keep])
+        self.chunks = [c for c, k in zip(self.chunks, keep) if k]
+        if self._ann is not None:
+            self._ann.compact(keep)
+        if self._quantizer is not None:
+            self._quantizer.compact(keep)
+        if self._bm25 is not None:
+            self._bm25.compact(keep)
+        self._deleted = None
+        self._partitions = None
+        self._persisted = None  # 行号已重排，下次保存需全量重写
+        self.version += 1
+        return removed
+    @property
+    def embeddings(self) -> Optional[np.ndarray]:
+        """已归一化的向量矩阵，仅在 add_chunks 之后的首次访问时重建"""
+        if self._blocks:
+            parts = ([self._matrix] if self._matrix is not None else []) + self._blocks
+            self._matrix = parts[0] if len(parts) == 1 else np.concatenate(parts)
+            self._blocks = []
+        return self._matrix
+    @property
+    def ann_index(self) -> Optional[IVFIndex]:
+        """index_type=ivf 时的倒排索引，首次检索时构建"""
+        if self.index_type == 'ivf' and self._ann is None and self.embeddings is not None:
+            self._ann = IVFIndex(nlist=self.nlist, nprobe=self.nprobe)
+            self._ann.build(self.embeddings)
+        return self._ann
+    @property
+    def partitions(self) -> Dict[str, np.ndarray]:
+        """按 metadata.file_name 分区的行号，公司/年份属性由文件名派生"""
+        if self._partitions is None:
+            self._partitions = self._group_rows(self.chunks, skip=self._deleted)
+            self._file_attrs = {fn: report_attributes(fn) for fn in self._partitions}
+        return self._partitions
+    @property
+    def file_attributes(self) -> Dict[str, Dict[str, str]]:
+        self.partitions
+        return self._file_attrs
+    @property
+    def bm25_index(self) -> BM25Index:
+        """chunk 内容的 BM25 倒排索引，首次关键词检索时一次遍历构建"""
+        if self._bm25 is None:
+            self._bm25 = BM25Index()
+            self._bm25.build([c.get('content', '') for c in self.chunks])
+            if self._deleted is not None:
+                self._bm25.delete(np.flatnonzero(self._deleted))
+        return self._bm25
+    def match_files(self, where: Dict[str, Any]) -> List[str]:
+        """
+        返回满足过滤条件的 file_name 列表
+        :param where: 键为 file_name/company/year/ticker，值为单个值或值列表，多个键之间为“且”
+        """
+        conds = {}
+        for key, value in where.items():
+            if key not in PARTITION_KEYS:
+                raise ValueError(f"不支持的过滤字段: {key}，可选 {PARTITION_KEYS}")
+            values = value if isinstance(value, (list, tuple, set, frozenset)) else [value]
+            conds[key] = {str(v) for v in values}
+        return [
+            fn for fn, attrs in self.file_attributes.items()
+            if all(attrs.get(key, '') in values for key, values in conds.items())
+        ]
+    def partition_rows(self, where: Dict[str, Any]) -> np.ndarray:
+        files = self.match_files(where)
+        if not files:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self.partitions[fn] for fn in files])
+    @property
+    def quantizer(self):
+        """storage 为 int8/pq 时的量化器（含全部编码），首次检索时训练并编码"""
+        if self.storage != 'float32' and self._quantizer is None and self.embeddings is not None:
+            self._quantizer = create_quantizer(self.storage, pq_m=self.pq_m)
+            self._quantizer.build(self.embeddings)
+        return self._quantizer
+    @property
+    def sharded(self) -> Optional[ShardedSearcher]:
+        """满足条件时的多进程分片检索器，首次检索时启动 worker 进程"""
+        if self.search_workers <= 1 or self.index_type != 'flat' or self.storage != 'float32' \
+                or self._deleted is not None or self.embeddings is None or len(self.embeddings) < SHARD_MIN_ROWS:
+            return None
+        if self._sharded is None or self._sharded_version != self.version:
+            self.close()
+            self._sharded = ShardedSearcher(self.embeddings, self.search_workers)
+            self._sharded_version = self.version
+        return self._sharded
+    def close(self):
+        """结束分片检索的 worker 进程（及共享内存）"""
+        if self._sharded is not None:
+            self._sharded.close()
+            self._sharded = None
+    def _scores(self, query_emb: np.ndarray) -> np.ndarray:
+        if self.quantizer is not None:
+            return self.quantizer.scores(query_emb)
+        matrix = self.embeddings
+        if matrix.dtype == np.float32:
+            return matrix @ query_emb
+        sims = np.empty(len(matrix), dtype=np.float32)
+        # float16 存储时分块转 float32 计算，不产生整库大小的临时矩阵
+        for i in range(0, len(matrix), SEARCH_BLOCK_ROWS):
+            block = np.asarray(matrix[i:i + SEARCH_BLOCK_ROWS], dtype=np.float32)
+            sims[i:i + len(block)] = block @ query_emb
+        return sims
+    def _scores_rows(self, query_emb: np.ndarray, rows: np.ndarray, exact: bool = False) -> np.ndarray:
+        # 只对候选行计算相似度；exact=True 时忽略量化，用原始向量
+        if self.quantizer is not None and not exact:
+            return self.quantizer.scores(query_emb, rows)
+        return np.asarray(self.embeddings[rows], dtype=np.float32) @ query_emb
+    def _search_ids(self, query_emb: np.ndarray, top_k: int, nprobe: int = None,
+                    rows: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        单查询检索核心，query_emb 须已归一化，返回 (行号, 分数)
+        :param rows: 可选，只在这些行（过滤后的分区）中检索，代价为 O(len(rows))
+        """
+        ann = self.ann_index
+        rerank = self.quantizer is not None and bool(self.rerank_k)
+        k = max(top_k, self.rerank_k) if rerank else top_k
+        if rows is not None:
+            # 分区已足够小，直接扫描分区内全部行，不走 ivf
+            sims = self._scores_rows(query_emb, rows)
+            top = topk_indices(sims, k)
+            idxs, scores = rows[top], sims[top]
+        elif ann is None and self.sharded is not None:
+            idxs, scores = self.sharded.search(query_emb[None, :], k, single=True)
+            idxs, scores = idxs[0], scores[0]
+        elif ann is None:
+            sims = self._scores(query_emb)
+            if self._deleted is not None:
+                sims[self._deleted] = -np.inf
+            idxs = topk_indices(sims, k)
+            scores = sims[idxs]
+            if self._deleted is not None:
+                alive = np.isfinite(scores)
+                idxs, scores = idxs[alive], scores[alive]
+        else:
+            rows = ann.probe(query_emb, nprobe)
+            if self._deleted is not None:
+                rows = rows[~self._deleted[rows]]
+            sims = self._scores_rows(query_emb, rows)
+            top = topk_indices(sims, k)
+            idxs, scores = rows[top], sims[top]
+        if rerank:
+            # 量化分数只用于粗排，前 rerank_k 个候选用原始向量精确重打分
+            exact = self._scores_rows(query_emb, idxs, exact=True)
+            top = topk_indices(exact, top_k)
+            idxs, scores = idxs[top], exact[top]
+        return idxs, scores
+    def save(self, index_dir: str, model_name: str = None, corpus_hash: str = None, full: bool = False):
+        """
+        持久化到目录：embeddings.npy + chunks.jsonl + bm25.npz + manifest.json（ivf 时另存 ivf.npz）
+        上次保存/加载自同一目录且期间未 compact 时增量保存：只追加新增行的向量与 chunk、新删除的行号，
+        加载时在基础索引上重放；增量部分超过 INDEX_COMPACT_RATIO 或 full=True 时 compact 后全量重写
+        :param model_name: 写入 manifest 的 embedding 模型名
+        :param corpus_hash: 写入 manifest 的语料哈希（SimpleRAG 使用 chunk JSON 文件的 sha256）
+        :param full: 强制全量重写（合并增量部分）
+        """
+        p = self._persisted
+        pending = len(self.chunks) - p["base"] + self.n_deleted if p is not None else None
+        if not full and p is not None and p["dir"] == os.path.abspath(index_dir) \
+                and pending <= INDEX_COMPACT_RATIO * len(self.chunks) \
+                and os.path.exists(os.path.join(index_dir, INDEX_MANIFEST_FILE)):
+            self._save_delta(index_dir, model_name, corpus_hash)
+        else:
+            self._save_full(index_dir, model_name, corpus_hash)
+    def _save_full(self, index_dir: str, model_name: str = None, corpus_hash: str = None):
+        # 有已删除行时先 compact；矩阵先写临时文件再替换，正在内存映射旧文件的进程不受影响
+        self.compact()
+        matrix = self.embeddings
+        if matrix is None:
+            raise ValueError("向量库为空，无法保存")
+        os.makedirs(index_dir, exist_ok=True)
+        manifest_path = os.path.join(index_dir, INDEX_MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)  # 先删除 manifest，写入中途失败时旧索引不会被误用
+        matrix_path = os.path.join(index_dir, INDEX_MATRIX_FILE)
+        with open(matrix_path + '.tmp', 'wb') as f:
+            np.save(f, np.ascontiguousarray(matrix))
+        os.replace(matrix_path + '.tmp', matrix_path)
+        with open(os.path.join(index_dir, INDEX_CHUNKS_FILE), 'w', encoding='utf-8') as f:
+            for c in self.chunks:
+                f.write(json.dumps(c, ensure_ascii=False, separators=(',', ':')) + '\n')
+            chunks_bytes = f.tell()
+        for name in (INDEX_DELTA_MATRIX_FILE, INDEX_DELETED_FILE):
+            if os.path.exists(os.path.join(index_dir, name)):
+                os.remove(os.path.join(index_dir, name))
+        if self.quantizer is not None:
+            self.quantizer.save(index_dir)
+        self.bm25_index.save(index_dir)
+        manifest = {
+            "version": INDEX_FORMAT_VERSION,
+            "model": model_name,
+            "dim": int(matrix.shape[1]),
+            "dtype": str(matrix.dtype),
+            "count": int(matrix.shape[0]),
+            "delta_count": 0,
+            "deleted_count": 0,
+            "chunks_bytes": chunks_bytes,
+            "corpus_hash": corpus_hash,
+            "index_type": self.index_type,
+            "storage": self.storage,
+            "pq_m": self.pq_m,
+            "rerank_k": self.rerank_k,
+            "bm25": True,
+        }
+        if self.ann_index is not None:
+            self.ann_index.save(index_dir)
+            manifest["nlist"] = self.ann_index.nlist
+            manifest["nprobe"] = self.ann_index.nprobe
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        self._persisted = {"dir": os.path.abspath(index_dir), "base": len(self.chunks), "rows": len(self.chunks),
+                           "deleted": np.empty(0, dtype=np.int64)}
+    @staticmethod
+    def _append_bytes(path: str, committed: int, data: bytes) -> int:
+        # 先截断到 manifest 记录的长度（丢弃中断时写了一半的内容）再追加，返回新长度
+        with open(path, 'ab') as f:
+            f.truncate(committed)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            return f.tell()
+    def _save_delta(self, index_dir: str, model_name: str = None, corpus_hash: str = None):
+        # 只追加上次保存后的新增行与新删除行号，最后原子替换 manifest；代价与变化量有关，与库规模无关
+        p = self._persisted
+        manifest = self.read_manifest(index_dir)
+        rows = len(self.chunks)
+        deleted = np.flatnonzero(self._deleted) if self._deleted is not None else np.empty(0, dtype=np.int64)
+        new_deleted = np.setdiff1d(deleted, p["deleted"], assume_unique=True).astype(np.int64)
+        if rows > p["rows"]:
+            block = np.ascontiguousarray(self.embeddings[p["rows"]:rows], dtype=np.dtype(manifest["dtype"]))
+            lines = ''.join(json.dumps(c, ensure_ascii=False, separators=(',', ':')) + '\n'
+                            for c in self.chunks[p["rows"]:rows])
+            manifest["chunks_bytes"] = self._append_bytes(
+                os.path.join(index_dir, INDEX_CHUNKS_FILE), manifest["chunks_bytes"], lines.encode('utf-8'))
+            self._append_bytes(os.path.join(index_dir, INDEX_DELTA_MATRIX_FILE),
+                               manifest["delta_count"] * block.shape[1] * block.itemsize, block.tobytes())
+            manifest["delta_count"] += rows - p["rows"]
+        if len(new_deleted):
+            self._append_bytes(os.path.join(index_dir, INDEX_DELETED_FILE),
+                               manifest["deleted_count"] * 8, new_deleted.tobytes())
+            manifest["deleted_count"] += len(new_deleted)
+        manifest["model"] = model_name
+        manifest["corpus_hash"] = corpus_hash
+        manifest_path = os.path.join(index_dir, INDEX_MANIFEST_FILE)
+        with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        p["rows"] = rows
+        p["deleted"] = deleted
+    @staticmethod
+    def read_manifest(index_dir: str) -> Optional[Dict[str, Any]]:
+        manifest_path = os.path.join(index_dir, INDEX_MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    @classmethod
+    def load(cls, index_dir: str, mmap: bool = True, nprobe: int = None, rerank_k: int = None,
+             search_workers: int = 1) -> 'SimpleVectorStore':
+        """
+        从目录加载；mmap=True 时向量矩阵以只读方式内存映射，多个进程共享同一份页缓存
+        量化存储时常驻内存的只有编码，原始矩阵仅在重打分时按需读入对应页
+        :param nprobe: 可选，覆盖保存时的 ivf nprobe
+        :param rerank_k: 可选，覆盖保存时的重打分候选数
+        :param search_workers: 分片检索的 worker 进程数，内存映射时各进程直接共享索引文件
+        """
+        manifest = cls.read_manifest(index_dir)
+        if manifest is None:
+            raise FileNotFoundError(f"{index_dir} 下没有 {INDEX_MANIFEST_FILE}")
+        if manifest.get("version") != INDEX_FORMAT_VERSION:
+            raise ValueError(f"索引格式版本 {manifest.get('version')} 与当前版本 {INDEX_FORMAT_VERSION} 不一致")
+        matrix = np.load(os.path.join(index_dir, INDEX_MATRIX_FILE), mmap_mode='r' if mmap else None)
+        base, delta_count = manifest["count"], manifest["delta_count"]
+        with open(os.path.join(index_dir, INDEX_CHUNKS_FILE), 'r', encoding='utf-8') as f:
+            # 只读 manifest 记录的行数，之后的内容是中断的增量保存留下的
+            chunks = [json.loads(line) for line in itertools.islice(f, base + delta_count)]
+        if len(chunks) != base + delta_count or len(matrix) != base:
+            raise ValueError(f"索引文件不完整: chunks={len(chunks)} vectors={len(matrix)} "
+                             f"manifest={base}+{delta_count}")
+        index_type = manifest.get("index_type", 'flat')
+        store = cls(dtype=str(matrix.dtype), index_type=index_type,
+                    nlist=manifest.get("nlist"), nprobe=nprobe or manifest.get("nprobe", 8),
+                    storage=manifest.get("storage", 'float32'), pq_m=manifest.get("pq_m", 64),
+                    rerank_k=rerank_k if rerank_k is not None else manifest.get("rerank_k"),
+                    search_workers=search_workers)
+        store.chunks = assign_chunk_ids(chunks[:base])
+        store._matrix = matrix
+        if index_type == 'ivf':
+            store._ann = IVFIndex.load(index_dir, nprobe=store.nprobe)
+        if store.storage != 'float32':
+            store._quantizer = load_quantizer(index_dir)
+        if manifest.get("bm25") and os.path.exists(os.path.join(index_dir, BM25_INDEX_FILE)):
+            store._bm25 = BM25Index.load(index_dir)
+        # 在基础索引上重放增量保存的新增行与删除行（矩阵随之读入内存，直到下次全量保存）
+        if delta_count:
+            delta = np.fromfile(os.path.join(index_dir, INDEX_DELTA_MATRIX_FILE), dtype=matrix.dtype,
+                                count=delta_count * matrix.shape[1]).reshape(delta_count, matrix.shape[1])
+            store.add_chunks(chunks[base:], delta)
+        deleted = np.empty(0, dtype=np.int64)
+        if manifest["deleted_count"]:
+            deleted = np.unique(np.fromfile(os.path.join(index_dir, INDEX_DELETED_FILE), dtype=np.int64,
+                                            count=manifest["deleted_count"]))
+            store.delete_rows(deleted)
+        store._persisted = {"dir": os.path.abspath(index_dir), "base": base, "rows": len(store.chunks),
+                            "deleted": deleted}
+        return store
+    def _scores_batch(self, query_matrix: np.ndarray) -> np.ndarray:
+        matrix = self.embeddings
+        if matrix.dtype == np.float32:
+            return query_matrix @ matrix.T
+        sims = np.empty((len(query_matrix), len(matrix)), dtype=np.float32)
+        for i in range(0, len(matrix), SEARCH_BLOCK_ROWS):
+            block = np.asarray(matrix[i:i + SEARCH_BLOCK_ROWS], dtype=np.float32)
+            sims[:, i:i + len(block)] = query_matrix @ block.T
+        return sims
+    def search_batch_rows(self, query_matrix: np.ndarray, top_k: int = 3, block_queries: int = None,
+                          where: Dict[str, Any] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        多查询批量检索：按查询分块做矩阵乘法并逐行取 top_k，相似度块大小受 SEARCH_BATCH_MAX_SCORES 限制
+        :param query_matrix: (Q, dim) 查询向量矩阵
+        :param block_queries: 可选，每块查询数，默认按库规模自动计算
+        :param where: 可选，所有查询共用的分区过滤条件，见 match_files
+        :return: 每个查询一个 (行号, 分数)
+        """
+        query_matrix = np.atleast_2d(np.asarray(query_matrix, dtype=np.float32))
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+        if self.embeddings is None or len(self.embeddings) == 0:
+            return [empty for _ in range(len(query_matrix))]
+        query_matrix = query_matrix / (np.linalg.norm(query_matrix, axis=1, keepdims=True) + 1e-8)
+        rows = self.partition_rows(where) if where else None
+        if rows is not None and len(rows) == 0:
+            return [empty for _ in range(len(query_matrix))]
+        if rows is not None or self.ann_index is not None or self.quantizer is not None:
+            # 分区过滤、ivf 候选桶、量化查表都按查询进行，逐条检索
+            return [self._search_ids(q, top_k, rows=rows) for q in query_matrix]
+        if self.sharded is not None:
+            idxs, scores = self.sharded.search(query_matrix, top_k)
+            return list(zip(idxs, scores))
+        n = len(self.embeddings)
+        block_queries = block_queries or max(1, SEARCH_BATCH_MAX_SCORES // n)
+        results = []
+        for i in range(0, len(query_matrix), block_queries):
+            sims = self._scores_batch(query_matrix[i:i + block_queries])
+            if self._deleted is not None:
+                sims[:, self._deleted] = -np.inf
+            idxs = topk_indices_2d(sims, top_k)
+            for row, row_idxs in enumerate(idxs):
+                scores = sims[row, row_idxs]
+                alive = np.isfinite(scores)
+                results.append((row_idxs[alive], scores[alive]))
+        return results
+    def search_batch_with_scores(self, query_matrix: np.ndarray, top_k: int = 3, block_queries: int = None,
+                                 where: Dict[str, Any] = None) -> List[List[Tuple[Dict[str, Any], float]]]:
+        """
+        :return: 每个查询一个 [(chunk, score), ...] 列表，参数同 search_batch_rows
+        """
+        return [
+            [(self.chunks[i], float(sc)) for i, sc in zip(idxs, scores)]
+            for idxs, scores in self.search_batch_rows(query_matrix, top_k, block_queries, where)
+        ]
+    def search_batch(self, query_matrix: np.ndarray, top_k: int = 3, block_queries: int = None,
+                     where: Dict[str, Any] = None) -> List[List[Dict[str, Any]]]:
+        return [[c for c, _ in hits] for hits in self.search_batch_with_scores(query_matrix, top_k, block_queries, where)]
+    def search_rows(self, query_embedding: np.ndarray, top_k: int = 3, nprobe: int = None,
+                    where: Dict[str, Any] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        余弦相似度检索，返回 (行号, 分数)，按分数降序
+        :param nprobe: 可选，ivf 本次查询扫描的桶数
+        :param where: 可选，分区过滤条件，如 {"company": "中国人保", "year": "2023"}；
+                      只对匹配分区打分，不会返回其他报告的 chunk
+        """
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+        if self.embeddings is None or len(self.embeddings) == 0:
+            return empty
+        rows = None
+        if where:
+            rows = self.partition_rows(where)
+            if len(rows) == 0:
+                return empty
+        query_emb = np.asarray(query_embedding, dtype=np.float32)
+        query_emb = query_emb / (np.linalg.norm(query_emb) + 1e-8)
+        return self._search_ids(query_emb, top_k, nprobe, rows=rows)
+    def search_with_scores(self, query_embedding: np.ndarray, top_k: int = 3, nprobe: int = None,
+                           where: Dict[str, Any] = None) -> List[Tuple[Dict[str, Any], float]]:
+        idxs, scores = self.search_rows(query_embedding, top_k, nprobe, where)
+        return [(self.chunks[i], float(sc)) for i, sc in zip(idxs, scores)]
+    def search(self, query_embedding: np.ndarray, top_k: int = 3,
+               where: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        return [c for c, _ in self.search_with_scores(query_embedding, top_k, where=where)]
+    def search_bm25_rows(self, query: str, top_k: int = 3,
+                         where: Dict[str, Any] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        BM25 关键词检索，返回 (行号, 分数)，只包含至少命中一个词的 chunk；不需要查询向量
+        :param where: 可选，分区过滤条件，同 search_rows
+        """
+        if not self.chunks:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        rows = None
+        if where:
+            rows = self.partition_rows(where)
+            if len(rows) == 0:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return self.bm25_index.search(query, top_k, rows=rows)
+    def search_bm25(self, query: str, top_k: int = 3,
+                    where: Dict[str, Any] = None) -> List[Tuple[Dict[str, Any], float]]:
+        idxs, scores = self.search_bm25_rows(query, top_k, where)
+        return [(self.chunks[i], float(sc)) for i, sc in zip(idxs, scores)]
 
 class SimpleRAG:
-    def __init__(self, chunk_json_path: str, model_path: str = None, batch_size: int = 8):
+    def __init__(self, chunk_json_path: str, model_path: str = None, batch_size: int = 8, index_dir: str = None,
+                 index_type: str = None, nprobe: int = None, storage: str = None, use_router: bool = None,
+                 retrieval_mode: str = None, recall_top_m_vec: int = 50, recall_top_m_bm25: int = 50, rrf_k: int = 60,
+                 use_rerank: bool = None, reranker: str = None, rerank_top_m: int = None, rerank_budget_ms: float = None,
+                 search_workers: int = None, llm_cache: str = None, pack_context: bool = None,
+                 context_token_budget: int = None, stream: bool = None, semantic_cache: bool = None):
+        """
+        :param index_dir: 可选，持久化索引目录；语料和模型未变时直接内存映射加载，不再重新嵌入
+        :param index_type: 向量索引类型 flat/ivf，默认读取 VECTOR_INDEX_TYPE 或 flat
+        :param nprobe: ivf 扫描桶数，默认读取 IVF_NPROBE 或 8
+        :param storage: 向量存储 float32/int8/pq，默认读取 VECTOR_STORAGE 或 float32；
+                        量化时前 QUANT_RERANK_K（默认 50）个候选用原始向量重打分
+        :param use_router: 是否按问题中的公司/年份限定检索范围，默认读取 RAG_USE_ROUTER，默认关闭（设为 1 开启）以保持原始的全库检索
+        :param retrieval_mode: dense 向量检索 / bm25 关键词检索 / hybrid 两路召回后 RRF 融合，
+                               默认读取 RAG_RETRIEVAL_MODE 或 dense（与原始流程一致，hybrid 需显式开启）；bm25 模式查询时不调用 embedding
+        :param recall_top_m_vec: hybrid 时向量召回的候选数
+        :param recall_top_m_bm25: hybrid 时 BM25 召回的候选数
+        :param rrf_k: RRF 融合常数，越大各路排名靠后的候选权重越接近
+        :param use_rerank: 是否在召回后重排，默认读取 RAG_USE_RERANK（1 开启）
+        :param reranker: 重排器 cross_encoder/lexical/stub，默认读取 RERANKER 或 cross_encoder
+        :param rerank_top_m: 参与重排的召回候选数，默认读取 RERANK_TOP_M 或 50
+        :param rerank_budget_ms: 每个查询的重排时间预算，超出时回退到召回顺序，默认读取 RERANK_BUDGET_MS 或 1000，0 表示不限
+        :param search_workers: 向量检索的分片进程数，默认读取 VECTOR_SEARCH_WORKERS 或 1（不分片）
+        :param llm_cache: 大模型回答缓存 on/replay/off，默认读取 LLM_CACHE_MODE 或 on；replay 只读回放，未命中不调用接口
+        :param pack_context: 是否在拼接提示词前合并同页切块、去掉切块重叠，默认读取 RAG_PACK_CONTEXT，默认关闭（设为 1 开启）以保持原始提示词
+        :param context_token_budget: 上下文估算 token 上限，默认读取 RAG_CONTEXT_TOKENS 或 0（不限）
+        :param stream: 是否流式生成，第一个完整 JSON 对象到达即停止，默认读取 LLM_STREAM（1 开启）
+        :param semantic_cache: 是否在生成前查语义答案缓存（相似问题且公司/年份一致时复用回答），
+                               默认读取 RAG_SEMANTIC_CACHE（1 开启）；阈值与 TTL 见 semantic_cache.py
+        """
         self.loader = PageChunkLoader(chunk_json_path)
-        self.embedding_model = EmbeddingModel(batch_size=batch_size)
-        self.vector_store = SimpleVectorStore()
+        # 后端、维度、精度由 EMBEDDING_BACKEND / EMBEDDING_DIM / EMBEDDING_DTYPE 配置
+        self.embedding_model = EmbeddingModel(batch_size=batch_size, model_name=model_path)
+        self.index_type = index_type or os.getenv('VECTOR_INDEX_TYPE', 'flat')
+        self.nprobe = nprobe or int(os.getenv('IVF_NPROBE', '8'))
+        self.storage = storage or os.getenv('VECTOR_STORAGE', 'float32')
+        self.rerank_k = int(os.getenv('QUANT_RERANK_K', '50'))
+        self.search_workers = search_workers or int(os.getenv('VECTOR_SEARCH_WORKERS', '1'))
+        self.vector_store = SimpleVectorStore(index_type=self.index_type, nprobe=self.nprobe,
+                                              storage=self.storage, rerank_k=self.rerank_k,
+                                              search_workers=self.search_workers)
+        self.index_dir = index_dir
+        self.use_router = use_router if use_router is not None else os.getenv('RAG_USE_ROUTER', '0') == '1'
+        self._router: Optional[QueryRouter] = None
+        self._router_source = None
+        self.retrieval_mode = retrieval_mode or os.getenv('RAG_RETRIEVAL_MODE', 'dense')
+        if self.retrieval_mode not in RETRIEVAL_MODES:
+            raise ValueError(f"不支持的 retrieval_mode: {self.retrieval_mode}，可选 {RETRIEVAL_MODES}")
+        self.recall_top_m_vec = recall_top_m_vec
+        self.recall_top_m_bm25 = recall_top_m_bm25
+        self.rrf_k = rrf_k
+        self.query_cache = QueryEmbeddingLRU()
+        self._async_client: Optional[AsyncOpenAI] = None
+        self.llm_cache_mode = llm_cache
+        self.pack_context = pack_context if pack_context is not None else os.getenv('RAG_PACK_CONTEXT', '0') == '1'
+        self.context_token_budget = context_token_budget if context_token_budget is not None \
+            else int(os.getenv('RAG_CONTEXT_TOKENS', '0'))
+        self.context_stats = ContextStats()
+        self.stream = stream if stream is not None else os.getenv('LLM_STREAM', '0') == '1'
+        self.stream_stats = StreamStats()
+        if semantic_cache is None:
+            semantic_cache = os.getenv('RAG_SEMANTIC_CACHE', '0') == '1'
+        self.semantic_cache: Optional[SemanticAnswerCache] = SemanticAnswerCache() if semantic_cache else None
+        self.coalescer = InflightCoalescer()  # 同一问题同时只生成一次
+        self._completion_cache: Optional[CompletionCache] = None
+        use_rerank = use_rerank if use_rerank is not None else os.getenv('RAG_USE_RERANK', '0') == '1'
+        self.rerank_stage: Optional[RerankStage] = None
+        if use_rerank:
+            budget_ms = rerank_budget_ms if rerank_budget_ms is not None else float(os.getenv('RERANK_BUDGET_MS', '1000'))
+            self.rerank_stage = RerankStage(
+                create_reranker(reranker),
+                top_m=rerank_top_m or int(os.getenv('RERANK_TOP_M', '50')),
+                time_budget=budget_ms / 1000 if budget_ms else None,
+            )
+    @property
+    def router(self) -> Optional[QueryRouter]:
+        """由向量库中各报告的 file_name 构建的公司/年份路由，向量库增删后随之重建"""
+        if not self.use_router:
+            return None
+        return self._query_router()
+    def _query_router(self) -> QueryRouter:
+        source = (id(self.vector_store), self.vector_store.version)
+        if self._router is None or self._router_source != source:
+            self._router = QueryRouter.from_store(self.vector_store)
+            self._router_source = source
+        return self._router
+    def route(self, question: str) -> Optional[Dict[str, Any]]:
+        # 问题中识别到公司（及年份）时返回 where 过滤条件，否则 None 表示全局检索
+        router = self.router
+        return router.route(question) if router is not None else None
+    def _dense_depth(self, top_k: int) -> int:
+        # 向量召回深度：hybrid 时多召回候选供融合，dense 时只取 top_k
+        return max(top_k, self.recall_top_m_vec) if self.retrieval_mode == 'hybrid' else top_k
+    def _retrieve_rows(self, question: str, top_k: int, q_emb: np.ndarray = None, where: Dict[str, Any] = None,
+                       dense_rows: np.ndarray = None) -> List[int]:
+        """
+        按 retrieval_mode 召回并融合，返回 top_k 个行号
+        :param dense_rows: 可选，已批量算好的向量召回结果（深度为 _dense_depth）
+        """
+        if self.retrieval_mode != 'bm25' and dense_rows is None:
+            if q_emb is None:
+                q_emb = self.embed_query(question)
+            dense_rows, _ = self.vector_store.search_rows(q_emb, self._dense_depth(top_k), where=where)
+        if self.retrieval_mode == 'dense':
+            return [int(i) for i in dense_rows[:top_k]]
+        sparse_rows, _ = self.vector_store.search_bm25_rows(
+            question, max(top_k, self.recall_top_m_bm25), where=where)
+        if self.retrieval_mode == 'bm25':
+            return [int(i) for i in sparse_rows[:top_k]]
+        fused = reciprocal_rank_fusion([dense_rows, sparse_rows], k=self.rrf_k)
+        return [i for i, _ in fused[:top_k]]
+    def retrieve(self, question: str, top_k: int = 3, q_emb: np.ndarray = None,
+                 where: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        """
+        检索入口：先按路由结果只在对应报告内检索，过滤后无结果时回退到全局检索；开启重排时对召回候选重排
+        :param q_emb: 可选，已计算好的问题向量（bm25 模式不需要）
+        :param where: 可选，显式过滤条件，传入时不再自动路由
+        """
+        if q_emb is None and self.retrieval_mode != 'bm25':
+            q_emb = self.embed_query(question)
+        if where is None:
+            where = self.route(question)
+        depth = self._recall_depth(top_k)
+        rows = self._retrieve_rows(question, depth, q_emb, where) if where else []
+        if not rows:
+            rows = self._retrieve_rows(question, depth, q_emb)
+        return self._rerank(question, [self.vector_store.chunks[i] for i in rows], top_k)
+    def _embed_queries(self, questions: List[str]) -> Tuple[np.ndarray, int]:
+        # 先查问题向量缓存，未命中的（同文本只算一次）合并成一次 embed_texts 调用；返回 (向量矩阵, 新嵌入数)
+        keys = [text_key(q) for q in questions]
+        texts = dict(zip(keys, questions))
+        vecs: Dict[str, np.ndarray] = {}
+        for k in texts:
+            v = self.query_cache.get(k)
+            if v is not None:
+                vecs[k] = v
+        missing = [k for k in texts if k not in vecs]
+        if missing:
+            new = self.embedding_model.embed_texts([texts[k] for k in missing])
+            self.query_cache.put_many(missing, new)
+            vecs.update(zip(missing, new))
+        return np.stack([vecs[k] for k in keys]), len(missing)
+    def embed_queries(self, questions: List[str]) -> np.ndarray:
+        """问题向量，优先取缓存"""
+        return self._embed_queries(questions)[0]
+    def embed_query(self, question: str) -> np.ndarray:
+        return self._embed_queries([question])[0][0]
+    def prepare_queries(self, questions: List[str]) -> int:
+        """
+        批量预先嵌入待回答的问题并放入缓存，之后 retrieve/generate_answer 不再逐题调用 embedding
+        :return: 本次新嵌入的问题数（已缓存的不重复计算）
+        """
+        if self.retrieval_mode == 'bm25' or not questions:
+            return 0
+        _, n_new = self._embed_queries(questions)
+        print(f"预先嵌入 {n_new} 个问题（共 {len(questions)} 个，其余已在缓存中）")
+        return n_new
+    def _recall_depth(self, top_k: int) -> int:
+        # 开启重排时召回 rerank_top_m 个候选，否则直接召回 top_k
+        return max(top_k, self.rerank_stage.top_m) if self.rerank_stage is not None else top_k
+    def _rerank(self, question: str, candidates: List[Dict[str, Any]], top_k: int) -> List[Dict[str, Any]]:
+        if self.rerank_stage is None:
+            return candidates[:top_k]
+        return self.rerank_stage.rerank(question, candidates, top_k)
+    def _try_load_index(self, corpus_hash: str) -> bool:
+        manifest = SimpleVectorStore.read_manifest(self.index_dir)
+        if manifest is None:
+            return False
+        if manifest.get("model") != self.embedding_model.model_name or manifest.get("corpus_hash") != corpus_hash \
+                or manifest.get("index_type", 'flat') != self.index_type \
+                or manifest.get("storage", 'float32') != self.storage:
+            print("持久化索引与当前模型/语料/索引类型/存储方式不一致，重新构建")
+            return False
+        try:
+            self.vector_store = SimpleVectorStore.load(self.index_dir, nprobe=self.nprobe, rerank_k=self.rerank_k,
+                                                       search_workers=self.search_workers)
+        except (ValueError, OSError) as e:
+            print(f"加载持久化索引失败，重新构建: {e}")
+            return False
+        print(f"已从 {self.index_dir} 加载向量库（{len(self.vector_store.chunks)} 个chunk）")
+        return True
     def setup(self):
+        corpus_hash = None
+        if self.index_dir:
+            corpus_hash = self.loader.corpus_hash()
+            if self._try_load_index(corpus_hash):
+                return
         print("加载所有页chunk...")
         chunks = self.loader.load_chunks()
         print(f"共加载 {len(chunks)} 个chunk")
@@ -122,27 +917,91 @@ class SimpleRAG:
         embeddings = self.embedding_model.embed_texts([c['content'] for c in chunks])
         print("存储向量...")
         self.vector_store.add_chunks(chunks, embeddings)
+        if self.index_dir:
+            self.vector_store.save(self.index_dir, model_name=self.embedding_model.model_name, corpus_hash=corpus_hash)
+            print(f"向量库已保存到: {self.index_dir}")
         print("RAG向量库构建完成！")
-    def query(self, question: str, top_k: int = 3) -> Dict[str, Any]:
-        q_emb = self.embedding_model.embed_text(question)
-        results = self.vector_store.search(q_emb, top_k)
+    def upsert_report(self, file_name: str, chunks: List[Dict[str, Any]]) -> Dict[str, int]:
+        """
+        新增或替换一份报告的 chunk，只对内容变化的 chunk 调用 embedding，见 SimpleVectorStore.upsert_file
+        """
+        stats = self.vector_store.upsert_file(file_name, chunks, self.embedding_model.embed_texts)
+        print(f"{file_name}: 新增 {stats['added']}，保留 {stats['kept']}，删除 {stats['deleted']}")
+        return stats
+    def delete_report(self, file_name: str) -> int:
+        removed = self.vector_store.delete_file(file_name)
+        print(f"{file_name}: 删除 {removed} 个chunk")
+        return removed
+    def save_index(self, corpus_hash: str = None, full: bool = False):
+        """
+        增量更新后持久化到 index_dir：默认只追加变化部分，见 SimpleVectorStore.save
+        :param corpus_hash: 更新后语料（chunk JSON 及其增量日志）的哈希，默认重新计算
+        :param full: 强制 compact 后全量重写
+        """
+        if not self.index_dir:
+            raise ValueError("未设置 index_dir")
+        corpus_hash = corpus_hash or self.loader.corpus_hash()
+        self.vector_store.save(self.index_dir, model_name=self.embedding_model.model_name, corpus_hash=corpus_hash,
+                               full=full)
+        print(f"向量库已保存到: {self.index_dir}")
+    def close(self):
+        """释放检索资源：结束分片检索的 worker 进程及共享内存"""
+        self.vector_store.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+    def query(self, question: str, top_k: int = 3, where: Dict[str, Any] = None) -> Dict[str, Any]:
+        results = self.retrieve(question, top_k, where=where)
         return {
             "question": question,
             "chunks": results
         }
 
-    def generate_answer(self, question: str, top_k: int = 3, max_retries: int = 3) -> Dict[str, Any]:
+    def query_batch(self, questions: List[str], top_k: int = 3, where: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        """
+        批量检索：所有问题一次性嵌入（由后端按批发送），路由结果相同的问题一次矩阵乘法完成向量召回，
+        再逐个问题与 BM25 结果融合
+        """
+        if not questions:
+            return []
+        routes = [where] * len(questions) if where is not None else [self.route(q) for q in questions]
+        q_embs = None
+        depth = self._recall_depth(top_k)
+        dense: List[Optional[np.ndarray]] = [None] * len(questions)
+        if self.retrieval_mode != 'bm25':
+            q_embs = self.embed_queries(questions)
+            # 路由结果相同的问题归为一组，每组一次批量检索
+            groups: Dict[str, List[int]] = {}
+            for i, r in enumerate(routes):
+                groups.setdefault(json.dumps(r, ensure_ascii=False, sort_keys=True), []).append(i)
+            for idxs in groups.values():
+                hits = self.vector_store.search_batch_rows(q_embs[idxs], self._dense_depth(depth), where=routes[idxs[0]])
+                for i, (rows, _) in zip(idxs, hits):
+                    dense[i] = rows
+        all_results = []
+        for i, q in enumerate(questions):
+            q_emb = q_embs[i] if q_embs is not None else None
+            rows = self._retrieve_rows(q, depth, q_emb, routes[i], dense_rows=dense[i])
+            if not rows and routes[i]:
+                # 过滤后无结果的问题回退到全局检索
+                rows = self._retrieve_rows(q, depth, q_emb)
+            all_results.append(self._rerank(q, [self.vector_store.chunks[j] for j in rows], top_k))
+        return [
+            {"question": q, "chunks": results}
+            for q, results in zip(questions, all_results)
+        ]
+
+    @staticmethod
+    def _llm_config() -> Tuple[str, str, str]:
+        # 配置在进程内只读取一次
+        config = load_llm_config().validate()
+        return config.api_key, config.base_url, config.text_model
+    @staticmethod
+    def build_messages(question: str, chunks: List[Dict[str, Any]]) -> List[Dict[str, str]]:
         """
-        检索+大模型生成式回答，返回结构化结果
+        拼接检索内容（带上元数据）并生成对话消息，同步/异步生成共用
         """
-        qwen_api_key = os.getenv('LOCAL_API_KEY')
-        qwen_base_url = os.getenv('LOCAL_BASE_URL')
-        qwen_model = os.getenv('LOCAL_TEXT_MODEL')
-        if not qwen_api_key or not qwen_base_url or not qwen_model:
-            raise ValueError('请在.env中配置LOCAL_API_KEY、LOCAL_BASE_URL、LOCAL_TEXT_MODEL')
-        q_emb = self.embedding_model.embed_text(question)
-        chunks = self.vector_store.search(q_emb, top_k)
-        # 拼接检索内容，带上元数据
         context = "\n".join([
             f"[文件名]{c['metadata']['file_name']} [页码]{c['metadata']['page']}\n{c['content']}" for c in chunks
         ])
@@ -154,160 +1013,367 @@ class SimpleRAG:
             f"检索内容：\n{context}\n\n问题：{question}\n"
             f"请确保输出内容为合法JSON字符串，不要输出多余内容。"
         )
-        client = OpenAI(api_key=qwen_api_key, base_url=qwen_base_url)
-        
-        # 添加重试机制
-        import time
-        for attempt in range(max_retries):
-            try:
-                completion = client.chat.completions.create(
-                    model=qwen_model,
-                    messages=[
-                        {"role": "system", "content": "你是一名专业的金融分析助手。"},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.2,
-                    max_tokens=1024
-                )
-                break  # 成功则跳出循环
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    wait_time = (attempt + 1) * 2  # 指数退避：2秒、4秒、6秒
-                    print(f"请求失败（尝试 {attempt + 1}/{max_retries}），{wait_time}秒后重试... 错误: {str(e)}")
-                    time.sleep(wait_time)
-                else:
-                    # 最后一次尝试也失败，返回默认值
-                    print(f"请求失败，已重试 {max_retries} 次，返回默认值。错误: {str(e)}")
-                    return {
-                        "question": question,
-                        "answer": "",
-                        "filename": chunks[0]['metadata']['file_name'] if chunks else '',
-                        "page": chunks[0]['metadata']['page'] if chunks else '',
-                        "retrieval_chunks": chunks
-                    }
-        
-        import json as pyjson
-        sys.path.append(os.path.dirname(__file__))
-        from extract_json_array import extract_json_array
-        raw = completion.choices[0].message.content.strip()
-        # 用 extract_json_array 提取 JSON 对象
+        return [
+            {"role": "system", "content": "你是一名专业的金融分析助手。"},
+            {"role": "user", "content": prompt}
+        ]
+    def prompt_messages(self, question: str, chunks: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+        """
+        生成用的对话消息：开启 pack_context 时先去重叠、装入 token 预算，并记录每题节省的 token
+        """
+        if not self.pack_context:
+            return self.build_messages(question, chunks)
+        packed, stats = pack_context(chunks, self.context_token_budget or None)
+        self.context_stats.record(stats)
+        return self.build_messages(question, packed)
+    @staticmethod
+    def empty_answer(question: str, chunks: List[Dict[str, Any]]) -> Dict[str, Any]:
+        # 请求失败时的默认结果：答案为空，来源取检索第一名
+        return {
+            "question": question,
+            "answer": "",
+            "filename": chunks[0]['metadata']['file_name'] if chunks else '',
+            "page": chunks[0]['metadata']['page'] if chunks else '',
+            "retrieval_chunks": [strip_chunk_id(c) for c in chunks]
+        }
+    @staticmethod
+    def parse_answer(question: str, raw: str, chunks: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        从模型输出中解析 answer/filename/page，解析失败时以原文为答案、检索第一名为来源
+        """
+        raw = raw.strip()
+        answer = raw
+        filename = chunks[0]['metadata']['file_name'] if chunks else ''
+        page = chunks[0]['metadata']['page'] if chunks else ''
+        # 用 extract_json_array 提取 JSON 对象，只取第一个
         json_str = extract_json_array(raw, mode='objects')
         if json_str:
             try:
-                arr = pyjson.loads(json_str)
-                # 只取第一个对象
+                arr = json.loads(json_str)
                 if isinstance(arr, list) and arr:
                     j = arr[0]
                     answer = j.get('answer', '')
                     filename = j.get('filename', '')
                     page = j.get('page', '')
-                else:
-                    answer = raw
-                    filename = chunks[0]['metadata']['file_name'] if chunks else ''
-                    page = chunks[0]['metadata']['page'] if chunks else ''
             except Exception:
-                answer = raw
-                filename = chunks[0]['metadata']['file_name'] if chunks else ''
-                page = chunks[0]['metadata']['page'] if chunks else ''
-        else:
-            answer = raw
-            filename = chunks[0]['metadata']['file_name'] if chunks else ''
-            page = chunks[0]['metadata']['page'] if chunks else ''
+                pass
         # 结构化输出
         return {
             "question": question,
             "answer": answer,
             "filename": filename,
             "page": page,
-            "retrieval_chunks": chunks
+            "retrieval_chunks": [strip_chunk_id(c) for c in chunks]
         }
+    @staticmethod
+    def _completion_tokens(messages: List[Dict[str, str]], output: str = None, max_tokens: int = 1024) -> int:
+        # 无输出时返回预估值（提示词 + 输出上限），用于限流器的 TPM 预扣；有输出时按提示词 + 实际输出估算
+        prompt = sum(estimate_tokens(m['content']) for m in messages)
+        return prompt + (max_tokens if output is None else estimate_tokens(output))
+    @property
+    def completion_cache(self) -> CompletionCache:
+        """回答缓存，首次生成时才打开"""
+        if self._completion_cache is None:
+            self._completion_cache = CompletionCache(mode=self.llm_cache_mode)
+        return self._completion_cache
+    @staticmethod
+    def _completion_request(model: str, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        # 同步/异步生成共用的请求参数，也是回答缓存的 key 来源
+        return {"model": model, "messages": messages, "temperature": 0.2, "max_tokens": 1024}
+    def _cached_answer(self, question: str, chunks: List[Dict[str, Any]], key: str) -> Optional[Dict[str, Any]]:
+        # 命中缓存时直接解析；回放模式未命中时返回默认结果，不调用接口；否则返回 None
+        cache = self.completion_cache
+        raw = cache.get(key)
+        if raw is not None:
+            return self.parse_answer(question, raw, chunks)
+        if cache.replay:
+            print(f"回放模式缓存未命中，返回默认值: {question}")
+            return self.empty_answer(question, chunks)
+        return None
+    def _complete(self, client, request: Dict[str, Any]) -> Tuple[str, Optional[int]]:
+        """
+        发送一次请求，返回 (输出文本, 服务端 usage token 数)；流式时读到第一个完整 JSON 对象即关闭流，usage 为 None
+        """
+        if not self.stream:
+            completion = client.chat.completions.create(**request)
+            return completion.choices[0].message.content, \
+                getattr(getattr(completion, 'usage', None), 'total_tokens', None)
+        t0 = time.perf_counter()
+        return read_stream(client.chat.completions.create(**request, stream=True), t0, self.stream_stats), None
+    async def _complete_async(self, request: Dict[str, Any]) -> Tuple[str, Optional[int]]:
+        # _complete 的异步版本
+        if not self.stream:
+            completion = await self.async_client.chat.completions.create(**request)
+            return completion.choices[0].message.content, \
+                getattr(getattr(completion, 'usage', None), 'total_tokens', None)
+        t0 = time.perf_counter()
+        stream = await self.async_client.chat.completions.create(**request, stream=True)
+        return await read_stream_async(stream, t0, self.stream_stats), None
+    def _semantic_key(self, question: str, top_k: int) -> Tuple[np.ndarray, str, bool]:
+        """
+        语义缓存查询条件：(归一化问题向量, 实体键, 是否只认原文)
+        实体键包含识别出的公司、年份与 top_k；未识别出公司时只复用完全相同的问题
+        """
+        q_vec = np.asarray(self.embed_query(question), dtype=np.float32)
+        q_vec = q_vec / (np.linalg.norm(q_vec) + 1e-8)
+        found = self._query_router().detect(question)
+        entity = json.dumps({"company": sorted(found["company"]), "year": sorted(found["year"]), "top_k": top_k},
+                            ensure_ascii=False)
+        return q_vec, entity, not found["company"]
+    def generate_answer(self, question: str, top_k: int = 3, max_retries: int = 3) -> Dict[str, Any]:
+        """
+        检索+大模型生成式回答，返回结构化结果；开启语义缓存时相似问题直接复用回答，并发的相同问题只生成一次
+        """
+        if self.semantic_cache is None:
+            return self.coalescer.run((text_key(question), top_k),
+                                      lambda: self._generate_answer(question, top_k, max_retries))
+        q_vec, entity, exact_only = self._semantic_key(question, top_k)
+        hit = self.semantic_cache.lookup(question, q_vec, entity, exact_only)
+        if hit is not None:
+            return hit
+
+        def run():
+            result = self._generate_answer(question, top_k, max_retries)
+            if result['answer']:  # 失败时的默认结果不缓存
+                self.semantic_cache.put(question, q_vec, entity, result)
+            return result
+        return self.coalescer.run((text_key(question), top_k), run)
+    def _generate_answer(self, question: str, top_k: int, max_retries: int) -> Dict[str, Any]:
+        qwen_api_key, qwen_base_url, qwen_model = self._llm_config()
+        chunks = self.retrieve(question, top_k)
+        messages = self.prompt_messages(question, chunks)
+        request = self._completion_request(qwen_model, messages)
+        key = completion_key(**request)
+        cached = self._cached_answer(question, chunks, key)
+        if cached is not None:
+            return cached
+        client = get_sync_client(qwen_api_key, qwen_base_url)  # 复用 keep-alive 连接，不再每题新建
+        limiter = get_rate_limiter('chat')
+
+        # 添加重试机制：请求经共享限流器排队，429 时整体降并发
+        for attempt in range(max_retries):
+            try:
+                with limiter.acquire(self._completion_tokens(messages)) as permit:
+                    content, tokens = self._complete(client, request)
+                    tokens = tokens or self._completion_tokens(messages, content)
+                    permit.set_tokens(tokens)
+                break  # 成功则跳出循环
+            except Exception as e:
+                if attempt < max_retries - 1:
+                    wait_time = retry_delay(e, attempt)  # 指数退避 + 抖动，Retry-After 优先
+                    print(f"请求失败（尝试 {attempt + 1}/{max_retries}），{wait_time:.1f}秒后重试... 错误: {str(e)}")
+                    time.sleep(wait_time)
+                else:
+                    # 最后一次尝试也失败，返回默认值
+                    print(f"请求失败，已重试 {max_retries} 次，返回默认值。错误: {str(e)}")
+                    return self.empty_answer(question, chunks)
+        self.completion_cache.put(key, content, qwen_model, tokens)
+        return self.parse_answer(question, content, chunks)
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        """异步客户端，同一事件循环内进程共用一个（复用连接池）；可赋值 _async_client 替换"""
+        if self._async_client is not None:
+            return self._async_client
+        qwen_api_key, qwen_base_url, _ = self._llm_config()
+        return get_async_client(qwen_api_key, qwen_base_url)
+    async def generate_answer_async(self, question: str, top_k: int = 3, max_retries: int = 3,
+                                    timeout: float = None, chunks: List[Dict[str, Any]] = None,
+                                    raise_on_failure: bool = False) -> Dict[str, Any]:
+        """
+        generate_answer 的异步版本，结果格式相同，同样经过语义缓存与并发请求合并
+        :param timeout: 单次请求超时（秒），默认读取 LLM_TIMEOUT 或 60；超时计为一次失败并重试
+        :param chunks: 可选，已检索好的 chunk（批量运行时统一用 query_batch 检索）；不传时在线程中检索
+        :param raise_on_failure: 重试耗尽时抛出 RuntimeError 而不是返回默认结果（便于记录失败、之后重试）
+        """
+        key = (text_key(question), top_k)
+        run = lambda: self._generate_answer_async(question, top_k, max_retries, timeout, chunks, raise_on_failure)
+        if self.semantic_cache is None:
+            return await self.coalescer.run_async(key, run)
+        q_vec, entity, exact_only = await asyncio.to_thread(self._semantic_key, question, top_k)
+        hit = self.semantic_cache.lookup(question, q_vec, entity, exact_only)
+        if hit is not None:
+            return hit
 
+        async def run_and_cache():
+            result = await run()
+            if result['answer']:
+                self.semantic_cache.put(question, q_vec, entity, result)
+            return result
+        return await self.coalescer.run_async(key, run_and_cache)
+    async def _generate_answer_async(self, question: str, top_k: int, max_retries: int, timeout: Optional[float],
+                                     chunks: Optional[List[Dict[str, Any]]], raise_on_failure: bool) -> Dict[str, Any]:
+        _, _, qwen_model = self._llm_config()
+        timeout = timeout or load_llm_config().timeout
+        if chunks is None:
+            chunks = await asyncio.to_thread(self.retrieve, question, top_k)
+        messages = self.prompt_messages(question, chunks)
+        request = self._completion_request(qwen_model, messages)
+        key = completion_key(**request)
+        cached = self._cached_answer(question, chunks, key)
+        if cached is not None:
+            return cached
+        limiter = get_rate_limiter('chat')
+        for attempt in range(max_retries):
+            try:
+                # 限流排队时间不计入超时；wait_for 超时会取消请求；外部取消（CancelledError）不在此捕获，直接向上传播
+                async with limiter.acquire_async(self._completion_tokens(messages)) as permit:
+                    content, tokens = await asyncio.wait_for(self._complete_async(request), timeout=timeout)
+                    tokens = tokens or self._completion_tokens(messages, content)
+                    permit.set_tokens(tokens)
+                break
+            except Exception as e:
+                reason = f"超时 {timeout:g}s" if isinstance(e, asyncio.TimeoutError) else str(e)
+                if attempt < max_retries - 1:
+                    wait_time = retry_delay(e, attempt)  # 指数退避 + 抖动，Retry-After 优先
+                    print(f"请求失败（尝试 {attempt + 1}/{max_retries}），{wait_time:.1f}秒后重试... 错误: {reason}")
+                    await asyncio.sleep(wait_time)
+                else:
+                    if raise_on_failure:
+                        raise RuntimeError(f"请求失败，已重试 {max_retries} 次: {reason}") from e
+                    print(f"请求失败，已重试 {max_retries} 次，返回默认值。错误: {reason}")
+                    return self.empty_answer(question, chunks)
+        self.completion_cache.put(key, content, qwen_model, tokens)
+        return self.parse_answer(question, content, chunks)
+    async def generate_answers_async(self, items: List[Tuple[int, str]], top_k: int = 3, max_concurrency: int = None,
+                                     timeout: float = None, journal: RunJournal = None) -> List[Tuple[int, Dict[str, Any]]]:
+        """
+        并发批量生成：先用 query_batch 一次性检索全部问题，再以信号量限制并发调用大模型
+        :param items: [(原始序号, 问题), ...]
+        :param max_concurrency: 同时进行的请求数上限，默认读取 LLM_MAX_CONCURRENCY 或 8；实际并发还受 chat 限流器自适应调整
+        :param journal: 可选，每完成一题即追加到运行日志并落盘（失败的题记为 failed，恢复时重试），结果不在内存中保留
+        :return: 未传 journal 时为 [(idx, result), ...]，按完成顺序，失败的题为默认结果；传 journal 时为 []
+        """
+        max_concurrency = max_concurrency or int(os.getenv('LLM_MAX_CONCURRENCY', '8'))
+        # query_batch 经问题向量缓存批量嵌入，已 prepare_queries 的问题不再调用 embedding
+        retrieved = await asyncio.to_thread(self.query_batch, [q for _, q in items], top_k)
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run_one(idx: int, question: str, chunks: List[Dict[str, Any]]):
+            async with semaphore:
+                try:
+                    result = await self.generate_answer_async(question, top_k, timeout=timeout, chunks=chunks,
+                                                              raise_on_failure=True)
+                    return idx, result, 'ok'
+                except Exception as e:
+                    print(f"处理失败: {question[:30]}... {e}")
+                    return idx, self.empty_answer(question, chunks), 'failed'
+
+        tasks = [asyncio.create_task(run_one(idx, q, r["chunks"])) for (idx, q), r in zip(items, retrieved)]
+        del retrieved
+        results = []
+        try:
+            for fut in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc='并发批量生成'):
+                idx, result, status = await fut
+                if journal is not None:
+                    journal.append(idx, result, status)
+                else:
+                    results.append((idx, result))
+        finally:
+            # 异常或被取消时取消尚未完成的请求
+            for t in tasks:
+                t.cancel()
+        return results
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="批量评测：检索 + 大模型生成，逐题写入可恢复的运行日志")
+    parser.add_argument("--resume", action="store_true", help="从运行日志恢复：跳过已回答的题，重试失败与未完成的题")
+    parser.add_argument("--sample", type=int, default=None, help="只随机抽取 N 题（默认全部）")
+    parser.add_argument("--test-path", type=str, default="./datas/test_advanced_250.json")
+    parser.add_argument("--journal", type=str, default=os.path.join(os.path.dirname(__file__), 'rag_top1_pred_raw.jsonl'),
+                        help="运行日志路径，manifest 写在同名 .manifest.json")
+    args = parser.parse_args()
+
+    # 启动时校验大模型配置，避免建完索引才发现 .env 缺项
+    load_llm_config().validate()
     # 路径可根据实际情况调整
     chunk_json_path = os.path.join(os.path.dirname(__file__), 'all_pdf_page_chunks_merged.json')
     rag = SimpleRAG(
         chunk_json_path, # 加载知识库
-        batch_size=32 # 指定批量大小
+        batch_size=32, # 指定批量大小
+        index_dir=os.path.join(os.path.dirname(__file__), 'rag_index') # 持久化索引，语料未变时直接加载
         )
-    rag.setup() # 构建RAG向量库
-    # EmbeddingModel 会自动从 Hugging Face 加载 bge-m3
+    try:
+        rag.setup() # 构建RAG向量库
+        # EmbeddingModel 会自动从 Hugging Face 加载 bge-m3
 
-    # 控制测试时读取的题目数量，默认只随机抽取10个，实际跑全部时设为None
-    TEST_SAMPLE_NUM = None  # 设置为None则全部跑
-    FILL_UNANSWERED = True  # 未回答的也输出默认内容
+        FILL_UNANSWERED = True  # 未回答的也输出默认内容
+        TOP_K = 5
 
-    # 批量评测脚本：读取测试集，检索+大模型生成，输出结构化结果
-    test_path = "./datas/test_advanced_250.json"
-    if os.path.exists(test_path):
-        with open(test_path, 'r', encoding='utf-8') as f:
-            test_data = json.load(f)
-        import concurrent.futures
-        import random
+        # 批量评测脚本：读取测试集，检索+大模型生成，输出结构化结果
+        test_path = args.test_path
+        if os.path.exists(test_path):
+            with open(test_path, 'r', encoding='utf-8') as f:
+                test_data = json.load(f)
 
-        # 记录所有原始索引
-        all_indices = list(range(len(test_data)))
-        # 随机抽取部分题目用于测试
-        selected_indices = all_indices
-        if TEST_SAMPLE_NUM is not None and TEST_SAMPLE_NUM > 0:
-            if len(test_data) > TEST_SAMPLE_NUM:
-                selected_indices = sorted(random.sample(all_indices, TEST_SAMPLE_NUM))
+            config = {
+                "test_path": os.path.abspath(test_path),
+                "test_sha1": file_sha1(test_path),
+                "top_k": TOP_K,
+                "retrieval_mode": rag.retrieval_mode,
+                "model": load_llm_config().text_model,
+            }
+            if args.resume:
+                # 恢复时沿用首次运行抽取的题目
+                journal = RunJournal.resume(args.journal, config)
+                selected_indices = journal.manifest["config"]["selected_indices"]
+                print(f"恢复运行：已回答 {len(journal.answered())}，失败待重试 {len(journal.failed())}")
+            else:
+                # 记录所有原始索引；随机抽取部分题目用于测试
+                selected_indices = list(range(len(test_data)))
+                if args.sample and len(test_data) > args.sample:
+                    selected_indices = sorted(random.sample(selected_indices, args.sample))
+                journal = RunJournal.start(args.journal, dict(config, selected_indices=selected_indices))
 
-        def process_one(idx):
-            item = test_data[idx]
-            question = item['question']
-            tqdm.write(f"[{selected_indices.index(idx)+1}/{len(selected_indices)}] 正在处理: {question[:30]}...")
-            result = rag.generate_answer(question, top_k=5)
-            return idx, result
-
-        results = []
-        if selected_indices:
-            # 降低并发数，从2改为1，避免服务器过载
-            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-                # 添加延迟以避免请求过快
-                import time
-                futures = []
-                for idx in selected_indices:
-                    future = executor.submit(process_one, idx)
-                    futures.append(future)
-                    time.sleep(0.5)  # 每个请求间隔0.5秒
-                
-                results = []
-                for future in tqdm(concurrent.futures.as_completed(futures), 
-                                 total=len(futures), desc='并发批量生成'):
-                    try:
-                        results.append(future.result())
-                    except Exception as e:
-                        print(f"处理失败: {e}")
-                        # 可以选择跳过或记录错误
+            done = journal.answered()
+            pending = [idx for idx in selected_indices if idx not in done]
+            try:
+                if pending:
+                    # asyncio 并发生成：并发数由 LLM_MAX_CONCURRENCY 控制，单次请求超时由 LLM_TIMEOUT 控制
+                    # 每完成一题即写入运行日志并落盘，中途中断后可用 --resume 继续
+                    items = [(idx, test_data[idx]['question']) for idx in pending]
+                    rag.prepare_queries([q for _, q in items])  # 全部问题一次批量嵌入
+                    asyncio.run(rag.generate_answers_async(items, top_k=TOP_K, journal=journal))
+            except BaseException:
+                journal.close(status="interrupted")
+                raise
+            journal.close(status="completed" if not journal.failed() else "completed_with_failures")
+            print(f"运行日志: {args.journal}，{journal.summary()}")
 
-        # 先输出一份未过滤的原始结果（含 idx）
-        import json
-        raw_out_path = os.path.join(os.path.dirname(__file__), 'rag_top1_pred_raw.json')
-        with open(raw_out_path, 'w', encoding='utf-8') as f:
-            json.dump(results, f, ensure_ascii=False, indent=2)
-        print(f'已输出原始未过滤结果到: {raw_out_path}')
+            # 由运行日志压实出最终文件：先输出一份未过滤的原始结果（含 idx）
+            raw_out_path = os.path.join(os.path.dirname(__file__), 'rag_top1_pred_raw.json')
+            journal.compact_raw(raw_out_path)
+            print(f'已输出原始未过滤结果到: {raw_out_path}')
 
-        # 只保留结果部分，并去除 retrieval_chunks 字段
-        idx2result = {idx: {k: v for k, v in r.items() if k != 'retrieval_chunks'} for idx, r in results}
-        filtered_results = []
-        for idx, item in enumerate(test_data):
-            if idx in idx2result:
-                filtered_results.append(idx2result[idx])
-            elif FILL_UNANSWERED:
-                # 未被回答的，补默认内容
-                filtered_results.append({
-                    "question": item.get("question", ""),
-                    "answer": "",
-                    "filename": "",
-                    "page": "",
-                })
-        # 输出结构化结果到json
-        out_path = os.path.join(os.path.dirname(__file__), 'rag_top1_pred.json')
-        with open(out_path, 'w', encoding='utf-8') as f:
-            json.dump(filtered_results, f, ensure_ascii=False, indent=2)
-        print(f'已输出结构化检索+大模型生成结果到: {out_path}')
-    else:
-        print("datas/test.json 不存在")
-    
-        
\ No newline at end of file
+            def filtered_results():
+                # 按题目顺序逐条产出，去除 retrieval_chunks 字段；未被回答的补默认内容
+                logged = journal.iter_results()
+                nxt = next(logged, None)
+                for idx, item in enumerate(test_data):
+                    if nxt is not None and nxt[0] == idx:
+                        yield {k: v for k, v in nxt[1].items() if k != 'retrieval_chunks'}
+                        nxt = next(logged, None)
+                    elif FILL_UNANSWERED:
+                        yield {
+                            "question": item.get("question", ""),
+                            "answer": "",
+                            "filename": "",
+                            "page": "",
+                        }
+            # 输出结构化结果到json
+            out_path = os.path.join(os.path.dirname(__file__), 'rag_top1_pred.json')
+            write_json_array(out_path, filtered_results())
+            print(f'已输出结构化检索+大模型生成结果到: {out_path}')
+            if rag.rerank_stage is not None:
+                print(rag.rerank_stage.stats.report())
+            print(rate_limit_report())
+            print(rag.completion_cache.report())
+            print(rag.context_stats.report())
+            if rag.stream:
+                print(rag.stream_stats.report())
+            if rag.semantic_cache is not None:
+                print(rag.semantic_cache.report())
+        else:
+            print(f"{test_path} 不存在")
+    finally:
+        rag.close()  # 结束分片检索的 worker 进程并释放共享内存
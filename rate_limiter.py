@@ -0,0 +1,330 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# 同一进程内按端点共享的限流器，如 embedding、chat；配置读取 RATE_LIMIT_<端点>_RPM / _TPM / _CONCURRENCY / _TARGET_LATENCY
+_LIMITERS: Dict[str, "RateLimiter"] = {}
+_LIMITERS_LOCK = threading.Lock()
+
+WAIT_EPSILON = 0.001  # 等待超过该秒数才计为一次被限流
+
+
+def retry_after_seconds(err: Exception) -> Optional[float]:
+    """
+    从错误响应头中解析服务端建议的等待时间（retry-after-ms / Retry-After）
+    """
+    response = getattr(err, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        # HTTP-date 格式
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_rate_limited(err: Exception) -> bool:
+    return getattr(err, "status_code", None) == 429
+
+
+def retry_delay(err: Exception, attempt: int, base_delay: float = 2.0, max_delay: float = 30.0) -> float:
+    """
+    重试等待秒数：指数退避 + 抖动，服务端给出 Retry-After 时以其为下限
+    """
+    delay = min(base_delay * (2 ** attempt), max_delay) * random.uniform(0.5, 1.0)
+    retry_after = retry_after_seconds(err)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+class TokenBucket:
+    """
+    令牌桶：容量 capacity，每秒补充 rate；reserve 立即扣减（可透支），返回需要等待的秒数
+    透支方式让等待的请求按到达顺序排队，不会被后来的请求插队
+    """
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self._level = capacity
+        self._stamp = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        self._level = min(self.capacity, self._level + (now - self._stamp) * self.rate)
+        self._stamp = now
+        # 单个请求超过桶容量时按容量计，避免永远等不到
+        self._level -= min(amount, self.capacity)
+        return max(0.0, -self._level / self.rate)
+
+    def adjust(self, delta: float):
+        # 实际用量与预估不同时补扣或退还
+        self._level = min(self.capacity, self._level - delta)
+
+
+class Permit:
+    """
+    一次请求的许可：请求完成后可用 set_tokens 回填实际 token 数
+    """
+    def __init__(self, limiter: "RateLimiter", tokens: float, waited: float):
+        self.limiter = limiter
+        self.tokens = tokens
+        self.waited = waited
+        self.start = time.monotonic()
+
+    def set_tokens(self, actual: Optional[float]):
+        if actual is not None:
+            self.limiter._settle_tokens(actual - self.tokens)
+            self.tokens = actual
+
+
+class RateLimiter:
+    """
+    单个端点的共享限流器，同步线程与 asyncio 任务共用同一份状态：
+    - RPM / TPM 两个令牌桶限制请求速率与 token 速率
+    - 并发上限按 AIMD 自适应：成功且延迟正常时每轮 +1，遇到 429 减半、延迟超过目标时降 10%（每秒最多下调一次）
+    - 429 带 Retry-After 时全体暂停到该时刻
+    - 统计排队等待时间、被限流次数、429 次数
+    """
+    def __init__(self, name: str, rpm: float = None, tpm: float = None, max_concurrency: int = 16,
+                 min_concurrency: int = 1, target_latency: float = None):
+        """
+        :param rpm: 每分钟请求数上限，None 表示不限
+        :param tpm: 每分钟 token 上限，None 表示不限
+        :param max_concurrency: 并发上限的最大值（初始值）
+        :param target_latency: 可选，单次请求目标延迟（秒），超过时下调并发
+        """
+        self.name = name
+        self._rpm = TokenBucket(rpm, rpm / 60.0) if rpm else None
+        self._tpm = TokenBucket(tpm, tpm / 60.0) if tpm else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.target_latency = target_latency
+        self.limit = float(max_concurrency)
+        self._inflight = 0
+        self._waiters = deque()  # FIFO：threading.Event 或 (loop, future)
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        # 统计
+        self.requests = 0
+        self.throttled = 0
+        self.rate_limited = 0
+        self.tokens = 0.0
+        self._waits: List[float] = []
+        self._latencies: List[float] = []
+        self._min_limit = self.limit
+
+    # ---- 并发槽位 ----
+    def _try_take(self) -> bool:
+        if not self._waiters and self._inflight < int(self.limit):
+            self._inflight += 1
+            return True
+        return False
+
+    def _wake(self):
+        # 持锁调用：按 FIFO 把空出的槽位直接交给等待者
+        while self._waiters and self._inflight < int(self.limit):
+            waiter = self._waiters.popleft()
+            self._inflight += 1
+            if isinstance(waiter, threading.Event):
+                waiter.set()
+            else:
+                loop, fut = waiter
+                loop.call_soon_threadsafe(lambda f=fut: f.done() or f.set_result(None))
+
+    def _release(self):
+        with self._lock:
+            self._inflight -= 1
+            self._wake()
+
+    def _reserve(self, tokens: float) -> float:
+        # 扣减令牌并返回需要等待的秒数（含 Retry-After 暂停）
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._paused_until - now)
+            if self._rpm is not None:
+                wait = max(wait, self._rpm.reserve(1, now))
+            if self._tpm is not None:
+                wait = max(wait, self._tpm.reserve(tokens, now))
+            return wait
+
+    def _settle_tokens(self, delta: float):
+        # 只修正 TPM 桶；累计用量在 _on_done 中按最终的 permit.tokens 记一次
+        with self._lock:
+            if self._tpm is not None:
+                self._tpm.adjust(delta)
+
+    # ---- AIMD ----
+    def _on_done(self, permit: Permit, err: Optional[BaseException]):
+        latency = time.monotonic() - permit.start
+        with self._lock:
+            self.requests += 1
+            self.tokens += permit.tokens
+            self._waits.append(permit.waited)
+            if permit.waited > WAIT_EPSILON:
+                self.throttled += 1
+            now = time.monotonic()
+            if err is not None and is_rate_limited(err):
+                self.rate_limited += 1
+                retry_after = retry_after_seconds(err)
+                if retry_after:
+                    self._paused_until = max(self._paused_until, now + retry_after)
+                self._decrease(0.5, now)
+            elif err is None:
+                self._latencies.append(latency)
+                if self.target_latency and latency > self.target_latency:
+                    self._decrease(0.9, now)
+                else:
+                    self.limit = min(self.max_concurrency, self.limit + 1.0 / max(self.limit, 1.0))
+            self._inflight -= 1
+            self._wake()
+
+    def _decrease(self, factor: float, now: float):
+        # 同一波拥塞只下调一次
+        if now - self._last_decrease < 1.0:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_concurrency, self.limit * factor)
+        self._min_limit = min(self._min_limit, self.limit)
+
+    # ---- 对外接口 ----
+    @contextmanager
+    def acquire(self, tokens: float = 1):
+        """
+        同步获取许可：先等并发槽位，再按令牌桶等待；块内抛出的 429 会触发降并发与暂停
+        :param tokens: 预估 token 数（用于 TPM），请求完成后可用 permit.set_tokens 回填实际值
+        """
+        t0 = time.monotonic()
+        event = None
+        with self._lock:
+            if not self._try_take():
+                event = threading.Event()
+                self._waiters.append(event)
+        if event is not None:
+            event.wait()
+        try:
+            wait = self._reserve(tokens)
+            if wait > 0:
+                time.sleep(wait)
+        except BaseException:
+            self._release()
+            raise
+        permit = Permit(self, tokens, time.monotonic() - t0)
+        try:
+            yield permit
+        except BaseException as e:
+            self._on_done(permit, e)
+            raise
+        self._on_done(permit, None)
+
+    @asynccontextmanager
+    async def acquire_async(self, tokens: float = 1):
+        """
+        acquire 的 asyncio 版本，等待期间不阻塞事件循环，被取消时归还槽位
+        """
+        t0 = time.monotonic()
+        waiter = None
+        with self._lock:
+            if not self._try_take():
+                waiter = (asyncio.get_running_loop(), asyncio.get_running_loop().create_future())
+                self._waiters.append(waiter)
+        if waiter is not None:
+            try:
+                await waiter[1]
+            except asyncio.CancelledError:
+                with self._lock:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+                        raise
+                # 槽位已移交给本任务，归还
+                self._release()
+                raise
+        try:
+            wait = self._reserve(tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+        except BaseException:
+            self._release()
+            raise
+        permit = Permit(self, tokens, time.monotonic() - t0)
+        try:
+            yield permit
+        except BaseException as e:
+            self._on_done(permit, e)
+            raise
+        self._on_done(permit, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            waits = np.asarray(self._waits, dtype=np.float64)
+            lat = np.asarray(self._latencies, dtype=np.float64)
+            return {
+                "endpoint": self.name,
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "rate_limited": self.rate_limited,
+                "tokens": int(self.tokens),
+                "wait_s_total": float(waits.sum()),
+                "wait_s_mean": float(waits.mean()) if waits.size else 0.0,
+                "wait_s_p95": float(np.percentile(waits, 95)) if waits.size else 0.0,
+                "wait_s_max": float(waits.max()) if waits.size else 0.0,
+                "latency_s_p50": float(np.percentile(lat, 50)) if lat.size else 0.0,
+                "concurrency_limit": round(self.limit, 2),
+                "concurrency_min": round(self._min_limit, 2),
+            }
+
+    def report(self) -> str:
+        s = self.stats()
+        return (f"[{s['endpoint']}] 请求 {s['requests']}，被限流 {s['throttled']}，429 {s['rate_limited']}，"
+                f"token {s['tokens']}；排队 总/均/p95/max = {s['wait_s_total']:.1f}/{s['wait_s_mean']:.2f}/"
+                f"{s['wait_s_p95']:.2f}/{s['wait_s_max']:.2f}s；并发上限 当前 {s['concurrency_limit']}，"
+                f"最低 {s['concurrency_min']}")
+
+
+def get_rate_limiter(endpoint: str) -> RateLimiter:
+    """
+    获取进程内共享的端点限流器，首次调用时从环境变量读取配置
+    例如 RATE_LIMIT_CHAT_RPM=600、RATE_LIMIT_CHAT_TPM=1000000、RATE_LIMIT_CHAT_CONCURRENCY=16
+    """
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(endpoint)
+        if limiter is None:
+            prefix = f"RATE_LIMIT_{endpoint.upper()}_"
+            env = lambda key: os.getenv(prefix + key)
+            limiter = RateLimiter(
+                endpoint,
+                rpm=float(env("RPM")) if env("RPM") else None,
+                tpm=float(env("TPM")) if env("TPM") else None,
+                max_concurrency=int(env("CONCURRENCY") or 16),
+                target_latency=float(env("TARGET_LATENCY")) if env("TARGET_LATENCY") else None,
+            )
+            _LIMITERS[endpoint] = limiter
+        return limiter
+
+
+def rate_limit_report() -> str:
+    with _LIMITERS_LOCK:
+        limiters = list(_LIMITERS.values())
+    return "\n".join(l.report() for l in limiters)
@@ -0,0 +1,50 @@
+import re
+from pathlib import Path
+from typing import Dict, Tuple
+
+
+def extract_company_and_year(filename: str) -> Tuple[str, str]:
+    stem = Path(filename).stem
+    parts = stem.split("-")
+    # 规则：优先选择包含中文、且不含“年度报告/审计报告/摘要”的片段，
+    # 同时排除形如“600030.SH”或纯数字、日期段
+    def is_candidate(s: str) -> bool:
+        if not re.search(r"[\u4e00-\u9fff]", s):
+            return False
+        if any(x in s for x in ["年度报告", "审计报告", "摘要"]):
+            return False
+        if re.match(r"^\d{6}\.[A-Z]{2,}$", s):
+            return False
+        if re.match(r"^\d{4}$", s):
+            return False
+        if re.match(r"^\d{2}$", s):
+            return False
+        return True
+
+    candidates = [p for p in parts if is_candidate(p)]
+    if candidates:
+        # 选择中文字符数最多的片段作为公司名
+        company = max(candidates, key=lambda x: len(re.findall(r"[\u4e00-\u9fff]", x)))
+    elif len(parts) >= 5:
+        company = parts[4]
+    else:
+        company = stem
+
+    # 报告年度：匹配“(\d{4})年?年度报告”
+    m = re.search(r"(\d{4})年?年度报告", filename)
+    year = m.group(1) if m else ""
+    return company, year
+
+
+def extract_ticker(filename: str) -> str:
+    # 文件名中的证券代码，如 601319.SH
+    m = re.search(r"(\d{6})\.[A-Z]{2,}", Path(filename).stem)
+    return m.group(0) if m else ""
+
+
+def report_attributes(filename: str) -> Dict[str, str]:
+    """
+    从年报文件名派生分区属性：file_name、company、year、ticker
+    """
+    company, year = extract_company_and_year(filename)
+    return {"file_name": filename, "company": company, "year": year, "ticker": extract_ticker(filename)}
@@ -0,0 +1,231 @@
+import os
+import time
+import threading
+from typing import Any, Callable, Dict, List, Optional, Type
+
+import numpy as np
+
+from bm25_index import tokenize
+
+# 通过环境变量选择重排器：RERANKER=cross_encoder|lexical|stub，RERANK_MODEL、RERANK_DEVICE 可选
+RERANKERS: Dict[str, Type["Reranker"]] = {}
+
+
+def register_reranker(name: str):
+    """
+    注册重排器的装饰器，注册后可通过名字（配置）选择
+    """
+    def decorator(cls):
+        cls.name = name
+        RERANKERS[name] = cls
+        return cls
+    return decorator
+
+
+class Reranker:
+    """
+    重排器统一接口：score(query, passages) 返回与 passages 等长的相关度分数，越大越相关
+    """
+    name = "base"
+
+    def __init__(self, batch_size: int = 16):
+        self.batch_size = batch_size
+
+    def score(self, query: str, passages: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+
+@register_reranker("cross_encoder")
+class CrossEncoderReranker(Reranker):
+    """
+    本地 cross-encoder（默认 bge-reranker-v2-m3），问题与 chunk 成对输入打分，默认在 CPU 上运行
+    """
+    def __init__(self, batch_size: int = 16, model_name: str = None, device: str = None, max_length: int = 512):
+        super().__init__(batch_size)
+        from FlagEmbedding import FlagReranker
+        self.model_name = model_name or os.getenv('RERANK_MODEL', 'BAAI/bge-reranker-v2-m3')
+        self.device = device or os.getenv('RERANK_DEVICE', 'cpu')
+        self.max_length = max_length
+        print(f"正在加载重排模型: {self.model_name}")
+        use_fp16 = self.device.startswith("cuda")  # 仅 GPU 使用 fp16 加速
+        try:
+            self.model = FlagReranker(self.model_name, use_fp16=use_fp16, devices=self.device)
+        except TypeError:
+            # 旧版 FlagEmbedding 不支持 devices 参数，按其默认设备选择
+            self.model = FlagReranker(self.model_name, use_fp16=use_fp16)
+        print(f"重排模型加载完成，设备: {self.device}")
+
+    def score(self, query: str, passages: List[str]) -> np.ndarray:
+        scores = self.model.compute_score([[query, p] for p in passages], batch_size=self.batch_size,
+                                          max_length=self.max_length)
+        # 只有一对输入时 compute_score 返回标量
+        return np.atleast_1d(np.asarray(scores, dtype=np.float32))
+
+
+@register_reranker("lexical")
+class LexicalOverlapReranker(Reranker):
+    """
+    词项覆盖率打分：问题中不同词项（中文二元组、英文数字整词）在 chunk 中出现的比例
+    不需要模型，适合作为 cross-encoder 的低成本替代或对照
+    """
+    def score(self, query: str, passages: List[str]) -> np.ndarray:
+        q_terms = set(tokenize(query))
+        if not q_terms:
+            return np.zeros(len(passages), dtype=np.float32)
+        return np.array([len(q_terms.intersection(tokenize(p))) / len(q_terms) for p in passages], dtype=np.float32)
+
+
+@register_reranker("stub")
+class StubReranker(Reranker):
+    """
+    本地占位重排器：所有候选同分（保持召回顺序），可设置每批延迟，用于离线测试时间预算与回退
+    """
+    def __init__(self, batch_size: int = 16, delay: float = 0.0):
+        super().__init__(batch_size)
+        self.delay = delay
+
+    def score(self, query: str, passages: List[str]) -> np.ndarray:
+        if self.delay:
+            time.sleep(self.delay)
+        return np.zeros(len(passages), dtype=np.float32)
+
+
+def create_reranker(reranker: str = None, batch_size: int = 16, **kwargs) -> Reranker:
+    """
+    按名字创建重排器
+    :param reranker: 重排器名（cross_encoder/lexical/stub），默认 RERANKER 或 cross_encoder
+    """
+    reranker = reranker or os.getenv('RERANKER', 'cross_encoder')
+    if reranker not in RERANKERS:
+        raise ValueError(f"未知的重排器: {reranker}，可选 {list(RERANKERS)}")
+    return RERANKERS[reranker](batch_size=batch_size, **kwargs)
+
+
+class RerankStats:
+    """
+    重排阶段的耗时与效果统计，线程安全
+    hit@k 只在调用方提供 is_relevant 时统计（如评测集带标准答案的文件名/页码）
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.reranked = 0  # 在预算内完成打分并按重排结果输出的查询数
+        self.fallbacks = 0  # 超出时间预算、回退到召回顺序的查询数
+        self.errors = 0  # 重排器异常、回退到召回顺序的查询数
+        self.candidates = 0  # 实际送入重排器打分的候选数
+        self.top1_changed = 0  # 重排后第一名与召回第一名不同的查询数
+        self.judged = 0  # 提供了 is_relevant 的查询数
+        self.recall_hits = 0  # 召回顺序 top_k 命中相关 chunk 的查询数
+        self.rerank_hits = 0  # 最终输出 top_k 命中相关 chunk 的查询数
+        self.latencies: List[float] = []  # 每个查询重排阶段耗时（秒）
+
+    def record(self, seconds: float, scored: int, outcome: str, top1_changed: bool = False,
+               recall_hit: Optional[bool] = None, rerank_hit: Optional[bool] = None):
+        with self._lock:
+            self.queries += 1
+            self.candidates += scored
+            self.latencies.append(seconds)
+            if outcome == "reranked":
+                self.reranked += 1
+            elif outcome == "fallback":
+                self.fallbacks += 1
+            elif outcome == "error":
+                self.errors += 1
+            self.top1_changed += int(top1_changed)
+            if recall_hit is not None:
+                self.judged += 1
+                self.recall_hits += int(recall_hit)
+                self.rerank_hits += int(bool(rerank_hit))
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            lat = np.asarray(self.latencies, dtype=np.float64) * 1000
+            total = sum(self.latencies)
+            out = {
+                "queries": self.queries,
+                "reranked": self.reranked,
+                "fallbacks": self.fallbacks,
+                "errors": self.errors,
+                "fallback_rate": (self.fallbacks + self.errors) / self.queries if self.queries else 0.0,
+                "candidates_per_sec": self.candidates / total if total > 0 else 0.0,
+                "latency_ms_mean": float(lat.mean()) if lat.size else 0.0,
+                "latency_ms_p50": float(np.percentile(lat, 50)) if lat.size else 0.0,
+                "latency_ms_p95": float(np.percentile(lat, 95)) if lat.size else 0.0,
+                "top1_changed_rate": self.top1_changed / self.queries if self.queries else 0.0,
+            }
+            if self.judged:
+                out["recall_hit_rate"] = self.recall_hits / self.judged
+                out["rerank_hit_rate"] = self.rerank_hits / self.judged
+            return out
+
+    def report(self) -> str:
+        s = self.summary()
+        lines = [
+            f"重排查询 {s['queries']} 个：完成 {s['reranked']}，超时回退 {s['fallbacks']}，异常回退 {s['errors']}",
+            f"耗时 mean/p50/p95 = {s['latency_ms_mean']:.1f}/{s['latency_ms_p50']:.1f}/{s['latency_ms_p95']:.1f} ms，"
+            f"{s['candidates_per_sec']:.0f} 候选/s，第一名改变比例 {s['top1_changed_rate']:.1%}",
+        ]
+        if "recall_hit_rate" in s:
+            lines.append(f"hit@k：召回顺序 {s['recall_hit_rate']:.1%} -> 重排后 {s['rerank_hit_rate']:.1%}")
+        return "\n".join(lines)
+
+
+class RerankStage:
+    """
+    召回与生成之间的重排阶段：对召回的前 top_m 个候选分批打分，按分数重新取 top_k
+    每个查询有时间预算：下一批预计超出预算或打分未能在预算内完成时，回退到召回顺序
+    """
+    def __init__(self, reranker: Reranker, top_m: int = 50, time_budget: float = None, batch_size: int = None):
+        """
+        :param reranker: 打分器，见 create_reranker
+        :param top_m: 参与重排的召回候选数
+        :param time_budget: 每个查询的重排时间预算（秒），None/0 表示不限
+        :param batch_size: 每批送入打分器的候选数，默认沿用打分器的 batch_size
+        """
+        self.reranker = reranker
+        self.top_m = top_m
+        self.time_budget = time_budget
+        self.batch_size = batch_size or reranker.batch_size
+        self.stats = RerankStats()
+
+    def rerank(self, query: str, candidates: List[Dict[str, Any]], top_k: int,
+               is_relevant: Callable[[Dict[str, Any]], bool] = None) -> List[Dict[str, Any]]:
+        """
+        :param candidates: 召回结果（按召回顺序），只取前 top_m 个参与重排
+        :param is_relevant: 可选，判断 chunk 是否相关，用于统计重排前后的 hit@k
+        :return: 重排后的前 top_k 个 chunk；超时或异常时为召回顺序的前 top_k 个
+        """
+        t0 = time.perf_counter()
+        candidates = candidates[:self.top_m]
+        n = len(candidates)
+        scores = np.empty(n, dtype=np.float32)
+        scored = 0
+        outcome = "reranked"
+        try:
+            for start in range(0, n, self.batch_size):
+                elapsed = time.perf_counter() - t0
+                # 按已完成批次的平均耗时预估下一批，预计超时则不再打分
+                if self.time_budget and scored and elapsed + elapsed / (start // self.batch_size) > self.time_budget:
+                    outcome = "fallback"
+                    break
+                batch = candidates[start:start + self.batch_size]
+                scores[start:start + len(batch)] = self.reranker.score(query, [c['content'] for c in batch])
+                scored += len(batch)
+            if outcome == "reranked" and self.time_budget and time.perf_counter() - t0 > self.time_budget:
+                outcome = "fallback"
+        except Exception as e:
+            print(f"重排失败，回退到召回顺序: {e}")
+            outcome = "error"
+        if outcome == "reranked":
+            # 同分时保持召回顺序
+            order = np.lexsort((np.arange(n), -scores))[:top_k]
+            results = [candidates[i] for i in order]
+        else:
+            results = candidates[:top_k]
+        recall_hit = rerank_hit = None
+        if is_relevant is not None:
+            recall_hit = any(is_relevant(c) for c in candidates[:top_k])
+            rerank_hit = any(is_relevant(c) for c in results)
+        top1_changed = bool(results) and results[0] is not candidates[0]
+        self.stats.record(time.perf_counter() - t0, scored, outcome, top1_changed, recall_hit, rerank_hit)
+        return results
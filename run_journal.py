@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import hashlib
+import textwrap
+import threading
+from typing import Any, Dict, Iterable, Iterator, Tuple
+
+# 批量评测的逐题日志：每完成一题追加一行 JSON {"idx", "status", "result"} 并落盘，
+# 同一 idx 以最后一条为准；旁边的 manifest 记录运行配置与进度，--resume 时据此跳过已答题目
+MANIFEST_SUFFIX = ".manifest.json"
+MANIFEST_EVERY = 10  # 每追加多少条刷新一次 manifest 中的进度
+
+
+def file_sha1(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _write_json_atomic(path: str, obj: Any):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def write_json_array(path: str, items: Iterable[Any]):
+    """
+    逐条写出 JSON 数组（格式同 json.dump(list, indent=2)），先写临时文件再替换，中断不会留下半个文件
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write("[")
+        n = 0
+        for item in items:
+            text = json.dumps(item, ensure_ascii=False, indent=2)
+            f.write(("," if n else "") + "\n" + textwrap.indent(text, "  "))
+            n += 1
+        f.write("\n]" if n else "]")
+    os.replace(tmp, path)
+
+
+class RunJournal:
+    """
+    崩溃安全的 JSONL 结果日志，只在内存中保留 idx -> (状态, 文件偏移)，结果按需从文件读取
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.manifest_path = path + MANIFEST_SUFFIX
+        self.manifest: Dict[str, Any] = {}
+        self._entries: Dict[int, Tuple[str, int]] = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._appended = 0
+
+    # ---- 打开 ----
+    @classmethod
+    def start(cls, path: str, config: Dict[str, Any]) -> "RunJournal":
+        """
+        新建一次运行：清空已有日志，写入 manifest
+        :param config: 运行配置（题库路径与哈希、选中的题目序号、top_k 等），恢复时用于校验
+        """
+        journal = cls(path)
+        open(path, "w", encoding="utf-8").close()
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+        journal.manifest = {"config": config, "started_at": now, "updated_at": now, "resumes": 0,
+                            "status": "running", "answered": 0, "failed": 0}
+        journal._write_manifest()
+        return journal
+
+    @classmethod
+    def resume(cls, path: str, config: Dict[str, Any] = None) -> "RunJournal":
+        """
+        恢复已有运行：读取日志（截掉崩溃时写了一半的末行），校验配置一致
+        :param config: 可选，本次运行配置；与 manifest 中记录的不一致时报错，避免混入不同题库的结果
+        """
+        journal = cls(path)
+        if not os.path.exists(path) or not os.path.exists(journal.manifest_path):
+            raise FileNotFoundError(f"找不到可恢复的运行日志: {path}（及 {journal.manifest_path}）")
+        with open(journal.manifest_path, "r", encoding="utf-8") as f:
+            journal.manifest = json.load(f)
+        if config is not None:
+            recorded = journal.manifest.get("config", {})
+            diff = [k for k in config if k in recorded and recorded[k] != config[k]]
+            if diff:
+                raise ValueError(f"运行配置与日志记录不一致，无法恢复: {diff}")
+        journal._scan()
+        journal.manifest["resumes"] = journal.manifest.get("resumes", 0) + 1
+        journal.manifest["status"] = "running"
+        journal._write_manifest()
+        return journal
+
+    def _scan(self):
+        # 读取全部记录的状态与偏移；末尾不完整或无法解析的行视为崩溃残留并截掉
+        good_end = 0
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    break
+                self._entries[int(rec["idx"])] = (rec["status"], offset)
+                offset += len(line)
+                good_end = offset
+        if os.path.getsize(self.path) != good_end:
+            print(f"运行日志末尾有不完整的记录，已截断到 {good_end} 字节")
+            with open(self.path, "r+b") as f:
+                f.truncate(good_end)
+
+    # ---- 写入 ----
+    def append(self, idx: int, result: Dict[str, Any], status: str = "ok"):
+        """
+        追加一条结果并 fsync，进程随时中断也只会丢失正在写的这一行
+        :param status: ok 已回答；failed 请求失败（result 为默认结果），恢复时重试
+        """
+        line = json.dumps({"idx": idx, "status": status, "result": result}, ensure_ascii=False) + "\n"
+        data = line.encode("utf-8")
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "ab")
+            offset = self._file.tell()
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._entries[idx] = (status, offset)
+            self._appended += 1
+            if self._appended % MANIFEST_EVERY == 0:
+                self._write_manifest()
+
+    def close(self, status: str = None):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        if status:
+            self.manifest["status"] = status
+        self._write_manifest()
+
+    def _write_manifest(self):
+        statuses = [s for s, _ in self._entries.values()]
+        self.manifest.update({
+            "updated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "answered": statuses.count("ok"),
+            "failed": statuses.count("failed"),
+        })
+        _write_json_atomic(self.manifest_path, self.manifest)
+
+    # ---- 读取 ----
+    def answered(self) -> set:
+        return {idx for idx, (status, _) in self._entries.items() if status == "ok"}
+
+    def failed(self) -> set:
+        return {idx for idx, (status, _) in self._entries.items() if status == "failed"}
+
+    def iter_results(self, include_failed: bool = True) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """按 idx 顺序逐条产出 (idx, result)，一次只读一条"""
+        with open(self.path, "rb") as f:
+            for idx in sorted(self._entries):
+                status, offset = self._entries[idx]
+                if status != "ok" and not include_failed:
+                    continue
+                f.seek(offset)
+                yield idx, json.loads(f.readline())["result"]
+
+    def compact_raw(self, out_path: str):
+        """
+        把日志压实为 [[idx, result], ...] 的 JSON 数组（每题只保留最后一条），逐条写出不占内存
+        """
+        write_json_array(out_path, (list(item) for item in self.iter_results()))
+
+    def summary(self) -> Dict[str, int]:
+        statuses = [s for s, _ in self._entries.values()]
+        return {"answered": statuses.count("ok"), "failed": statuses.count("failed")}
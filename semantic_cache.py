@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import asyncio
+import threading
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import numpy as np
+
+# 语义答案缓存：问题向量相似度达到阈值且识别出的公司/年份一致时复用之前的回答
+# 阈值、TTL、容量与审计日志路径由 SEMANTIC_CACHE_THRESHOLD / _TTL / _MAX_ENTRIES / _AUDIT 配置
+DEFAULT_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+DEFAULT_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+DEFAULT_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "10000"))
+DEFAULT_AUDIT_PATH = os.getenv(
+    "SEMANTIC_CACHE_AUDIT",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "semantic_cache_audit.jsonl")
+)
+BORDERLINE_MARGIN = 0.02  # 相似度高于阈值不足该值的命中标记为 borderline，优先人工复核
+
+
+class SemanticAnswerCache:
+    """
+    按实体键（公司+年份等）分桶保存 (问题向量, 回答)，桶内余弦相似度最高且 >= threshold 时命中
+    exact_only 时（如未识别出公司的问题）只允许完全相同的问题文本命中，避免跨公司误复用
+    每次命中都写一行审计日志（问题、被复用的问题、相似度、是否 borderline），用于排查误命中
+    """
+    def __init__(self, threshold: float = None, ttl: float = None, max_entries: int = None,
+                 audit_path: Optional[str] = DEFAULT_AUDIT_PATH):
+        """
+        :param threshold: 余弦相似度阈值（问题向量已归一化时即内积）
+        :param ttl: 条目存活秒数，过期后不再命中并被清理；0 表示不过期
+        :param max_entries: 条目上限，超出时淘汰最早写入的
+        :param audit_path: 命中审计日志（JSONL），None 表示不写文件
+        """
+        self.threshold = threshold if threshold is not None else DEFAULT_THRESHOLD
+        self.ttl = ttl if ttl is not None else DEFAULT_TTL
+        self.max_entries = max_entries or DEFAULT_MAX_ENTRIES
+        self.audit_path = audit_path
+        self._lock = threading.Lock()
+        # 实体键 -> {"vecs": [向量], "items": [(写入时间, 问题, 回答)]}
+        self._buckets: Dict[str, Dict[str, list]] = {}
+        self._order: deque = deque()  # (写入时间, 实体键)，用于容量淘汰
+        self.lookups = 0
+        self.hits = 0
+        self.borderline = 0
+        self.expired = 0
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def _expire(self, now: float):
+        # 持锁调用：按写入顺序清理过期及超出容量的条目
+        while self._order and (len(self._order) > self.max_entries
+                               or (self.ttl and now - self._order[0][0] > self.ttl)):
+            created, key = self._order.popleft()
+            bucket = self._buckets[key]
+            bucket["vecs"].pop(0)
+            bucket["items"].pop(0)
+            if not bucket["items"]:
+                del self._buckets[key]
+            self.expired += 1
+
+    def lookup(self, question: str, q_vec: np.ndarray, entity_key: str,
+               exact_only: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        :param q_vec: 归一化后的问题向量
+        :param entity_key: 识别出的公司/年份等必须完全一致的部分
+        :param exact_only: 只认完全相同的问题文本
+        :return: 命中时返回之前的回答（question 换成当前问题），否则 None
+        """
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            self.lookups += 1
+            bucket = self._buckets.get(entity_key)
+            if bucket is None:
+                return None
+            if exact_only:
+                pos = next((i for i, it in enumerate(bucket["items"]) if it[1] == question), None)
+                if pos is None:
+                    return None
+                sim = 1.0
+            else:
+                sims = np.stack(bucket["vecs"]).astype(np.float32) @ q_vec.astype(np.float32)
+                pos = int(np.argmax(sims))
+                sim = float(sims[pos])
+                if sim < self.threshold:
+                    return None
+            _, cached_question, result = bucket["items"][pos]
+            self.hits += 1
+            borderline = sim < self.threshold + BORDERLINE_MARGIN and cached_question != question
+            self.borderline += borderline
+        self._audit({"time": time.strftime("%Y-%m-%d %H:%M:%S"), "question": question,
+                     "matched_question": cached_question, "similarity": round(sim, 4),
+                     "entity": entity_key, "borderline": borderline, "answer": result.get("answer")})
+        return dict(result, question=question)
+
+    def put(self, question: str, q_vec: np.ndarray, entity_key: str, result: Dict[str, Any]):
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.setdefault(entity_key, {"vecs": [], "items": []})
+            bucket["vecs"].append(np.asarray(q_vec, dtype=np.float32))
+            bucket["items"].append((now, question, result))
+            self._order.append((now, entity_key))
+            self._expire(now)
+
+    def _audit(self, record: Dict[str, Any]):
+        if not self.audit_path:
+            return
+        with self._lock:
+            with open(self.audit_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "borderline_hits": self.borderline,
+            "expired": self.expired,
+        }
+
+    def report(self) -> str:
+        s = self.stats()
+        audit = f"，审计日志 {self.audit_path}" if self.audit_path else ""
+        return (f"语义答案缓存：查询 {s['lookups']}，命中 {s['hits']}（{s['hit_rate']:.1%}），"
+                f"其中临界命中 {s['borderline_hits']} 需复核，过期淘汰 {s['expired']}，当前 {s['entries']} 条{audit}")
+
+
+class InflightCoalescer:
+    """
+    合并并发的相同请求：同一 key 同时只执行一次，其余调用方等待并共享结果（或异常）
+    同步（线程）与异步（asyncio）调用分别合并
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sync: Dict[Any, list] = {}
+        self._async: Dict[Any, asyncio.Future] = {}
+        self.coalesced = 0
+
+    def run(self, key: Any, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            entry = self._sync.get(key)
+            leader = entry is None
+            if leader:
+                entry = [threading.Event(), None, None]  # 完成事件, 结果, 异常
+                self._sync[key] = entry
+            else:
+                self.coalesced += 1
+        if not leader:
+            entry[0].wait()
+            if entry[2] is not None:
+                raise entry[2]
+            return entry[1]
+        try:
+            entry[1] = fn()
+            return entry[1]
+        except BaseException as e:
+            entry[2] = e
+            raise
+        finally:
+            with self._lock:
+                del self._sync[key]
+            entry[0].set()
+
+    async def run_async(self, key: Any, fn: Callable[[], Awaitable[Any]]) -> Any:
+        fut = self._async.get(key)
+        if fut is not None:
+            self.coalesced += 1
+            # shield：等待方被取消不影响正在执行的请求
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        # 没有等待方时也标记异常已读取，避免 "exception was never retrieved" 警告
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._async[key] = fut
+        try:
+            result = await fn()
+            fut.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            del self._async[key]
@@ -0,0 +1,112 @@
+import os
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+from topk import topk_indices_2d, merge_topk
+
+SHARD_BLOCK_ROWS = 65536  # float16 分片按块转 float32 计算的行数
+SHARD_MAX_SCORES = 1 << 24  # 每个分片单次相似度块的最大元素数
+# 每个 worker 只用单线程 BLAS，并行度由进程数决定，避免线程超额订阅
+_BLAS_THREAD_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+_worker: Dict[str, Any] = {}  # worker 进程内的共享矩阵
+
+
+def _init_worker(spec: Dict[str, Any]):
+    if spec["kind"] == "mmap":
+        matrix = np.memmap(spec["path"], dtype=spec["dtype"], mode="r", offset=spec["offset"], shape=spec["shape"])
+    else:
+        shm = shared_memory.SharedMemory(name=spec["name"])
+        _worker["shm"] = shm  # 保持引用，进程存活期间映射有效
+        matrix = np.ndarray(spec["shape"], dtype=spec["dtype"], buffer=shm.buf)
+    _worker["matrix"] = matrix
+
+
+def _shard_scores(shard: np.ndarray, queries: np.ndarray, single: bool) -> np.ndarray:
+    # 与 SimpleVectorStore 单进程的计算方式一致（单查询矩阵乘向量、多查询矩阵乘矩阵），保证分数逐位相同
+    if shard.dtype == np.float32:
+        return (shard @ queries[0])[None, :] if single else queries @ shard.T
+    sims = np.empty((len(queries), len(shard)), dtype=np.float32)
+    for i in range(0, len(shard), SHARD_BLOCK_ROWS):
+        block = np.asarray(shard[i:i + SHARD_BLOCK_ROWS], dtype=np.float32)
+        sims[:, i:i + len(block)] = (block @ queries[0])[None, :] if single else queries @ block.T
+    return sims
+
+
+def _search_shard(args) -> Tuple[np.ndarray, np.ndarray]:
+    lo, hi, queries, top_k, single = args
+    shard = _worker["matrix"][lo:hi]
+    idxs, scores = [], []
+    block = max(1, SHARD_MAX_SCORES // max(1, hi - lo))
+    for i in range(0, len(queries), block):
+        sims = _shard_scores(shard, queries[i:i + block], single)
+        top = topk_indices_2d(sims, top_k)
+        idxs.append(top + lo)
+        scores.append(np.take_along_axis(sims, top, axis=1))
+    return np.concatenate(idxs), np.concatenate(scores)
+
+
+class ShardedSearcher:
+    """
+    多进程分片暴力检索：矩阵按行切成若干分片，worker 进程通过内存映射文件或共享内存读取（不复制），
+    各分片返回局部 top-k，由协调进程合并为全局 top-k；top-k 规则见 topk.py，结果与单进程一致
+    """
+    def __init__(self, matrix: np.ndarray, n_workers: int, n_shards: int = None):
+        """
+        :param matrix: (N, dim) 已归一化矩阵；np.load(mmap_mode='r') 得到的内存映射直接共享文件，
+                       否则复制一份到共享内存
+        :param n_workers: worker 进程数
+        :param n_shards: 分片数，默认等于 n_workers
+        """
+        self.n_workers = n_workers
+        self.n_rows = len(matrix)
+        n_shards = max(1, min(n_shards or n_workers, self.n_rows))
+        self.bounds = np.linspace(0, self.n_rows, n_shards + 1).astype(np.int64)
+        self._shm: Optional[shared_memory.SharedMemory] = None
+        if isinstance(matrix, np.memmap) and matrix.filename and matrix.flags.c_contiguous:
+            spec = {"kind": "mmap", "path": matrix.filename, "offset": matrix.offset}
+        else:
+            self._shm = shared_memory.SharedMemory(create=True, size=max(1, matrix.nbytes))
+            np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=self._shm.buf)[:] = matrix
+            spec = {"kind": "shm", "name": self._shm.name}
+        spec.update(dtype=str(matrix.dtype), shape=tuple(matrix.shape))
+        saved = {k: os.environ.get(k) for k in _BLAS_THREAD_VARS}
+        os.environ.update({k: "1" for k in _BLAS_THREAD_VARS})
+        try:
+            # spawn 启动的 worker 在导入 numpy 前读取上面的线程数设置
+            self._pool = mp.get_context("spawn").Pool(n_workers, initializer=_init_worker, initargs=(spec,))
+        finally:
+            for k, v in saved.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+
+    def search(self, queries: np.ndarray, top_k: int, single: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param queries: (Q, dim) 已归一化的 float32 查询矩阵
+        :param single: 单查询（Q=1）时按矩阵乘向量计算，与单进程 _scores 一致
+        :return: (Q, min(top_k, N)) 的全局行号与分数
+        """
+        tasks = [(int(lo), int(hi), queries, top_k, single) for lo, hi in zip(self.bounds[:-1], self.bounds[1:])]
+        parts = self._pool.map(_search_shard, tasks)
+        idxs = np.concatenate([p[0] for p in parts], axis=1)
+        scores = np.concatenate([p[1] for p in parts], axis=1)
+        return merge_topk(idxs, scores, top_k)
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
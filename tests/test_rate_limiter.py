@@ -0,0 +1,47 @@
+import os
+import sys
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rate_limiter import RateLimiter
+
+
+@pytest.mark.parametrize("tpm", [None, 1_000_000])
+def test_set_tokens_counts_actual_once(tpm):
+    limiter = RateLimiter("test", tpm=tpm)
+    with limiter.acquire(100) as permit:
+        permit.set_tokens(80)
+    assert limiter.stats()["tokens"] == 80
+    with limiter.acquire(100) as permit:
+        permit.set_tokens(130)
+    assert limiter.stats()["tokens"] == 210
+
+
+@pytest.mark.parametrize("tpm", [None, 1_000_000])
+def test_set_tokens_counts_actual_once_async(tpm):
+    limiter = RateLimiter("test", tpm=tpm)
+
+    async def run():
+        async with limiter.acquire_async(100) as permit:
+            permit.set_tokens(80)
+
+    asyncio.run(run())
+    assert limiter.stats()["tokens"] == 80
+
+
+def test_set_tokens_settles_tpm_bucket():
+    limiter = RateLimiter("test", tpm=1000)
+    with limiter.acquire(100) as permit:
+        permit.set_tokens(80)
+    # 预扣 100、实际 80，桶内应只少 80（允许按时间回填的微小误差）
+    assert limiter._tpm._level == pytest.approx(920, abs=1)
+
+
+def test_without_set_tokens_uses_estimate():
+    limiter = RateLimiter("test")
+    with limiter.acquire(50):
+        pass
+    assert limiter.stats()["tokens"] == 50
@@ -0,0 +1,103 @@
+"""
+IVF 近似检索 recall@k 报告：与精确（flat）检索对比不同 nprobe 下的召回率与查询延迟，用于选择参数
+
+使用方法：
+    # 合成的聚类数据
+    python tools/bench_ann_recall.py --n 200000 --dim 256
+    # 真实语料（用离线 hash 后端嵌入，问题集作为查询）
+    python tools/bench_ann_recall.py --chunks all_pdf_page_chunks_merged.json --queries-json datas/test_advanced_250.json
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+# 添加父目录到路径以便导入
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from rag_from_page_chunks_original import SimpleVectorStore
+from ann_index import pad_ids, recall_at_k, short_results
+
+
+def synthetic_clustered(n: int, dim: int, n_queries: int, n_centers: int = 512, seed: int = 0):
+    # 高斯混合数据：比纯随机向量更接近真实 embedding 的聚簇结构
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_centers, dim), dtype=np.float32)
+    labels = rng.integers(0, n_centers, size=n + n_queries)
+    data = centers[labels] + 0.6 * rng.standard_normal((n + n_queries, dim), dtype=np.float32)
+    return data[:n], data[n:]
+
+
+def load_corpus(args):
+    if not args.chunks:
+        return synthetic_clustered(args.n, args.dim, args.queries)
+    from embedding_backends import HashEmbeddingBackend
+    backend = HashEmbeddingBackend(dim=args.dim)
+    with open(args.chunks, 'r', encoding='utf-8') as f:
+        chunks = json.load(f)
+    emb = backend.embed([c['content'] for c in chunks])
+    if args.queries_json:
+        with open(args.queries_json, 'r', encoding='utf-8') as f:
+            questions = [x['question'] for x in json.load(f)][:args.queries]
+        return emb, backend.embed(questions)
+    rng = np.random.default_rng(0)
+    return emb, emb[rng.choice(len(emb), size=min(args.queries, len(emb)), replace=False)]
+
+
+def run_queries(store, queries, top_k, nprobe=None):
+    ids, costs = [], []
+    for q in queries:
+        t0 = time.perf_counter()
+        hits = store.search_with_scores(q, top_k, nprobe=nprobe)
+        costs.append((time.perf_counter() - t0) * 1000)
+        ids.append([c['metadata']['page'] for c, _ in hits])
+    return pad_ids(ids, top_k), float(np.mean(costs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IVF recall@k vs 精确检索")
+    parser.add_argument("--n", type=int, default=100000, help="合成数据规模")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--nprobes", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument("--chunks", type=str, default=None, help="chunk JSON，提供时用真实语料")
+    parser.add_argument("--queries-json", type=str, default=None, help="问题集 JSON，与 --chunks 配合")
+    args = parser.parse_args()
+
+    emb, queries = load_corpus(args)
+    # 用行号作为 page，便于直接比较结果
+    chunks = [{"content": "", "metadata": {"file_name": "", "page": i}} for i in range(len(emb))]
+    flat = SimpleVectorStore()
+    flat.add_chunks(chunks, emb)
+    exact_ids, flat_ms = run_queries(flat, queries, args.top_k)
+
+    ivf = SimpleVectorStore(index_type='ivf', nlist=args.nlist)
+    ivf.add_chunks(chunks, emb)
+    t0 = time.perf_counter()
+    ann = ivf.ann_index
+    build_s = time.perf_counter() - t0
+    sizes = ann.list_sizes()
+    print(f"N={len(emb)} dim={emb.shape[1]} queries={len(queries)} top_k={args.top_k}")
+    print(f"IVF nlist={ann.nlist} 构建耗时 {build_s:.1f}s，桶大小 min/median/max = "
+          f"{sizes.min()}/{int(np.median(sizes))}/{sizes.max()}")
+    print(f"flat: {flat_ms:.2f} ms/query")
+    # short：返回不足 top_k 条的查询数（探测的桶内行数不够），缺失的条目在 recall 中按未命中计
+    print(f"{'nprobe':>7} {'recall@k':>9} {'ms/query':>9} {'speedup':>8} {'scanned':>8} {'short':>6} {'missing':>8}")
+    for nprobe in args.nprobes:
+        if nprobe > ann.nlist:
+            break
+        approx_ids, ivf_ms = run_queries(ivf, queries, args.top_k, nprobe=nprobe)
+        scanned = np.mean([len(ann.probe(q / (np.linalg.norm(q) + 1e-8), nprobe)) for q in queries]) / len(emb)
+        short = short_results(approx_ids)
+        print(f"{nprobe:>7} {recall_at_k(exact_ids, approx_ids):>9.3f} {ivf_ms:>9.2f} "
+              f"{flat_ms / ivf_ms:>7.1f}x {scanned:>7.1%} {short['queries']:>6} {short['missing']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+大模型客户端连接复用基准：对比“每次请求新建 OpenAI 客户端”（原 generate_answer 的做法）与共享连接池客户端的单请求延迟
+
+使用方法：
+    # 真实接口（读取 .env 中的 LOCAL_API_KEY / LOCAL_BASE_URL / LOCAL_TEXT_MODEL），每次 max_tokens=1
+    python tools/bench_llm_client.py --requests 30
+    # embedding 接口
+    python tools/bench_llm_client.py --endpoint embeddings
+    # 本地模拟服务（纯 HTTP，无 TLS，只能体现 TCP 建连与客户端构造开销；真实 HTTPS 接口节省更多）
+    python tools/bench_llm_client.py --mock --mock-delay-ms 20
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+from openai import OpenAI
+
+# 添加父目录到路径以便导入
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from llm_client import load_llm_config, get_sync_client, close_clients
+
+
+def start_mock_server(delay: float) -> str:
+    # 最小的 OpenAI 兼容接口，支持 HTTP/1.1 keep-alive
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # 头与正文分开写，不关 Nagle 会在 keep-alive 连接上触发 40ms 延迟确认
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(delay)
+            if self.path.endswith("/embeddings"):
+                body = {"object": "list", "model": "mock", "data": [{"object": "embedding", "index": 0,
+                        "embedding": [0.0] * 8}], "usage": {"prompt_tokens": 1, "total_tokens": 1}}
+            else:
+                body = {"id": "x", "object": "chat.completion", "created": 0, "model": "mock",
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": "{}"}}],
+                        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}}
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def one_request(client: OpenAI, endpoint: str, model: str):
+    if endpoint == "embeddings":
+        client.embeddings.create(model=model, input=["连接复用基准"])
+    else:
+        client.chat.completions.create(model=model, messages=[{"role": "user", "content": "你好"}], max_tokens=1)
+
+
+def measure(make_client, endpoint: str, model: str, n: int, fresh: bool):
+    costs = []
+    client = None
+    for _ in range(n):
+        t0 = time.perf_counter()
+        if fresh or client is None:
+            client = make_client()
+        one_request(client, endpoint, model)
+        costs.append((time.perf_counter() - t0) * 1000)
+        if fresh:
+            client.close()  # 原做法不关闭，这里关闭只为避免连接泄漏，不计入耗时
+    return np.asarray(costs[1:] if n > 1 else costs)  # 去掉第一次（共享客户端的首次建连）
+
+
+def main():
+    parser = argparse.ArgumentParser(description="新建客户端 vs 共享连接池的单请求延迟")
+    parser.add_argument("--endpoint", type=str, default="chat", choices=["chat", "embeddings"])
+    parser.add_argument("--requests", type=int, default=30)
+    parser.add_argument("--mock", action="store_true", help="使用本地模拟服务")
+    parser.add_argument("--mock-delay-ms", type=float, default=0, help="模拟服务的处理耗时")
+    args = parser.parse_args()
+
+    if args.mock:
+        os.environ.update(LOCAL_API_KEY="mock", LOCAL_BASE_URL=start_mock_server(args.mock_delay_ms / 1000),
+                          LOCAL_TEXT_MODEL="mock", LOCAL_EMBEDDING_MODEL="mock")
+    config = load_llm_config(reload=True).validate()
+    model = config.embedding_model if args.endpoint == "embeddings" else config.text_model
+    print(f"endpoint={args.endpoint} base_url={config.base_url} requests={args.requests}")
+
+    fresh = measure(lambda: OpenAI(api_key=config.api_key, base_url=config.base_url),
+                    args.endpoint, model, args.requests, fresh=True)
+    pooled = measure(lambda: get_sync_client(), args.endpoint, model, args.requests, fresh=False)
+    close_clients()
+
+    print(f"{'mode':>14} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    for name, costs in (("new client", fresh), ("pooled", pooled)):
+        print(f"{name:>14} {costs.mean():>9.2f} {np.percentile(costs, 50):>9.2f} {np.percentile(costs, 95):>9.2f}")
+    saved = np.percentile(fresh, 50) - np.percentile(pooled, 50)
+    print(f"单请求 p50 节省 {saved:.2f} ms（{saved / np.percentile(fresh, 50) * 100:.0f}%）")
+
+
+if __name__ == "__main__":
+    main()
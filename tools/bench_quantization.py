@@ -0,0 +1,71 @@
+"""
+量化存储评估：对比 float32 / int8 / PQ 的每向量字节数、查询延迟与相对精确检索的 recall@k（含/不含精确重打分）
+
+使用方法：
+    python tools/bench_quantization.py --n 100000 --dim 1024
+    python tools/bench_quantization.py --pq-m 32 64 128 --rerank-k 0 50 200
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+# 添加父目录到路径以便导入
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from rag_from_page_chunks_original import SimpleVectorStore
+from ann_index import pad_ids, recall_at_k
+from bench_ann_recall import synthetic_clustered
+
+
+def run_queries(store, queries, top_k):
+    ids, costs = [], []
+    for q in queries:
+        t0 = time.perf_counter()
+        hits = store.search_with_scores(q, top_k)
+        costs.append((time.perf_counter() - t0) * 1000)
+        ids.append([c['metadata']['page'] for c, _ in hits])
+    return pad_ids(ids, top_k), float(np.mean(costs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="int8 / PQ 量化存储的内存与召回评估")
+    parser.add_argument("--n", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--pq-m", type=int, nargs="+", default=[64, 128])
+    parser.add_argument("--rerank-k", type=int, nargs="+", default=[0, 50, 200])
+    args = parser.parse_args()
+
+    emb, queries = synthetic_clustered(args.n, args.dim, args.queries)
+    chunks = [{"content": "", "metadata": {"file_name": "", "page": i}} for i in range(len(emb))]
+    flat = SimpleVectorStore()
+    flat.add_chunks(chunks, emb)
+    exact_ids, flat_ms = run_queries(flat, queries, args.top_k)
+    float_bytes = flat.embeddings.nbytes / len(emb)
+    print(f"N={args.n} dim={args.dim} queries={args.queries} top_k={args.top_k}")
+    print(f"{'storage':>10} {'rerank_k':>8} {'B/vec':>7} {'ratio':>6} {'build s':>8} {'recall@k':>9} {'ms/query':>9}")
+    print(f"{'float32':>10} {'-':>8} {float_bytes:>7.0f} {1:>5.0f}x {'-':>8} {1.0:>9.3f} {flat_ms:>9.2f}")
+
+    configs = [("int8", None)] + [("pq", m) for m in args.pq_m if args.dim % m == 0]
+    for storage, m in configs:
+        store = SimpleVectorStore(storage=storage, pq_m=m or 64)
+        store.add_chunks(chunks, emb)
+        t0 = time.perf_counter()
+        quantizer = store.quantizer
+        build_s = time.perf_counter() - t0
+        code_bytes = quantizer.code_bytes() / len(emb)
+        name = storage if m is None else f"pq(m={m})"
+        for rerank_k in args.rerank_k:
+            store.rerank_k = rerank_k
+            approx_ids, ms = run_queries(store, queries, args.top_k)
+            print(f"{name:>10} {rerank_k:>8} {code_bytes:>7.0f} {float_bytes / code_bytes:>5.0f}x "
+                  f"{build_s:>8.1f} {recall_at_k(exact_ids, approx_ids):>9.3f} {ms:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+重排阶段评估：用问题集中标准答案的文件名/页码统计召回顺序与重排后的 hit@k，并报告重排耗时与回退比例
+
+使用方法：
+    # 词项覆盖率重排器，离线 hash 嵌入
+    EMBEDDING_BACKEND=hash python tools/bench_rerank.py --reranker lexical
+    # cross-encoder，预算 500ms
+    python tools/bench_rerank.py --reranker cross_encoder --budget-ms 500 --top-m 50
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+# 添加父目录到路径以便导入
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from rag_from_page_chunks_original import SimpleRAG
+
+
+def main():
+    base_dir = Path(__file__).parent.parent
+    parser = argparse.ArgumentParser(description="重排前后 hit@k 与耗时")
+    parser.add_argument("--chunks", type=str, default=str(base_dir / "all_pdf_page_chunks_merged.json"))
+    parser.add_argument("--queries-json", type=str, default=str(base_dir / "datas/test_advanced_250.json"))
+    parser.add_argument("--index-dir", type=str, default=None, help="可选，持久化索引目录")
+    parser.add_argument("--reranker", type=str, default=None, help="cross_encoder/lexical/stub，默认读取 RERANKER")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--top-m", type=int, default=50)
+    parser.add_argument("--budget-ms", type=float, default=0, help="每个查询的重排时间预算，0 表示不限")
+    parser.add_argument("--limit", type=int, default=None, help="只评估前 N 个问题")
+    args = parser.parse_args()
+
+    with open(args.queries_json, 'r', encoding='utf-8') as f:
+        items = [x for x in json.load(f) if x.get('filename')][:args.limit]
+    rag = SimpleRAG(args.chunks, index_dir=args.index_dir, use_rerank=True, reranker=args.reranker,
+                    rerank_top_m=args.top_m, rerank_budget_ms=args.budget_ms)
+    try:
+        rag.setup()
+        stage = rag.rerank_stage
+        # 召回与重排分开调用，召回时间不计入重排耗时
+        rag.rerank_stage = None
+        for item in items:
+            candidates = rag.retrieve(item['question'], top_k=args.top_m)
+            gold = (item['filename'], str(item['page']))
+            stage.rerank(item['question'], candidates, args.top_k,
+                         is_relevant=lambda c: (c['metadata']['file_name'], str(c['metadata']['page'])) == gold)
+        print(f"问题 {len(items)} 个，top_k={args.top_k} top_m={args.top_m} 重排器={stage.reranker.name}")
+        print(stage.stats.report())
+    finally:
+        rag.close()
+
+
+if __name__ == "__main__":
+    main()
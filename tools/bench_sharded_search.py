@@ -0,0 +1,91 @@
+"""
+多进程分片检索扩展性基准：不同库规模下 1/2/4/8 个 worker 的单查询延迟与批量吞吐，并校验结果与单进程完全一致
+
+使用方法：
+    python tools/bench_sharded_search.py
+    python tools/bench_sharded_search.py --sizes 100000 500000 --dim 1024 --workers 1 2 4 8
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+# 添加父目录到路径以便导入
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import rag_from_page_chunks_original as rag_module
+from rag_from_page_chunks_original import SimpleVectorStore
+
+
+def time_single(fn, queries) -> float:
+    # 单查询延迟中位数（毫秒）
+    costs = []
+    for q in queries:
+        t0 = time.perf_counter()
+        fn(q)
+        costs.append((time.perf_counter() - t0) * 1000)
+    return float(np.median(costs))
+
+
+def time_batch(fn, queries) -> float:
+    # 批量检索吞吐（查询/秒）
+    t0 = time.perf_counter()
+    fn(queries)
+    return len(queries) / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分片检索 worker 数扩展性")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50000, 200000, 500000])
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--queries", type=int, default=20, help="单查询延迟测试的查询数")
+    parser.add_argument("--batch", type=int, default=256, help="批量吞吐测试的查询数")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16"])
+    args = parser.parse_args()
+    rag_module.SHARD_MIN_ROWS = 0  # 基准中所有规模都启用分片
+
+    rng = np.random.default_rng(0)
+    print(f"dim={args.dim} dtype={args.dtype} top_k={args.top_k} CPU={os.cpu_count()}")
+    print(f"{'N':>9} {'mode':>9} {'single ms':>10} {'speedup':>8} {'batch q/s':>10} {'speedup':>8} {'identical':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in args.sizes:
+            emb = rng.standard_normal((n, args.dim), dtype=np.float32)
+            queries = rng.standard_normal((args.batch, args.dim), dtype=np.float32)
+            queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+            store = SimpleVectorStore(dtype=args.dtype)
+            store.add_chunks([{"content": "", "metadata": {"file_name": "", "page": i}} for i in range(n)], emb)
+            del emb
+            # 与实际部署相同：保存后内存映射加载，worker 共享同一个文件
+            index_dir = os.path.join(tmp, str(n))
+            store.save(index_dir)
+            store = SimpleVectorStore.load(index_dir)
+            single_q = queries[:args.queries]
+            base_single = base_batch = base_ms = base_qps = None
+            for w in args.workers:
+                # workers=1 为单进程检索，作为对照
+                store.close()
+                store.search_workers = w
+                store.search_rows(single_q[0], args.top_k)  # 预热：启动 worker、映射文件
+                single = [store.search_rows(q, args.top_k) for q in single_q]
+                batch = store.search_batch_rows(queries, args.top_k)
+                ms = time_single(lambda q: store.search_rows(q, args.top_k), single_q)
+                qps = time_batch(lambda qs: store.search_batch_rows(qs, args.top_k), queries)
+                if base_single is None:
+                    base_single, base_batch, base_ms, base_qps = single, batch, ms, qps
+                identical = all(np.array_equal(a[0], b[0]) and np.array_equal(a[1], b[1])
+                                for a, b in zip(base_single + base_batch, single + batch))
+                mode = "inproc" if w <= 1 else f"{w} proc"
+                print(f"{n:>9} {mode:>9} {ms:>10.2f} {base_ms / ms:>7.1f}x {qps:>10.0f} "
+                      f"{qps / base_qps:>7.1f}x {str(identical):>9}")
+            store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+向量检索微基准：比较旧实现（每次查询从 Python 列表重建矩阵、重算范数、全量排序）
+与 SimpleVectorStore（预归一化矩阵 + argpartition top-k）在不同库规模下的单次查询延迟
+
+使用方法：
+    python tools/bench_vector_search.py
+    python tools/bench_vector_search.py --sizes 1000 10000 100000 --dim 1024 --queries 50
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+# 添加父目录到路径以便导入
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from rag_from_page_chunks_original import SimpleVectorStore
+
+
+def legacy_search(embeddings_list, query_embedding, top_k):
+    # 与改造前 SimpleVectorStore.search 相同的计算方式
+    emb_matrix = np.array(embeddings_list)
+    query_emb = np.array(query_embedding)
+    sims = emb_matrix @ query_emb / (np.linalg.norm(emb_matrix, axis=1) * np.linalg.norm(query_emb) + 1e-8)
+    idxs = sims.argsort()[::-1][:top_k]
+    return idxs
+
+
+def time_queries(fn, queries) -> float:
+    # 返回单次查询延迟的中位数（毫秒）
+    costs = []
+    for q in queries:
+        t0 = time.perf_counter()
+        fn(q)
+        costs.append((time.perf_counter() - t0) * 1000)
+    return float(np.median(costs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SimpleVectorStore 查询延迟 vs 库规模")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000, 100000])
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--legacy-max", type=int, default=50000, help="超过该规模时跳过旧实现（太慢且占内存）")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"dim={args.dim} top_k={args.top_k} queries={args.queries}")
+    print(f"{'N':>10} {'legacy(ms)':>12} {'store(ms)':>10} {'speedup':>8} {'store MB':>9}")
+    for n in args.sizes:
+        emb = rng.standard_normal((n, args.dim), dtype=np.float32)
+        queries = rng.standard_normal((args.queries, args.dim), dtype=np.float32)
+        store = SimpleVectorStore()
+        store.add_chunks([{"content": "", "metadata": {"file_name": "", "page": i}} for i in range(n)], emb)
+        store.search(queries[0], args.top_k)  # 预热：合并归一化矩阵
+        new_ms = time_queries(lambda q: store.search(q, args.top_k), queries)
+        if n <= args.legacy_max:
+            emb_list = emb.tolist()
+            old_ms = time_queries(lambda q: legacy_search(emb_list, q.tolist(), args.top_k), queries)
+            del emb_list
+            old_str, speedup = f"{old_ms:.2f}", f"{old_ms / new_ms:.1f}x"
+        else:
+            old_str, speedup = "skip", "-"
+        print(f"{n:>10} {old_str:>12} {new_ms:>10.2f} {speedup:>8} {store.embeddings.nbytes / 1e6:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
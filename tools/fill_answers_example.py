@@ -40,21 +40,23 @@ def main():
     for qtype, count in sorted(type_counts.items()):
         print(f"  {qtype}: {count}题")
     
-    # ====== 方式1: 使用 rag_from_page_chunks.py 中的 SimpleRAG ======
+    # ====== 方式1: 使用 rag_from_page_chunks_original.py 中的 SimpleRAG ======
     try:
-        from rag_from_page_chunks import SimpleRAG
+        from rag_from_page_chunks_original import SimpleRAG
         
         print("\n初始化RAG系统...")
         # 根据您的配置调整参数
         chunk_json_path = str(BASE_DIR / "all_pdf_page_chunks_merged.json")
         rag = SimpleRAG(
             chunk_json_path=chunk_json_path,
-            use_rerank=True,  # 使用重排序
+            retrieval_mode='hybrid',  # 向量 + BM25 召回后 RRF 融合
+            use_rerank=True,  # 使用重排序，重排器由 RERANKER 配置
             recall_top_m_vec=50,
             recall_top_m_bm25=50
         )
         rag.setup()
         
+        rag.prepare_queries([item['question'] for item in test_data])  # 全部问题一次批量嵌入，生成时复用
         print("\n开始生成答案（可能需要较长时间）...")
         for item in tqdm(test_data, desc="生成答案"):
             try:
@@ -81,9 +83,11 @@ def main():
         print(f"\n生成统计:")
         print(f"  成功生成答案: {answered}/{len(test_data)}题")
         print(f"  失败/空答案: {len(test_data)-answered}题")
+        if rag.rerank_stage is not None:
+            print(rag.rerank_stage.stats.report())
         
     except ImportError:
-        print("\n[ERROR] 未找到 rag_from_page_chunks.py 或其依赖")
+        print("\n[ERROR] 未找到 rag_from_page_chunks_original.py 或其依赖")
         print("请确保已安装所需依赖并正确配置 .env 文件")
         print("\n备选方案：手动实现RAG逻辑或使用其他检索系统")
         return
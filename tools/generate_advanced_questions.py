@@ -1,11 +1,14 @@
 import json
-import re
+import sys
 from pathlib import Path
 from collections import defaultdict, Counter
-from typing import Dict, List, Tuple
+from typing import Dict, List
 
 
 BASE_DIR = Path(__file__).resolve().parent.parent
+# 添加父目录到路径以便导入
+sys.path.insert(0, str(BASE_DIR))
+from report_meta import extract_company_and_year
 MERGED = (BASE_DIR / "all_pdf_page_chunks_merged.json").resolve()
 PDF_DIR = (BASE_DIR / "datas/年报").resolve()
 OUT = (BASE_DIR / "datas/test_advanced_250.json").resolve()
@@ -46,39 +49,6 @@ def group_pages_by_file(chunks: List[Dict]) -> Dict[str, Dict[int, str]]:
     return out
 
 
-def extract_company_and_year(filename: str) -> Tuple[str, str]:
-    stem = Path(filename).stem
-    parts = stem.split("-")
-    # 规则：优先选择包含中文、且不含“年度报告/审计报告/摘要”的片段，
-    # 同时排除形如“600030.SH”或纯数字、日期段
-    def is_candidate(s: str) -> bool:
-        if not re.search(r"[\u4e00-\u9fff]", s):
-            return False
-        if any(x in s for x in ["年度报告", "审计报告", "摘要"]):
-            return False
-        if re.match(r"^\d{6}\.[A-Z]{2,}$", s):
-            return False
-        if re.match(r"^\d{4}$", s):
-            return False
-        if re.match(r"^\d{2}$", s):
-            return False
-        return True
-
-    candidates = [p for p in parts if is_candidate(p)]
-    if candidates:
-        # 选择中文字符数最多的片段作为公司名
-        company = max(candidates, key=lambda x: len(re.findall(r"[\u4e00-\u9fff]", x)))
-    elif len(parts) >= 5:
-        company = parts[4]
-    else:
-        company = stem
-
-    # 报告年度：匹配“(\d{4})年?年度报告”
-    m = re.search(r"(\d{4})年?年度报告", filename)
-    year = m.group(1) if m else ""
-    return company, year
-
-
 CATEGORY_KEYWORDS: Dict[str, List[str]] = {
     "管理层讨论": ["管理层讨论", "讨论与分析", "经营情况", "经营回顾"],
     "风险因素": ["风险", "不确定", "风险提示"],
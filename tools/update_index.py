@@ -0,0 +1,65 @@
+"""
+增量更新持久化索引：新增/替换/删除某几份报告，不重新嵌入整个语料
+
+使用方法：
+    # 新增或替换报告（chunk JSON 格式同 all_pdf_page_chunks_merged.json，可包含多份报告）
+    python tools/update_index.py --add new_report_chunks.json
+    # 删除报告
+    python tools/update_index.py --delete "2024-03-28-601398.SH-工商银行-601398工商银行2023年度报告.pdf"
+    # 把累积的增量合并进语料 JSON 并全量重写索引
+    python tools/update_index.py --compact
+
+语料变化以报告为单位追加到语料 JSON 旁的 .updates.jsonl，索引只追加新增行与删除行号，
+都不重写整个语料；manifest 中的语料哈希随之更新，之后 SimpleRAG.setup() 会直接加载更新后的索引
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+# 添加父目录到路径以便导入
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from rag_from_page_chunks_original import SimpleRAG
+
+
+def main():
+    base_dir = Path(__file__).parent.parent
+    parser = argparse.ArgumentParser(description="按报告增量更新向量索引")
+    parser.add_argument("--corpus", type=str, default=str(base_dir / "all_pdf_page_chunks_merged.json"))
+    parser.add_argument("--index-dir", type=str, default=str(base_dir / "rag_index"))
+    parser.add_argument("--add", type=str, nargs="*", default=[], help="新增/替换报告的 chunk JSON 文件")
+    parser.add_argument("--delete", type=str, nargs="*", default=[], help="要删除的报告 file_name")
+    parser.add_argument("--compact", action="store_true", help="合并增量日志到语料 JSON，并全量重写索引")
+    args = parser.parse_args()
+
+    rag = SimpleRAG(args.corpus, index_dir=args.index_dir)
+    rag.setup()  # 索引与语料一致时直接加载
+
+    new_by_file = {}
+    for path in args.add:
+        with open(path, 'r', encoding='utf-8') as f:
+            for c in json.load(f):
+                new_by_file.setdefault(c['metadata']['file_name'], []).append(c)
+    for file_name, chunks in new_by_file.items():
+        rag.upsert_report(file_name, chunks)
+    for file_name in args.delete:
+        rag.delete_report(file_name)
+
+    # 语料变化追加到增量日志，顺序与上面对索引的操作一致
+    for file_name, chunks in new_by_file.items():
+        rag.loader.append_update('upsert', file_name, chunks)
+    for file_name in args.delete:
+        rag.loader.append_update('delete', file_name)
+    if args.compact:
+        merged = rag.loader.compact_updates()
+        print(f"已合并 {merged} 条增量更新到语料: {args.corpus}")
+    elif not new_by_file and not args.delete:
+        print("没有需要更新的报告")
+        return
+
+    rag.save_index(full=args.compact)
+
+if __name__ == "__main__":
+    main()
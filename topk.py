@@ -0,0 +1,56 @@
+import numpy as np
+
+# top-k 统一规则：按分数降序，同分按行号升序；第 k 名处的并列也按行号取舍，
+# 因此对任意行划分（分片）各自取 top-k 再合并，结果与整体取 top-k 完全一致
+
+
+def topk_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """
+    部分选择取 top_k：argpartition O(N) 选出候选，只对 k 个候选排序
+    同分时按行号升序，保证结果确定
+    """
+    n = len(scores)
+    if top_k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if top_k < n:
+        cand = np.argpartition(-scores, top_k - 1)[:top_k]
+        thr = scores[cand].min()
+        # argpartition 在第 k 名并列时任选其一，并列跨过边界时改为取行号最小的
+        if np.count_nonzero(scores == thr) > np.count_nonzero(scores[cand] == thr):
+            above = np.flatnonzero(scores > thr)
+            cand = np.concatenate([above, np.flatnonzero(scores == thr)[:top_k - len(above)]])
+    else:
+        cand = np.arange(n)
+    order = np.lexsort((cand, -scores[cand]))
+    return cand[order]
+
+
+def topk_indices_2d(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """
+    对 (Q, N) 相似度矩阵逐行取 top_k，返回 (Q, min(top_k, N)) 行号，规则同 topk_indices
+    """
+    q, n = scores.shape
+    k = min(top_k, n)
+    if k <= 0:
+        return np.empty((q, 0), dtype=np.int64)
+    if k < n:
+        cand = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        vals = np.take_along_axis(scores, cand, axis=1)
+        thr = vals.min(axis=1, keepdims=True)
+        ambiguous = np.flatnonzero(np.count_nonzero(scores == thr, axis=1) > np.count_nonzero(vals == thr, axis=1))
+        for row in ambiguous:
+            cand[row] = topk_indices(scores[row], k)
+    else:
+        cand = np.broadcast_to(np.arange(n), (q, n))
+    vals = np.take_along_axis(scores, cand, axis=1)
+    order = np.lexsort((cand, -vals), axis=-1)
+    return np.take_along_axis(cand, order, axis=1)
+
+
+def merge_topk(idxs: np.ndarray, scores: np.ndarray, top_k: int):
+    """
+    合并多个分片的局部 top-k：idxs/scores 为 (Q, M) 的全局行号与分数（各分片结果按列拼接）
+    :return: (Q, min(top_k, M)) 的行号与分数，规则同 topk_indices
+    """
+    order = np.lexsort((idxs, -scores), axis=-1)[:, :top_k]
+    return np.take_along_axis(idxs, order, axis=1), np.take_along_axis(scores, order, axis=1)